@@ -1,51 +1,462 @@
 from fyers_apiv3 import fyersModel
-from flask import Flask, request, render_template_string, jsonify, redirect, session, url_for
+try:
+    from fyers_apiv3.FyersWebsocket import order_ws
+except ImportError:  # older fyers_apiv3 builds ship without the order socket
+    order_ws = None
+from cryptography.fernet import Fernet, InvalidToken
+from flask import Flask, request, render_template_string, jsonify, redirect, session, url_for, g, Response
 import webbrowser
 import pandas as pd
+import numpy as np
+import requests
+import csv
 import os
 import threading
 import time
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
 import hashlib
 import json
 import uuid
 from functools import wraps
+import bisect
+import heapq
+import logging
+import logging.handlers
+import queue
+import re
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import atexit
 
 # ---- User Management File ----
 USERS_FILE = "users_data.txt"
 ACTIVE_SESSIONS_FILE = "active_sessions.txt"
+SESSION_TIMEOUT = 3600  # seconds of inactivity before a session expires
+STATE_DIR = os.environ.get("STATE_DIR", "trading_state")
+STATE_KEY_FILE = os.environ.get("STATE_KEY_FILE", "state.key")
+STATE_CHECKPOINT_INTERVAL = float(os.environ.get("STATE_CHECKPOINT_INTERVAL", 1.0))  # seconds
+ORDER_JOURNAL_FILE = os.environ.get("ORDER_JOURNAL_FILE", "order_journal.jsonl")
+ORDER_JOURNAL_COMMIT_WINDOW = float(os.environ.get("ORDER_JOURNAL_COMMIT_WINDOW", 0.002))  # seconds records wait to share an fsync
 
 # ---- Flask ----
 app = Flask(__name__)
 app.secret_key = "sajid_secret_key_2024"
 
 # ---- User Sessions Storage ----
-user_sessions = {}
+user_sessions = {}  # username -> UserState
+user_sessions_lock = threading.Lock()
 active_user_sessions = {}  # Track one session per user
 
 # ---- Fixed Thresholds ----
 FIXED_CE_THRESHOLD = 20
 FIXED_PE_THRESHOLD = 20
 
+# ---- Bot Polling Cadence ----
+BOT_POLL_MIN_INTERVAL = float(os.environ.get("BOT_POLL_MIN_INTERVAL", 0.5))      # seconds
+BOT_POLL_MAX_INTERVAL = float(os.environ.get("BOT_POLL_MAX_INTERVAL", 10))       # seconds
+BOT_POLL_BUDGET_PER_MIN = float(os.environ.get("BOT_POLL_BUDGET_PER_MIN", 120))  # optionchain calls per user
+
+# ---- Order Submission ----
+ORDER_SUBMIT_WORKERS = int(os.environ.get("ORDER_SUBMIT_WORKERS", 4))         # threads sending signal orders for all bots
+ORDER_SUBMIT_QUEUE_SIZE = int(os.environ.get("ORDER_SUBMIT_QUEUE_SIZE", 256))  # pending orders before evaluators block
+
+# ---- Order Chasing ----
+ORDER_CHASE_INTERVAL = float(os.environ.get("ORDER_CHASE_INTERVAL", 0.5))             # seconds between reprices; 0 disables chasing
+ORDER_CHASE_TIMEOUT = float(os.environ.get("ORDER_CHASE_TIMEOUT", 5.0))               # seconds before converting to market
+ORDER_CHASE_MAX_SLIPPAGE_PCT = float(os.environ.get("ORDER_CHASE_MAX_SLIPPAGE_PCT", 2.0))  # max % beyond the signal price
+ORDER_CHASE_WORKERS = int(os.environ.get("ORDER_CHASE_WORKERS", 4))
+OPTION_TICK_SIZE = 0.05
+
+# ---- Order Updates ----
+ORDER_STREAM_MODE = os.environ.get("ORDER_STREAM_MODE", "fyers")  # "fyers": order websocket, "local": in-process stand-in, "off": poll only
+ORDER_RECONCILE_INTERVAL = float(os.environ.get("ORDER_RECONCILE_INTERVAL", 30))  # seconds between orderbook reconciliations
+ORDER_FILL_POLL_INTERVAL = float(os.environ.get("ORDER_FILL_POLL_INTERVAL", 1.0))  # orderbook polls for unfilled orders without a stream
+
+# ---- Paper Trading ----
+PAPER_LATENCY = float(os.environ.get("PAPER_LATENCY", 0.05))              # seconds before a paper order reaches the book
+PAPER_SLIPPAGE_TICKS = int(os.environ.get("PAPER_SLIPPAGE_TICKS", 1))     # ticks paid beyond the LTP by marketable orders
+
+# ---- Copy Trading ----
+COPY_FANOUT_WORKERS = int(os.environ.get("COPY_FANOUT_WORKERS", 32))  # concurrent follower order submissions
+
+# ---- Kill Switch ----
+ADMIN_USERS = {name.strip() for name in os.environ.get("ADMIN_USERS", "").split(",") if name.strip()}
+KILL_SWITCH_WORKERS = int(os.environ.get("KILL_SWITCH_WORKERS", 16))      # users flattened at once (broker rate limit)
+KILL_SWITCH_DEADLINE = float(os.environ.get("KILL_SWITCH_DEADLINE", 30))  # seconds for the whole flatten
+
+# ---- Exit Rules ----
+EXIT_TRIGGER_LOG = os.environ.get("EXIT_TRIGGER_LOG", "exit_triggers.jsonl")  # append-only audit of fired exits
+EXIT_WORKERS = int(os.environ.get("EXIT_WORKERS", 4))                         # threads sending triggered exits
+EXIT_RETRIGGER_COOLDOWN = float(os.environ.get("EXIT_RETRIGGER_COOLDOWN", 5))  # seconds before a fired leg can re-arm
+EXIT_RETRY_LIMIT = int(os.environ.get("EXIT_RETRY_LIMIT", 5))                    # failed exits of a leg re-armed before giving up
+
+# ---- Bot Market Data Feed ----
+BOT_FEED_MODE = os.environ.get("BOT_FEED_MODE", "quotes")  # "quotes": batched quotes after baseline, "chain": full chain every tick
+QUOTES_MAX_SYMBOLS_PER_CALL = int(os.environ.get("QUOTES_MAX_SYMBOLS_PER_CALL", 50))
+QUOTES_POLL_INTERVAL = float(os.environ.get("QUOTES_POLL_INTERVAL", 0.5))  # seconds between batched quote rounds
+QUOTES_MAX_AGE = float(os.environ.get("QUOTES_MAX_AGE", 2.0))              # seconds before a cached quote is stale
+BOT_CHAIN_REFRESH_TTLS = float(os.environ.get("BOT_CHAIN_REFRESH_TTLS", 5))  # chain cache TTLs a quotes-fed bot lets the shared snapshot age
+
+# ---- Symbol Master ----
+SYMBOL_MASTER_URL = os.environ.get("SYMBOL_MASTER_URL", "https://public.fyers.in/sym_details/NSE_FO.csv")
+SYMBOL_MASTER_CSV = os.environ.get("SYMBOL_MASTER_CSV", "NSE_FO.csv")
+SYMBOL_MASTER_INDEX = os.environ.get("SYMBOL_MASTER_INDEX", "symbol_master.npy")
+SYMBOL_UNDERLYING = "NIFTY"
+AUTO_SYMBOL_PREFIX = "AUTO"  # symbol_prefix value that resolves symbols from the master
+
+# ---- Market Hours ----
+MARKET_TIMEZONE = ZoneInfo("Asia/Kolkata")
+NSE_HOLIDAYS_FILE = os.environ.get("NSE_HOLIDAYS_FILE", "nse_holidays.txt")
+MARKET_OPEN_TIME = os.environ.get("MARKET_OPEN_TIME", "09:15")
+MARKET_CLOSE_TIME = os.environ.get("MARKET_CLOSE_TIME", "15:30")
+PREOPEN_WARMUP_MINUTES = int(os.environ.get("PREOPEN_WARMUP_MINUTES", 5))
+BASELINE_CAPTURE_TIME = os.environ.get("BASELINE_CAPTURE_TIME", "09:15:00")
+
+# ---- Option Analytics ----
+CHAIN_CACHE_TTL = float(os.environ.get("CHAIN_CACHE_TTL", 1.0))                   # seconds a chain snapshot is shared
+ANALYTICS_RISK_FREE_RATE = float(os.environ.get("ANALYTICS_RISK_FREE_RATE", 0.065))  # annualised, continuous
+ANALYTICS_IV_ITERATIONS = 50
+CHAIN_HISTORY_SIZE = int(os.environ.get("CHAIN_HISTORY_SIZE", 900))               # snapshots kept per strike
+CHAIN_HISTORY_MAX_STRIKES = int(os.environ.get("CHAIN_HISTORY_MAX_STRIKES", 160))  # strikes tracked at once
+CHAIN_HISTORY_WINDOW = int(os.environ.get("CHAIN_HISTORY_WINDOW", 30))             # snapshots for ROC / OI change
+CHAIN_HISTORY_EMA_SPANS = (10, 30)
+CHAIN_STRIKE_STEP = int(os.environ.get("CHAIN_STRIKE_STEP", 50))        # points between NIFTY strikes
+STRIKE_WINDOW_MARGIN = int(os.environ.get("STRIKE_WINDOW_MARGIN", 3))   # strikes fetched beyond the farthest leg
+STRIKE_WINDOW_DISPLAY = int(os.environ.get("STRIKE_WINDOW_DISPLAY", 10))  # strikes per side around spot for the dashboard and analytics
+STRIKE_WINDOW_BASELINE = int(os.environ.get("STRIKE_WINDOW_BASELINE", 20))  # strikes per side captured as a user's baseline
+STRIKE_WINDOW_MAX = int(os.environ.get("STRIKE_WINDOW_MAX", 50))        # broker limit on strikecount
+
+# ---- Strategy Rules ----
+STRATEGY_MAX_RULES = int(os.environ.get("STRATEGY_MAX_RULES", 20))  # rules per user
+SHADOW_MAX_CONFIGS = int(os.environ.get("SHADOW_MAX_CONFIGS", 10))  # shadow variants per user
+
+# ---- Metrics ----
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram in seconds, Prometheus style"""
+    __slots__ = ('buckets', 'counts', 'total', 'count', 'lock')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.total += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.total, self.count
+
+
+metrics_lock = threading.Lock()
+metrics_histograms = {}  # (name, labels) -> LatencyHistogram
+metrics_counters = {}    # (name, labels) -> int
+METRIC_HELP = {
+    'pipeline_stage_seconds': 'Latency of trading pipeline stages (fetch, quote_age, pivot, evaluate, queue, submit, tick_to_order)',
+    'http_request_seconds': 'Flask request latency per route',
+    'http_requests_total': 'Flask requests per route, method and status',
+    'broker_call_seconds': 'Latency of Fyers API calls',
+    'broker_calls_total': 'Fyers API calls per method and outcome',
+    'feed_rows_total': 'Market data rows fetched per feed (chain rows or quote symbols)',
+}
+
+
+def observe_latency(name, seconds, **labels):
+    """Record a latency sample into the labelled histogram"""
+    key = (name, tuple(sorted(labels.items())))
+    hist = metrics_histograms.get(key)
+    if hist is None:
+        with metrics_lock:
+            hist = metrics_histograms.setdefault(key, LatencyHistogram())
+    hist.observe(seconds)
+
+
+def increment_counter(name, amount=1, **labels):
+    """Increment a labelled counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics_counters[key] = metrics_counters.get(key, 0) + amount
+
+
+def broker_call(method, func, *args, **kwargs):
+    """Call a Fyers API method, recording its latency and outcome (exceptions and "s": "error" replies are errors)"""
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        increment_counter('broker_calls_total', method=method, outcome="error")
+        raise
+    finally:
+        observe_latency('broker_call_seconds', time.perf_counter() - start, method=method)
+    # Fyers reports most failures as {"s": "error", ...} rather than raising
+    outcome = "error" if isinstance(result, dict) and result.get("s") == "error" else "ok"
+    increment_counter('broker_calls_total', method=method, outcome=outcome)
+    return result
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    with metrics_lock:
+        counters = sorted(metrics_counters.items())
+        histograms = sorted(metrics_histograms.items(), key=lambda item: item[0])
+
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), hist in histograms:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        counts, total, count = hist.snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip(hist.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+# ---- Logging ----
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+DEFAULT_LOG_LEVEL = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper())
+if not isinstance(DEFAULT_LOG_LEVEL, int):
+    # getLevelName returns "Level X" for unknown names, which would break every level comparison
+    print(f"Unknown LOG_LEVEL {os.environ.get('LOG_LEVEL')!r}, using INFO", file=sys.stderr)
+    DEFAULT_LOG_LEVEL = logging.INFO
+user_log_levels = {}  # username -> logging level override
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+
+class UserLevelFilter(logging.Filter):
+    """Apply the per-user log level, falling back to DEFAULT_LOG_LEVEL"""
+    def filter(self, record):
+        fields = getattr(record, 'fields', None)
+        user = fields.get('user') if fields else None
+        return record.levelno >= user_log_levels.get(user, DEFAULT_LOG_LEVEL)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records without ever blocking the caller; count drops when full"""
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            increment_counter('log_records_dropped_total')
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, msg and the structured fields"""
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'msg': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+logger = logging.getLogger("algo")
+logger.setLevel(logging.DEBUG)
+logger.propagate = False
+_queue_handler = DroppingQueueHandler(log_queue)
+_queue_handler.addFilter(UserLevelFilter())
+logger.addHandler(_queue_handler)
+
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(JsonLogFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, _stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+METRIC_HELP['log_records_dropped_total'] = 'Log records dropped because the log queue was full'
+
+
+def log_event(level, message, **fields):
+    """Queue a structured log record (user, symbol, stage, latency_ms, ...)"""
+    if fields.get('latency_ms') is not None:
+        fields['latency_ms'] = round(fields['latency_ms'], 3)
+    logger.log(level, message, extra={'fields': fields})
+
+
 # ---- User-specific Globals (stored per user) ----
+class UserState:
+    """Trading state of one user.
+
+    Fields are plain attributes. A single read or write is atomic under the
+    GIL, so read-mostly fields (client, offsets, flags) are read without a
+    lock. Updates that touch several fields together, or read-modify-write the
+    signal history, hold `lock`. `signals` and `placed_orders` are a tuple and
+    a frozenset that are replaced on every change, so a reader always sees a
+    consistent value.
+    """
+    __slots__ = (
+        'username', 'lock', 'submit_lock', 'fyers', 'token', 'token_issued_at', 'app_session',
+        'atm_strike', 'initial_data', 'baseline_date', 'strike_symbols',
+        'symbol_prefix', 'ce_strike_offset', 'pe_strike_offset',
+        'signals', 'placed_orders', 'staged_orders', 'exit_rules', 'strategy_rules', 'shadow_configs',
+        'paper_mode', 'live_fyers', 'copy_master', 'copy_multiplier', 'bot_running',
+        'bot_thread', 'cadence', 'session_id', 'last_activity',
+    )
+
+    def __init__(self, username):
+        self.username = username
+        self.lock = threading.RLock()
+        self.submit_lock = threading.RLock()  # held while a signal order is sent, so the venue cannot switch under it
+        self.fyers = None
+        self.token = None
+        self.token_issued_at = None
+        self.app_session = None
+        self.atm_strike = None
+        self.initial_data = None
+        self.baseline_date = None
+        self.strike_symbols = None
+        self.symbol_prefix = "NSE:NIFTY25"
+        self.ce_strike_offset = -300
+        self.pe_strike_offset = 300
+        self.signals = ()
+        self.placed_orders = frozenset()
+        self.staged_orders = None
+        self.exit_rules = dict.fromkeys(EXIT_RULE_FIELDS)
+        self.strategy_rules = ()
+        self.shadow_configs = ()
+        self.paper_mode = False
+        self.live_fyers = None
+        self.copy_master = None
+        self.copy_multiplier = 1.0
+        self.bot_running = False
+        self.bot_thread = None
+        self.cadence = None
+        self.session_id = None
+        self.last_activity = time.time()
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def set_fyers(self, fyers, token):
+        with self.lock:
+            self.live_fyers = fyers
+            self.fyers = paper_exchange.client(self.username, fyers) if self.paper_mode else fyers
+            self.token = token
+            self.token_issued_at = time.time()
+
+    def set_paper_mode(self, enabled):
+        """Route the user's orders to the paper exchange (market data still comes from the live client).
+
+        Exits go through the active client, so switching is refused with
+        ValueError while the user holds legs or working orders; each mode
+        keeps its own P&L book. The check and the swap run under the submit
+        lock, so no signal order can reach the old venue after the check.
+        """
+        with self.submit_lock, self.lock:
+            if enabled == self.paper_mode:
+                return
+            if pnl_engine.open_legs(self.username) or order_store.working(self.username) or \
+                    order_chaser.working(self.username):
+                raise ValueError("close open positions and working orders before switching between live and paper")
+            self.paper_mode = enabled
+            self.fyers = paper_exchange.client(self.username, self.live_fyers) if enabled else self.live_fyers
+            self.staged_orders = None
+            pnl_engine.swap_book(self.username, "paper" if enabled else "live")
+
+    def set_baseline(self, atm_strike, initial_data, strike_symbols, baseline_date):
+        """Install a new ATM baseline and clear the signals of the previous one"""
+        with self.lock:
+            self.atm_strike = atm_strike
+            self.initial_data = initial_data
+            self.strike_symbols = strike_symbols
+            self.baseline_date = baseline_date
+            self.signals = ()
+            self.placed_orders = frozenset()
+
+    def reset_baseline(self):
+        self.set_baseline(None, None, None, None)
+
+    def record_signal(self, signal_name, text):
+        """Atomically claim a signal; False if it was already placed"""
+        with self.lock:
+            if signal_name in self.placed_orders:
+                return False
+            self.placed_orders = self.placed_orders | {signal_name}
+            self.signals = self.signals + (text,)
+            return True
+
+    def status(self):
+        """Consistent view for /bot_status"""
+        with self.lock:
+            return {
+                "running": self.bot_running,
+                "signals": list(self.signals),
+                "placed_orders": sorted(self.placed_orders),
+                "cadence": self.cadence.describe() if self.cadence else None,
+            }
+
+
+def get_user_state(username):
+    """Return the user's state, creating it on first use"""
+    state = user_sessions.get(username)
+    if state is None:
+        with user_sessions_lock:
+            state = user_sessions.get(username)
+            if state is None:
+                state = user_sessions[username] = UserState(username)
+    return state
+
+
+def find_user_state(username):
+    """Return the user's state or None; never creates one, so background threads cannot revive logged-out users"""
+    return user_sessions.get(username)
+
+
 def init_user_data(username):
     """Initialize user-specific data"""
-    if username not in user_sessions:
-        user_sessions[username] = {
-            'fyers': None,
-            'token': None,
-            'app_session': None,
-            'atm_strike': None,
-            'initial_data': None,
-            'symbol_prefix': "NSE:NIFTY25",
-            'ce_strike_offset': -300,
-            'pe_strike_offset': 300,
-            'signals': [],
-            'placed_orders': set(),
-            'bot_running': False,
-            'bot_thread': None,
-            'session_id': None
-        }
+    get_user_state(username)
+
+
+def drop_user_state(username):
+    """Stop the user's bot and forget their in-memory state"""
+    with user_sessions_lock:
+        state = user_sessions.pop(username, None)
+    if state is not None:
+        state.bot_running = False
+    order_stream.disconnect(username)
+    strategy_engine.discard(username)
+    shadow_engine.discard(username)
+    copy_trader.unfollow(username)
+    exit_engine.discard(username)
+    order_chaser.discard(username)
+    order_store.discard(username)
+    pnl_engine.discard(username)
+    paper_exchange.reset(username)
 
 def load_active_sessions():
     """Load active sessions from file"""
@@ -55,7 +466,7 @@ def load_active_sessions():
         with open(ACTIVE_SESSIONS_FILE, 'r') as f:
             return json.load(f)
     except Exception as e:
-        print(f"Error loading active sessions: {e}")
+        log_event(logging.ERROR, "Error loading active sessions", stage="sessions", error=str(e))
         return {}
 
 def save_active_sessions():
@@ -64,22 +475,20 @@ def save_active_sessions():
         with open(ACTIVE_SESSIONS_FILE, 'w') as f:
             json.dump(active_user_sessions, f)
     except Exception as e:
-        print(f"Error saving active sessions: {e}")
+        log_event(logging.ERROR, "Error saving active sessions", stage="sessions", error=str(e))
 
-def invalidate_user_session(username):
+def invalidate_user_session(username, persist=True):
     """Invalidate any existing session for a user"""
     if username in active_user_sessions:
         old_session_id = active_user_sessions[username]
-        # Clear user data for old session
-        if username in user_sessions:
-            # Stop bot if running
-            if user_sessions[username].get('bot_running'):
-                user_sessions[username]['bot_running'] = False
-            del user_sessions[username]
+        # Clear user data for old session (stops the bot if running)
+        drop_user_state(username)
         # Remove from active sessions
         del active_user_sessions[username]
-        save_active_sessions()
-        print(f"⚠️ Terminated previous session for user: {username}")
+        if persist:
+            save_active_sessions()
+        discard_user_state(username)
+        log_event(logging.WARNING, "Terminated previous session", user=username, stage="sessions")
         return old_session_id
     return None
 
@@ -90,25 +499,76 @@ def register_user_session(username, session_id):
     # Register new session
     active_user_sessions[username] = session_id
     save_active_sessions()
-    init_user_data(username)
-    user_sessions[username]['session_id'] = session_id
-    print(f"✅ New session registered for user: {username}")
-
-def cleanup_expired_sessions():
-    """Clean up expired sessions (run periodically)"""
-    current_time = time.time()
-    expired_users = []
-    
-    for username, session_id in active_user_sessions.items():
-        if username in user_sessions:
-            # Check if session is still valid (has recent activity)
-            last_activity = user_sessions[username].get('last_activity', 0)
-            if current_time - last_activity > 3600:  # 1 hour timeout
-                expired_users.append(username)
-    
-    for username in expired_users:
-        invalidate_user_session(username)
-        print(f"🧹 Cleaned up expired session for: {username}")
+    get_user_state(username).session_id = session_id
+    session_reaper.schedule(username, session_id, time.time() + SESSION_TIMEOUT)
+    log_event(logging.INFO, "New session registered", user=username, stage="sessions")
+
+class SessionReaper:
+    """Expires sessions close to their deadline using a min-heap of (deadline, username, session_id).
+
+    Activity only bumps `last_activity` on the user's state; when an entry
+    comes due it is checked against that and pushed back with the real
+    deadline if the user has been active. Entries for sessions that were
+    replaced or logged out are dropped when popped.
+    """
+
+    def __init__(self, timeout=SESSION_TIMEOUT):
+        self.timeout = timeout
+        self.heap = []
+        self.cond = threading.Condition()
+
+    def schedule(self, username, session_id, deadline):
+        with self.cond:
+            heapq.heappush(self.heap, (deadline, username, session_id))
+            if self.heap[0][2] == session_id:
+                self.cond.notify()
+
+    def _pop_due(self):
+        """Block until at least one entry is due and return all due entries"""
+        with self.cond:
+            while True:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                wait = self.heap[0][0] - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                now = time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+                return now, due
+
+    def sweep(self, now, due):
+        """Expire the due sessions that saw no activity; one sessions-file write per sweep"""
+        expired = []
+        for deadline, username, session_id in due:
+            if active_user_sessions.get(username) != session_id:
+                continue
+            state = user_sessions.get(username)
+            if state is not None and state.last_activity + self.timeout > now:
+                self.schedule(username, session_id, state.last_activity + self.timeout)
+                continue
+            expired.append(username)
+
+        for username in expired:
+            invalidate_user_session(username, persist=False)
+            log_event(logging.INFO, "Cleaned up expired session", user=username, stage="sessions")
+        if expired:
+            save_active_sessions()
+        return expired
+
+    def run(self):
+        while True:
+            try:
+                self.sweep(*self._pop_due())
+            except Exception as e:
+                log_event(logging.ERROR, "Session reaper error", stage="sessions", error=str(e))
+                time.sleep(1)
+
+
+session_reaper = SessionReaper()
 
 # ---- Helper Functions ----
 def hash_password(password):
@@ -126,7 +586,7 @@ def load_users():
                     data = json.loads(line)
                     users[data['username']] = data
     except Exception as e:
-        print(f"Error loading users: {e}")
+        log_event(logging.ERROR, "Error loading users", stage="users", error=str(e))
     return users
 
 def save_user(username, password, email, phone, fyers_client_id, fyers_secret_key):
@@ -166,33 +626,37 @@ def login_required(f):
             return redirect(url_for('signin', error="Session expired. Please login again."))
         
         # Update last activity
-        if username in user_sessions:
-            user_sessions[username]['last_activity'] = time.time()
+        state = user_sessions.get(username)
+        if state is not None:
+            state.last_activity = time.time()
         
         return f(*args, **kwargs)
     return decorated_function
 
 def get_user_fyers_session(username):
     """Get user's Fyers session"""
-    init_user_data(username)
-    return user_sessions[username].get('fyers'), user_sessions[username].get('token')
+    state = find_user_state(username)
+    if state is None:
+        return None, None
+    return state.fyers, state.token
 
 def set_user_fyers_session(username, fyers, token):
     """Set user's Fyers session"""
-    init_user_data(username)
-    user_sessions[username]['fyers'] = fyers
-    user_sessions[username]['token'] = token
+    get_user_state(username).set_fyers(fyers, token)
+    mark_state_dirty(username)
+    order_stream.connect(username, token)
 
 def get_user_data(username, key):
     """Get user-specific data"""
-    init_user_data(username)
-    return user_sessions[username].get(key)
+    return getattr(get_user_state(username), key)
 
 def set_user_data(username, key, value):
     """Set user-specific data"""
-    init_user_data(username)
-    user_sessions[username][key] = value
-    user_sessions[username]['last_activity'] = time.time()
+    state = get_user_state(username)
+    setattr(state, key, value)
+    state.last_activity = time.time()
+    if key in PERSISTED_USER_KEYS:
+        mark_state_dirty(username)
 
 def format_in_crores(value):
     """Format a number in crores (1 crore = 10 million)"""
@@ -231,12 +695,12 @@ def create_user_fyers_session(username):
 def init_user_fyers(username, auth_code):
     """Initialize Fyers for specific user"""
     try:
-        appSession = user_sessions[username].get('app_session')
+        appSession = get_user_state(username).app_session
         if not appSession:
             return False
             
         appSession.set_token(auth_code)
-        token_response = appSession.generate_token()
+        token_response = broker_call('generate_token', appSession.generate_token)
         access_token = token_response.get("access_token")
         
         user_info = get_user_info(username)
@@ -250,44 +714,302 @@ def init_user_fyers(username, auth_code):
         )
         
         set_user_fyers_session(username, fyers, access_token)
-        print(f"✅ Fyers session initialized for user: {username}")
+        # A same-day login must not inherit intents that never reached the broker
+        order_journal.replay_orderbook(username)
+        log_event(logging.INFO, "Fyers session initialized", user=username, stage="auth")
         return True
     except Exception as e:
-        print(f"❌ Failed to init Fyers for {username}: {e}")
+        log_event(logging.ERROR, "Failed to init Fyers", user=username, stage="auth", error=str(e))
         return False
 
 
-def place_order(username, symbol, price, side):
-    """Place order for specific user"""
-    fyers, _ = get_user_fyers_session(username)
-    if fyers is None:
+# ---- State Snapshots ----
+PERSISTED_USER_KEYS = (
+    'atm_strike', 'initial_data', 'symbol_prefix', 'ce_strike_offset', 'pe_strike_offset',
+    'signals', 'placed_orders', 'bot_running', 'baseline_date', 'strike_symbols', 'exit_rules',
+    'strategy_rules', 'shadow_configs', 'paper_mode', 'copy_master', 'copy_multiplier',
+)
+dirty_states = set()
+dirty_states_lock = threading.Lock()
+_state_cipher = None
+
+
+def get_state_cipher():
+    """Fernet cipher for tokens at rest, keyed by STATE_ENCRYPTION_KEY or a local key file"""
+    global _state_cipher
+    if _state_cipher is None:
+        key = os.environ.get("STATE_ENCRYPTION_KEY")
+        if not key:
+            if not os.path.exists(STATE_KEY_FILE):
+                fd = os.open(STATE_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(Fernet.generate_key())
+            with open(STATE_KEY_FILE, 'rb') as f:
+                key = f.read().strip()
+        _state_cipher = Fernet(key)
+    return _state_cipher
+
+
+def state_file(username):
+    return os.path.join(STATE_DIR, hashlib.sha256(username.encode()).hexdigest()[:32] + ".json")
+
+
+def mark_state_dirty(username):
+    with dirty_states_lock:
+        dirty_states.add(username)
+
+
+def snapshot_user_state(username):
+    """Serializable copy of a user's trading state, with the access token encrypted"""
+    state = user_sessions.get(username)
+    if state is None:
         return None
-    
-    try:
-        data = {
-            "symbol": symbol,
-            "qty": 75,
-            "type": 1,
-            "side": side,
-            "productType": "INTRADAY",
-            "limitPrice": price,
-            "stopPrice": 0,
-            "validity": "DAY",
-            "disclosedQty": 0,
-            "offlineOrder": False,
-            "orderTag": f"{username}_signalorder"
+    with state.lock:
+        token = state.token
+        snapshot = {
+            'username': username,
+            'session_id': state.session_id,
+            'token_issued_at': state.token_issued_at,
+            'atm_strike': state.atm_strike,
+            'initial_data': state.initial_data,
+            'symbol_prefix': state.symbol_prefix,
+            'ce_strike_offset': state.ce_strike_offset,
+            'pe_strike_offset': state.pe_strike_offset,
+            'signals': list(state.signals),
+            'placed_orders': sorted(state.placed_orders),
+            'bot_running': bool(state.bot_running),
+            'baseline_date': state.baseline_date.isoformat() if state.baseline_date else None,
+            'strike_symbols': state.strike_symbols,
+            'exit_rules': dict(state.exit_rules),
+            'strategy_rules': list(state.strategy_rules),
+            'shadow_configs': list(state.shadow_configs),
+            'paper_mode': bool(state.paper_mode),
+            'copy_master': state.copy_master,
+            'copy_multiplier': state.copy_multiplier,
+            'saved_at': time.time(),
         }
-        response = fyers.place_order(data=data)
-        print(f"✅ Order placed by {username}: {response}")
+    snapshot['shadow_fills'] = shadow_engine.fills(username)
+    snapshot['paper_positions'] = paper_exchange.positions(username)
+    snapshot['token'] = get_state_cipher().encrypt(token.encode()).decode() if token else None
+    return snapshot
+
+
+def write_user_state(username):
+    snapshot = snapshot_user_state(username)
+    if snapshot is None:
+        return
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = state_file(username)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, default=str)
+    os.replace(tmp_path, path)
+
+
+def discard_user_state(username):
+    with dirty_states_lock:
+        dirty_states.discard(username)
+    try:
+        os.remove(state_file(username))
+    except OSError:
+        pass
+
+
+def checkpoint_dirty_states():
+    """Write the snapshot of every user whose persisted state changed since the last checkpoint"""
+    with dirty_states_lock:
+        usernames = list(dirty_states)
+        dirty_states.clear()
+    for username in usernames:
+        try:
+            write_user_state(username)
+        except Exception as e:
+            mark_state_dirty(username)
+            log_event(logging.ERROR, "State checkpoint failed", user=username, stage="state", error=str(e))
+
+
+def checkpoint_worker():
+    """Background worker that checkpoints dirty user states"""
+    while True:
+        time.sleep(STATE_CHECKPOINT_INTERVAL)
+        checkpoint_dirty_states()
+
+
+def restore_user_state(snapshot):
+    """Rehydrate one user's state and Fyers client from a snapshot; returns True if a bot should resume"""
+    username = snapshot['username']
+    state = get_user_state(username)
+    for key in ('atm_strike', 'initial_data', 'symbol_prefix', 'ce_strike_offset', 'pe_strike_offset'):
+        if snapshot.get(key) is not None:
+            setattr(state, key, snapshot[key])
+    state.signals = tuple(snapshot.get('signals') or ())
+    state.placed_orders = frozenset(snapshot.get('placed_orders') or ())
+    if snapshot.get('exit_rules'):
+        state.exit_rules = dict(state.exit_rules, **snapshot['exit_rules'])
+    if snapshot.get('strategy_rules'):
+        try:
+            strategy_engine.set_rules(username, snapshot['strategy_rules'])
+        except ValueError as e:
+            log_event(logging.ERROR, "Stored strategy rules rejected", user=username, stage="rules", error=str(e))
+    if snapshot.get('shadow_configs'):
+        try:
+            shadow_engine.set_shadows(username, parse_shadow_configs(snapshot['shadow_configs'], state))
+            shadow_engine.restore_fills(username, snapshot.get('shadow_fills') or {})
+        except (ValueError, TypeError) as e:
+            log_event(logging.ERROR, "Stored shadow configs rejected", user=username, stage="shadow", error=str(e))
+    state.session_id = snapshot.get('session_id')
+    state.last_activity = time.time()
+    if snapshot.get('baseline_date'):
+        state.baseline_date = date.fromisoformat(snapshot['baseline_date'])
+    if snapshot.get('strike_symbols'):
+        # JSON turned the strike keys into strings
+        state.strike_symbols = {int(float(k)) if float(k).is_integer() else float(k): v
+                                for k, v in snapshot['strike_symbols'].items()}
+
+    # Fyers access tokens are only good for the day they were issued
+    issued_at = snapshot.get('token_issued_at')
+    if snapshot.get('token') and issued_at and \
+            datetime.fromtimestamp(issued_at, MARKET_TIMEZONE).date() == datetime.now(MARKET_TIMEZONE).date():
+        try:
+            token = get_state_cipher().decrypt(snapshot['token'].encode()).decode()
+        except InvalidToken:
+            log_event(logging.ERROR, "Stored token could not be decrypted", user=username, stage="state")
+            token = None
+        client_id = get_user_info(username).get('fyers_client_id')
+        if token and client_id:
+            fyers = fyersModel.FyersModel(client_id=client_id, token=token, is_async=False, log_path="")
+            state.set_fyers(fyers, token)
+            state.token_issued_at = issued_at
+            order_stream.connect(username, token)
+    if snapshot.get('paper_mode'):
+        state.set_paper_mode(True)
+    if snapshot.get('paper_positions'):
+        # Virtual positions survive the restart, so their P&L and exits carry on
+        paper_exchange.restore_positions(username, snapshot['paper_positions'])
+        if state.paper_mode:
+            pnl_engine.sync(username, paper_exchange.positions(username))
+    if snapshot.get('copy_master'):
+        try:
+            copy_trader.follow(username, snapshot['copy_master'], snapshot.get('copy_multiplier') or 1.0)
+        except ValueError as e:
+            log_event(logging.ERROR, "Stored copy subscription rejected", user=username, stage="copy", error=str(e))
+    return bool(snapshot.get('bot_running')) and state.fyers is not None
+
+
+def restore_user_states():
+    """Restore every checkpointed user that still has an active session and resume their bots"""
+    if not os.path.isdir(STATE_DIR):
+        return
+    start = time.perf_counter()
+    resumed = []
+    restored = []
+    for name in os.listdir(STATE_DIR):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(STATE_DIR, name)
+        try:
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+            username = snapshot['username']
+            if active_user_sessions.get(username) != snapshot.get('session_id'):
+                os.remove(path)
+                continue
+            if restore_user_state(snapshot):
+                resumed.append(username)
+            if get_user_state(username).fyers is not None:
+                restored.append(username)
+        except Exception as e:
+            log_event(logging.ERROR, "State restore failed", stage="state", file=name, error=str(e))
+    # Orders sent just before the restart must not go out again
+    for username in restored:
+        order_journal.replay_orderbook(username)
+    for username in resumed:
+        start_bot_thread(username)
+    log_event(logging.INFO, "User states restored", stage="state", resumed_bots=len(resumed),
+              latency_ms=(time.perf_counter() - start) * 1000)
+
+
+def signal_order_payload(username, symbol, side):
+    """Order dict for a signal entry; limitPrice is filled in when the signal fires"""
+    return {
+        "symbol": symbol,
+        "qty": 75,
+        "type": 1,
+        "side": side,
+        "productType": "INTRADAY",
+        "limitPrice": 0,
+        "stopPrice": 0,
+        "validity": "DAY",
+        "disclosedQty": 0,
+        "offlineOrder": False,
+        "orderTag": f"{username}_signalorder"
+    }
+
+
+def send_order(username, fyers, data, signal_name=None):
+    """Submit a ready order dict with the given client; signal orders are journaled under an idempotency tag first"""
+    tag = None
+    fanout = None
+    if signal_name is not None:
+        if kill_switch.engaged:
+            log_event(logging.WARNING, "Signal order blocked by kill switch", user=username, symbol=data["symbol"],
+                      stage="submit", signal=signal_name)
+            return None
+        tag = order_journal.begin(username, signal_name, data)
+        if tag is None:
+            log_event(logging.WARNING, "Duplicate signal order suppressed", user=username, symbol=data["symbol"],
+                      stage="submit", signal=signal_name)
+            return None
+        data = {**data, "orderTag": tag}
+        # Followers' copies go out alongside the master's own order
+        fanout = copy_trader.fan_out(username, signal_name, data)
+    state = find_user_state(username)
+    try:
+        # A paper/live switch waits until this order is registered; an order
+        # prepared for a client the user no longer uses is not sent at all
+        with state.submit_lock if state is not None else nullcontext():
+            if state is not None and fyers is not state.fyers:
+                raise RuntimeError("broker client changed since the order was prepared; not sent")
+            response = broker_call('place_order', fyers.place_order, data=data)
+            if isinstance(response, dict) and response.get("s") == "ok":
+                # The leg enters the P&L (and arms its exits) only as fills are confirmed
+                order_store.expect(response.get("id"), username, data)
+                order_chaser.track(username, fyers, response.get("id"), data)
+        if fanout is not None:
+            fanout.ack(username, response)
+        log_event(logging.INFO, "Order placed", user=username, symbol=data["symbol"], stage="submit",
+                  price=data["limitPrice"], side=data["side"], tag=tag, response=response)
+        if tag is not None:
+            order_journal.record_sent(username, tag, response)
         return response
     except Exception as e:
-        print(f"❌ Order error for {username}: {e}")
+        log_event(logging.ERROR, "Order error", user=username, symbol=data["symbol"], stage="submit", error=str(e))
+        if fanout is not None:
+            fanout.ack(username, None)
+        if tag is not None:
+            order_journal.record_sent(username, tag, None)
         return None
 
 
-def exit_position(username, symbol, qty, side, productType="INTRADAY"):
-    """Exit a specific position for user"""
+def place_order(username, symbol, price, side, signal_name=None):
+    """Place order for specific user"""
     fyers, _ = get_user_fyers_session(username)
+    if fyers is None:
+        return None
+
+    if not symbol or symbol_master.is_valid(symbol) is False:
+        log_event(logging.ERROR, "Order rejected: unknown symbol", user=username, symbol=symbol, stage="submit")
+        return None
+
+    data = signal_order_payload(username, symbol, side)
+    data["limitPrice"] = price
+    return send_order(username, fyers, data, signal_name)
+
+
+def exit_position(username, symbol, qty, side, productType="INTRADAY", fyers=None):
+    """Exit a specific position for user, on `fyers` (default: their active client)"""
+    active, _ = get_user_fyers_session(username)
+    fyers = active if fyers is None else fyers
     if fyers is None:
         return {"error": "⚠️ Please login first!"}
     
@@ -306,31 +1028,40 @@ def exit_position(username, symbol, qty, side, productType="INTRADAY"):
             "orderTag": f"{username}_exitposition"
         }
         
-        response = fyers.place_order(data=data)
-        print(f"✅ Exit order placed for {username} - {symbol}: {response}")
+        response = broker_call('place_order', fyers.place_order, data=data)
+        log_event(logging.INFO, "Exit order placed", user=username, symbol=symbol, stage="exit", qty=qty, side=side, response=response)
+        if isinstance(response, dict) and response.get("s") == "ok":
+            # Only fills on the active client belong to the user's current P&L book
+            if fyers is active:
+                order_store.expect(response.get("id"), username, data)
+            else:
+                order_store.expect(response.get("id"))
         return {
             "message": f"Exit order placed for {symbol}",
             "response": response
         }
         
     except Exception as e:
-        print(f"❌ Error exiting position {username} - {symbol}: {e}")
+        log_event(logging.ERROR, "Error exiting position", user=username, symbol=symbol, stage="exit", error=str(e))
         return {"error": str(e)}
 
 
-def exit_all_positions(username):
-    """Exit all open positions for user"""
-    fyers, _ = get_user_fyers_session(username)
+def exit_all_positions(username, fyers=None):
+    """Exit all open positions for user, on `fyers` (default: their active client)"""
+    active, _ = get_user_fyers_session(username)
+    fyers = active if fyers is None else fyers
     if fyers is None:
         return {"error": "⚠️ Please login first!"}
     
     try:
-        positions = fyers.positions()
+        positions = broker_call('positions', fyers.positions)
         
         if not positions or "netPositions" not in positions:
             return {"message": "No open positions found"}
         
         open_positions = positions["netPositions"]
+        if fyers is active:
+            pnl_engine.sync(username, open_positions)
         exit_results = []
         
         for pos in open_positions:
@@ -339,7 +1070,7 @@ def exit_all_positions(username):
                 qty = abs(int(pos["netQty"]))
                 side = -1 if int(pos["netQty"]) > 0 else 1
                 
-                result = exit_position(username, symbol, qty, side, pos.get("productType", "INTRADAY"))
+                result = exit_position(username, symbol, qty, side, pos.get("productType", "INTRADAY"), fyers)
                 exit_results.append({
                     "symbol": symbol,
                     "qty": qty,
@@ -353,124 +1084,3927 @@ def exit_all_positions(username):
         }
         
     except Exception as e:
-        print(f"❌ Error exiting positions for {username}: {e}")
+        log_event(logging.ERROR, "Error exiting positions", user=username, stage="exit", error=str(e))
         return {"error": str(e)}
 
 
-def background_bot_worker(username):
-    """Background thread for specific user"""
-    print(f"🤖 Background bot started for {username}")
-    
-    while get_user_data(username, 'bot_running'):
+# ---- Copy Trading ----
+METRIC_HELP['copy_fanout_seconds'] = 'Time from a master signal order until the last copy (or the master order) was acknowledged'
+METRIC_HELP['copy_fanout_spread_seconds'] = 'Time between the first and the last acknowledgement of one fan-out'
+METRIC_HELP['copy_orders_total'] = 'Follower copies of master signal orders, by outcome (ok, error, skipped)'
+
+
+class FanOut:
+    """One master signal order and its follower copies, finished when every order was acknowledged"""
+    __slots__ = ('master', 'signal_name', 'started', 'pending', 'first_ack', 'last_ack', 'outcomes', 'lock')
+
+    def __init__(self, master, signal_name, count):
+        self.master = master
+        self.signal_name = signal_name
+        self.started = time.perf_counter()
+        self.pending = count
+        self.first_ack = None
+        self.last_ack = None
+        self.outcomes = {}  # outcome -> count
+        self.lock = threading.Lock()
+
+    def ack(self, username, response, outcome=None):
+        now = time.perf_counter()
+        if outcome is None:
+            outcome = "ok" if isinstance(response, dict) and response.get("s") == "ok" else "error"
+        with self.lock:
+            if outcome != "skipped":
+                self.first_ack = now if self.first_ack is None else self.first_ack
+                self.last_ack = now
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.pending -= 1
+            done = self.pending == 0
+        if username != self.master:
+            increment_counter('copy_orders_total', outcome=outcome)
+        if done:
+            self.finish()
+
+    def finish(self):
+        if self.last_ack is None:
+            return
+        observe_latency('copy_fanout_seconds', self.last_ack - self.started)
+        observe_latency('copy_fanout_spread_seconds', self.last_ack - self.first_ack)
+        log_event(logging.INFO, "Copy fan-out complete", user=self.master, stage="copy", signal=self.signal_name,
+                  latency_ms=(self.last_ack - self.started) * 1000,
+                  spread_ms=round((self.last_ack - self.first_ack) * 1000, 3), **self.outcomes)
+
+
+class CopyTrader:
+    """Master/follower copy trading of signal orders.
+
+    When a master's signal order is sent, a copy for every follower is
+    submitted to a shared pool at the same moment, scaled by the follower's
+    multiplier in whole lots, so all accounts hit the broker within one
+    round of the pool rather than at each bot's own polling phase. The
+    signal is claimed on each follower's state, and journaled under the
+    follower's own idempotency tag, so nothing is ever copied twice.
+    Copies only go to followers trading in the master's mode (live or
+    paper). Followers do not run bots of their own; masters cannot follow
+    anyone.
+    """
+
+    def __init__(self, workers=COPY_FANOUT_WORKERS):
+        self.followers = {}  # master -> {follower: multiplier}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="copy")
+
+    def follow(self, username, master, multiplier=1.0):
+        """Make `username` copy `master`'s signal orders; raises ValueError when not allowed"""
+        multiplier = float(multiplier)
+        if not multiplier > 0:
+            raise ValueError("multiplier must be positive")
+        if master == username:
+            raise ValueError("cannot follow yourself")
+        if master not in load_users():
+            raise ValueError(f"unknown user {master!r}")
+        state = get_user_state(username)
+        with self.lock:
+            if self.followers.get(username):
+                raise ValueError("a master cannot follow another account")
+            if any(master in followers for followers in self.followers.values()):
+                raise ValueError(f"{master!r} is itself a follower")
+            self._remove(username)
+            self.followers.setdefault(master, {})[username] = multiplier
+            state.copy_master = master
+            state.copy_multiplier = multiplier
+        state.bot_running = False
+
+    def unfollow(self, username):
+        with self.lock:
+            self._remove(username)
+        state = user_sessions.get(username)
+        if state is not None:
+            state.copy_master = None
+
+    def _remove(self, username):
+        # Callers hold self.lock
+        for master, followers in list(self.followers.items()):
+            if followers.pop(username, None) is not None and not followers:
+                del self.followers[master]
+
+    def fan_out(self, master, signal_name, data):
+        """Submit the follower copies of a master signal order; the FanOut to ack the master's order on, or None"""
+        with self.lock:
+            followers = list(self.followers.get(master, {}).items())
+        if not followers:
+            return None
+        master_state = user_sessions.get(master)
+        paper = master_state is not None and master_state.paper_mode
+        fanout = FanOut(master, signal_name, len(followers) + 1)
+        for follower, multiplier in followers:
+            self.executor.submit(self._copy, fanout, follower, multiplier, signal_name, data, paper)
+        return fanout
+
+    def _copy(self, fanout, follower, multiplier, signal_name, data, paper):
+        state = user_sessions.get(follower)
+        fyers = state.fyers if state is not None else None
+        if fyers is None or state.paper_mode != paper:
+            # A paper signal must never become a live order (nor the other way round)
+            fanout.ack(follower, None, outcome="skipped")
+            return
+        try:
+            lot = symbol_master.lot_size(data["symbol"]) if symbol_master.is_valid(data["symbol"]) else None
+            lot = lot or data["qty"]
+            qty = max(1, round(data["qty"] * multiplier / lot)) * lot
+            option_type, _, strike = signal_name.split("_", 2)
+            if kill_switch.blocks(follower, signal_name, "copy") or \
+                    not state.record_signal(signal_name, f"{strike} {data['limitPrice']} {option_type} Copy of {fanout.master}"):
+                fanout.ack(follower, None, outcome="skipped")
+                return
+            mark_state_dirty(follower)
+            payload = {**signal_order_payload(follower, data["symbol"], data["side"]),
+                       "qty": qty, "limitPrice": data["limitPrice"]}
+            response = send_order(follower, fyers, payload, signal_name)
+        except Exception as e:
+            log_event(logging.ERROR, "Copy order failed", user=follower, symbol=data["symbol"], stage="copy",
+                      master=fanout.master, error=str(e))
+            response = None
+        fanout.ack(follower, response)
+
+    def describe(self, username):
+        with self.lock:
+            state = user_sessions.get(username)
+            return {
+                "master": state.copy_master if state is not None else None,
+                "multiplier": state.copy_multiplier if state is not None else None,
+                "followers": dict(self.followers.get(username, {})),
+            }
+
+
+copy_trader = CopyTrader()
+
+
+# ---- Kill Switch ----
+METRIC_HELP['kill_switch_user_seconds'] = 'Time to flatten one user during a kill switch run, by outcome'
+METRIC_HELP['kill_switch_runs_total'] = 'Kill switch flatten runs'
+METRIC_HELP['kill_switch_blocked_signals_total'] = 'Fired signals left unclaimed because the kill switch is engaged, by source'
+
+
+class KillSwitch:
+    """Firm-wide emergency flatten, for ADMIN_USERS only.
+
+    Engaging it blocks every new signal order (exits still go out) and stops
+    every bot. `start` then submits a flatten of every user with a broker
+    client to a pool of KILL_SWITCH_WORKERS before returning: working chased
+    orders are cancelled and exit_all_positions runs on the user's active
+    client, and also on the live client of users in paper mode. The flatten
+    does not depend on anyone reading the progress: `stream` only reports
+    one record per user as they finish and a summary at the end; users not
+    done by the deadline are reported as timed out (their exits keep running
+    in the background). The switch stays engaged until `release`.
+    """
+
+    def __init__(self, workers=KILL_SWITCH_WORKERS, deadline=KILL_SWITCH_DEADLINE):
+        self.deadline = deadline
+        self.engaged = False
+        self.running = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flatten")
+
+    def release(self):
+        self.engaged = False
+
+    def blocks(self, username, signal_name, source):
+        """Whether a fired signal must be left unclaimed, so it can still fire once the switch is released"""
+        if not self.engaged:
+            return False
+        increment_counter('kill_switch_blocked_signals_total', source=source)
+        log_event(logging.DEBUG, "Signal held by kill switch", user=username, stage="evaluate",
+                  signal=signal_name, source=source)
+        return True
+
+    def _flatten(self, username, state):
+        start = time.perf_counter()
+        try:
+            cancelled = order_chaser.cancel_user(username)
+            clients = [("paper" if state.paper_mode else "live", state.fyers)]
+            if state.paper_mode and state.live_fyers is not None:
+                # A paper user can still hold live positions opened before the switch or elsewhere
+                clients.append(("live", state.live_fyers))
+            exits, failed, errors = 0, [], []
+            for venue, fyers in clients:
+                result = exit_all_positions(username, fyers)
+                details = result.get("details", ())
+                exits += len(details)
+                failed += [f"{venue}:{d['symbol']}" for d in details if "error" in (d.get("result") or {})]
+                if "error" in result:
+                    errors.append(f"{venue}: {result['error']}")
+            outcome = "error" if errors or failed else "ok"
+            record = {"user": username, "outcome": outcome, "cancelled_orders": cancelled,
+                      "venues": [venue for venue, _ in clients], "exits": exits,
+                      "failed_symbols": failed, "detail": "; ".join(errors) or None}
+        except Exception as e:
+            outcome = "error"
+            record = {"user": username, "outcome": outcome, "detail": str(e)}
+        elapsed = time.perf_counter() - start
+        observe_latency('kill_switch_user_seconds', elapsed, outcome=outcome)
+        record["latency_ms"] = round(elapsed * 1000, 3)
+        log_event(logging.WARNING, "Kill switch flattened user", user=username, stage="kill_switch",
+                  outcome=outcome, latency_ms=record["latency_ms"])
+        return record
+
+    def start(self, operator):
+        """Engage, stop every bot and submit every user's flatten; returns the run for `stream`, or None if a run is in progress"""
+        if not self.running.acquire(blocking=False):
+            return None
+        try:
+            run = {"operator": operator, "start": time.perf_counter(), "results": queue.Queue(),
+                   "skipped": [], "pending": {}, "remaining": 0, "lock": threading.Lock()}
+            self.engaged = True
+            increment_counter('kill_switch_runs_total')
+            with user_sessions_lock:
+                states = list(user_sessions.values())
+            for state in states:
+                if state.bot_running:
+                    state.bot_running = False
+                    mark_state_dirty(state.username)
+            log_event(logging.CRITICAL, "Kill switch engaged", user=operator, stage="kill_switch", users=len(states))
+            run["users"] = len(states)
+
+            futures = []
+            for state in states:
+                if state.fyers is None:
+                    run["skipped"].append(state.username)
+                    continue
+                future = self.executor.submit(self._flatten, state.username, state)
+                run["pending"][future] = state.username
+                futures.append(future)
+            run["remaining"] = len(futures)
+        except Exception:
+            self.running.release()
+            raise
+        if not futures:
+            self._finish(run)
+        for future in futures:
+            future.add_done_callback(lambda future: self._done(run, future))
+        return run
+
+    def _done(self, run, future):
+        run["results"].put(future)
+        with run["lock"]:
+            run["remaining"] -= 1
+            last = run["remaining"] == 0
+        if last:
+            self._finish(run)
+
+    def _finish(self, run):
+        elapsed = time.perf_counter() - run["start"]
+        log_event(logging.CRITICAL, "Kill switch flatten finished", user=run["operator"], stage="kill_switch",
+                  latency_ms=elapsed * 1000, users=run["users"], skipped=len(run["skipped"]))
+        self.running.release()
+
+    def stream(self, run):
+        """Progress records of a started run: engaged, one per user, then a summary"""
+        yield {"event": "engaged", "operator": run["operator"], "users": run["users"],
+               "deadline_seconds": self.deadline}
+        outcomes = {}
+        for username in run["skipped"]:
+            outcomes["skipped"] = outcomes.get("skipped", 0) + 1
+            yield {"event": "user", "user": username, "outcome": "skipped",
+                   "detail": "No broker session", "latency_ms": 0.0}
+
+        pending = dict(run["pending"])
+        deadline = run["start"] + self.deadline
+        while pending:
+            try:
+                future = run["results"].get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            record = future.result()
+            pending.pop(future)
+            outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+            yield dict(record, event="user")
+        for future, username in pending.items():
+            outcomes["timeout"] = outcomes.get("timeout", 0) + 1
+            yield {"event": "user", "user": username, "outcome": "timeout",
+                   "detail": "Not finished by the deadline; still running"}
+
+        elapsed = time.perf_counter() - run["start"]
+        yield {"event": "done", "elapsed_ms": round(elapsed * 1000, 3), "within_deadline": not pending,
+               "outcomes": outcomes, "pnl": pnl_engine.aggregate()}
+
+
+kill_switch = KillSwitch()
+
+
+# ---- Order Journal ----
+METRIC_HELP['order_journal_commit_seconds'] = 'Write plus fsync time of one order journal group commit'
+METRIC_HELP['order_journal_records_total'] = 'Order journal records committed, by operation'
+METRIC_HELP['order_journal_duplicates_total'] = 'Signal orders not sent because their idempotency tag was already journaled'
+
+ORDER_TAG_PATTERN = re.compile(r"^S(\d{6})G(\d+)(?:R(\d+))?(CE|PE)([0-9D]+)$")
+
+
+def order_intent_tag(day, generation, signal_name):
+    """Alphanumeric idempotency tag of a signal order, e.g. S261019G0CE24200 or S261019G0R2CE24200 for rule 2"""
+    option_type, kind, strike = signal_name.split("_", 2)
+    rule = kind[len("RULE"):] if kind.startswith("RULE") else ""
+    return f"S{day:%y%m%d}G{generation}{'R' + rule if rule else ''}{option_type}{strike.replace('.', 'D')}"
+
+
+def parse_order_intent_tag(tag):
+    """(day, generation, signal_name) encoded in an order tag, or None for other tags"""
+    match = ORDER_TAG_PATTERN.match(tag or "")
+    if match is None:
+        return None
+    day, generation, rule, option_type, strike = match.groups()
+    kind = f"RULE{rule}" if rule else "OFFSET"
+    return (datetime.strptime(day, "%y%m%d").date(), int(generation),
+            f"{option_type}_{kind}_{strike.replace('D', '.')}")
+
+
+def signal_label(signal_name):
+    """Kind of a signal as shown on the dashboard, e.g. Offset Strike or Rule 2"""
+    kind = signal_name.split("_", 2)[1]
+    return "Offset Strike" if kind == "OFFSET" else f"Rule {kind[len('RULE'):]}"
+
+
+class OrderJournal:
+    """Write-ahead journal of signal order intents.
+
+    Every signal order is journaled under a tag derived from (day, baseline
+    generation, signal) before it is sent, and a tag already in the journal
+    is never sent again, so a restart cannot repeat an order even if the
+    state checkpoint missed the signal. A writer thread commits everything
+    queued within the commit window with one write and one fsync, and
+    `begin` returns only once its intent is on disk. The tag is also sent
+    as the orderTag, so `replay_orderbook` can match intents against the
+    broker's orderbook after a restart or a new login.
+    """
+
+    def __init__(self, path=ORDER_JOURNAL_FILE, commit_window=ORDER_JOURNAL_COMMIT_WINDOW):
+        self.path = path
+        self.commit_window = commit_window
+        self.intents = {}      # (username, tag) -> intent record, today only
+        self.generations = {}  # username -> baseline generation for today
+        self.in_flight = set()  # (username, tag) begun by this process and not yet recorded as sent
+        self.day = None
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def _roll_day(self):
+        today = trading_calendar.now().date()
+        if self.day != today:
+            self.day = today
+            self.intents.clear()
+            self.generations.clear()
+        return today
+
+    def _append(self, record):
+        # Callers hold self.lock
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put(record)
+
+    def load(self):
+        """Rebuild today's intents from the journal file and compact it to today's records"""
+        today = self._roll_day()
+        if not os.path.exists(self.path):
+            return
+        kept = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn final line from a crash mid-write
+                if record.get("day") != today.isoformat():
+                    continue
+                kept.append(line if line.endswith('\n') else line + '\n')
+                self._apply(record)
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            f.writelines(kept)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+        log_event(logging.INFO, "Order journal loaded", stage="journal", intents=len(self.intents))
+
+    def _apply(self, record):
+        key = (record["user"], record.get("tag"))
+        op = record["op"]
+        if op == "intent":
+            self.intents[key] = record
+        elif op == "sent" and key in self.intents:
+            self.intents[key] = dict(self.intents[key], order_id=record.get("order_id"), ok=record.get("ok"))
+        elif op == "void":
+            self.intents.pop(key, None)
+        elif op == "reset":
+            self.generations[record["user"]] = record["generation"]
+
+    def _record(self, op, username, **fields):
+        record = dict(op=op, user=username, day=self.day.isoformat(), ts=time.time(), **fields)
+        self._apply(record)
+        self._append(record)
+        return record
+
+    def begin(self, username, signal_name, data):
+        """Journal the intent of a signal order and return its tag once committed, or None if it was already journaled"""
+        with self.lock:
+            today = self._roll_day()
+            tag = order_intent_tag(today, self.generations.get(username, 0), signal_name)
+            if (username, tag) in self.intents:
+                increment_counter('order_journal_duplicates_total')
+                return None
+            self._record("intent", username, tag=tag, signal=signal_name, symbol=data["symbol"],
+                         side=data["side"], qty=data["qty"], price=data["limitPrice"])
+            self.in_flight.add((username, tag))
+        if not self.sync():
+            log_event(logging.ERROR, "Order journal commit timed out; sending anyway", user=username,
+                      stage="journal", tag=tag)
+        return tag
+
+    def record_sent(self, username, tag, response):
+        ok = isinstance(response, dict) and response.get("s") == "ok"
+        with self.lock:
+            self.in_flight.discard((username, tag))
+            self._record("sent", username, tag=tag, ok=ok, order_id=response.get("id") if ok else None)
+
+    def reset(self, username):
+        """Start a new baseline generation so the user's signals can fire again"""
+        with self.lock:
+            self._roll_day()
+            self._record("reset", username, generation=self.generations.get(username, 0) + 1)
+
+    def replay_orderbook(self, username):
+        """Dedupe today's intents of a restored or newly logged-in user against their orderbook"""
+        state = get_user_state(username)
+        if state.fyers is None:
+            return
+        try:
+            response = broker_call('orderbook', state.fyers.orderbook)
+        except Exception as e:
+            log_event(logging.ERROR, "Order journal replay failed", user=username, stage="journal", error=str(e))
+            return
+        by_tag = {order.get("orderTag"): order for order in (response or {}).get("orderBook") or []}
+
+        adopted, voided, claimed = 0, 0, 0
+        with self.lock:
+            today = self._roll_day()
+            generation = self.generations.get(username, 0)
+            for tag, order in by_tag.items():
+                parsed = parse_order_intent_tag(tag)
+                if parsed is None or parsed[0] != today or (username, tag) in self.intents:
+                    continue
+                # Sent before the crash, but the intent never reached the disk
+                self._record("intent", username, tag=tag, signal=parsed[2], symbol=order.get("symbol"),
+                             side=order.get("side"), qty=order.get("qty"), price=order.get("limitPrice"),
+                             source="orderbook")
+                self._record("sent", username, tag=tag, ok=True, order_id=order.get("id"))
+                adopted += 1
+            signals = []
+            for (user, tag), intent in list(self.intents.items()):
+                if user != username:
+                    continue
+                if not intent.get("ok") and tag not in by_tag and (user, tag) not in self.in_flight:
+                    # Never reached the broker: release the signal
+                    self._record("void", username, tag=tag)
+                    voided += 1
+                elif parse_order_intent_tag(tag)[1] == generation:
+                    signals.append(intent)
+
+        for intent in signals:
+            option_type, _, strike = intent["signal"].split("_", 2)
+            text = f"{strike} {intent.get('price')} {option_type} {signal_label(intent['signal'])}"
+            if state.record_signal(intent["signal"], text):
+                claimed += 1
+        if claimed:
+            mark_state_dirty(username)
+        log_event(logging.INFO, "Order journal replayed", user=username, stage="journal",
+                  adopted=adopted, voided=voided, claimed=claimed)
+
+    def sync(self, timeout=5.0):
+        """Block until everything journaled so far is on disk"""
+        if self.thread is None:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.commit_window
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            records = [item for item in batch if isinstance(item, dict)]
+            start = time.perf_counter()
+            try:
+                if records:
+                    with open(self.path, 'a') as f:
+                        f.write(''.join(json.dumps(record) + '\n' for record in records))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    observe_latency('order_journal_commit_seconds', time.perf_counter() - start)
+                    for record in records:
+                        increment_counter('order_journal_records_total', op=record["op"])
+            except Exception as e:
+                log_event(logging.ERROR, "Order journal commit failed", stage="journal", error=str(e))
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+
+order_journal = OrderJournal()
+atexit.register(order_journal.sync)
+
+
+# ---- P&L Engine ----
+class PositionLeg:
+    """Net position in one symbol and its last mark-to-market"""
+    __slots__ = ('symbol', 'qty', 'avg_price', 'ltp', 'realized', 'mtm')
+
+    def __init__(self, symbol, qty=0, avg_price=0.0, ltp=None, realized=0.0):
+        self.symbol = symbol
+        self.qty = qty
+        self.avg_price = avg_price
+        self.ltp = ltp
+        self.realized = realized
+        self.mtm = 0.0
+
+    def fill(self, qty, price):
+        """Apply a signed fill; return the realized P&L it booked"""
+        realized = 0.0
+        if self.qty and (self.qty > 0) != (qty > 0):
+            closed = min(abs(qty), abs(self.qty))
+            realized = closed * (price - self.avg_price) * (1 if self.qty > 0 else -1)
+            remaining = self.qty + qty
+            if remaining == 0:
+                self.avg_price = 0.0
+            elif (remaining > 0) != (self.qty > 0):
+                self.avg_price = price
+            self.qty = remaining
+        else:
+            held = abs(self.qty)
+            self.avg_price = (self.avg_price * held + price * abs(qty)) / (held + abs(qty))
+            self.qty += qty
+        self.realized += realized
+        return realized
+
+    def mark(self, ltp):
+        """Re-mark at `ltp`; return the change in MTM"""
+        self.ltp = ltp
+        mtm = (ltp - self.avg_price) * self.qty if self.qty else 0.0
+        delta = mtm - self.mtm
+        self.mtm = mtm
+        return delta
+
+    def to_dict(self):
+        return {
+            "symbol": self.symbol,
+            "qty": self.qty,
+            "avg_price": round(self.avg_price, 2),
+            "ltp": self.ltp,
+            "mtm": round(self.mtm, 2),
+            "realized": round(self.realized, 2),
+        }
+
+
+class PnlBook:
+    """Open legs of one user with running unrealized and realized totals"""
+    __slots__ = ('legs', 'unrealized', 'realized', 'updated_at')
+
+    def __init__(self):
+        self.legs = {}  # symbol -> PositionLeg
+        self.unrealized = 0.0
+        self.realized = 0.0
+        self.updated_at = None
+
+
+class PnlEngine:
+    """Server-side mark-to-market of every user's positions.
+
+    Each price update touches only the legs held in that symbol: the MTM
+    change of a leg is added to its user's book and to the aggregate, so
+    the P&L is current after every chain snapshot or quote without calling
+    the broker. Fills are booked as the order store confirms them; `sync`
+    replaces a user's book with the broker's net positions whenever they
+    are fetched.
+    """
+
+    def __init__(self):
+        self.books = {}    # username -> PnlBook
+        self.parked = {}   # (username, "live" or "paper") -> flat PnlBook of the mode not in use
+        self.holders = {}  # symbol -> set(usernames) with a non-zero position
+        self.unrealized = 0.0
+        self.realized = 0.0
+        self.lock = threading.Lock()
+
+    def _book(self, username):
+        book = self.books.get(username)
+        if book is None:
+            book = self.books[username] = PnlBook()
+        return book
+
+    def _track(self, username, leg):
+        exit_engine.on_position(username, leg.symbol, leg.qty, leg.avg_price)
+        holders = self.holders.setdefault(leg.symbol, set())
+        if leg.qty:
+            holders.add(username)
+        else:
+            holders.discard(username)
+            if not holders:
+                del self.holders[leg.symbol]
+
+    def _mark(self, book, leg, ltp):
+        delta = leg.mark(ltp)
+        book.unrealized += delta
+        self.unrealized += delta
+
+    def record_fill(self, username, symbol, qty, price):
+        """Book a signed fill (`qty` > 0 buys) at `price`"""
+        with self.lock:
+            book = self._book(username)
+            leg = book.legs.get(symbol)
+            if leg is None:
+                leg = book.legs[symbol] = PositionLeg(symbol)
+            realized = leg.fill(qty, price)
+            book.realized += realized
+            self.realized += realized
+            self._mark(book, leg, leg.ltp if leg.ltp is not None else price)
+            self._track(username, leg)
+            book.updated_at = time.time()
+
+    def last_price(self, symbol):
+        """Last price seen for a held symbol, or None"""
+        with self.lock:
+            for username in self.holders.get(symbol, ()):
+                return self.books[username].legs[symbol].ltp
+        return None
+
+    def on_prices(self, prices):
+        """Re-mark the legs held in any of the {symbol: ltp} prices"""
+        if not self.holders:
+            return
+        now = time.time()
+        with self.lock:
+            for symbol in self.holders.keys() & prices.keys():
+                ltp = prices[symbol]
+                for username in self.holders[symbol]:
+                    book = self.books[username]
+                    self._mark(book, book.legs[symbol], ltp)
+                    book.updated_at = now
+        exit_engine.on_prices(prices)
+
+    def on_chain(self, options_data):
+        """Re-mark held legs from optionchain rows"""
+        if self.holders:
+            self.on_prices({row["symbol"]: row["ltp"] for row in options_data
+                            if row.get("symbol") in self.holders and row.get("ltp") is not None})
+
+    def sync(self, username, net_positions):
+        """Replace the user's book with the broker's netPositions"""
+        book = PnlBook()
+        for pos in net_positions:
+            symbol = pos.get("symbol")
+            if not symbol:
+                continue
+            leg = PositionLeg(symbol, int(pos.get("netQty", 0)),
+                              float(pos.get("netAvg", pos.get("avgPrice", 0)) or 0),
+                              realized=float(pos.get("realized_profit", 0) or 0))
+            ltp = pos.get("ltp")
+            leg.mark(float(ltp) if ltp is not None else leg.avg_price)
+            book.legs[symbol] = leg
+            book.unrealized += leg.mtm
+            book.realized += leg.realized
+        book.updated_at = time.time()
+
+        with self.lock:
+            old = self.books.get(username)
+            if old is not None:
+                self.unrealized -= old.unrealized
+                self.realized -= old.realized
+                for symbol in old.legs:
+                    holders = self.holders.get(symbol)
+                    if holders is not None:
+                        holders.discard(username)
+                        if not holders:
+                            del self.holders[symbol]
+            self.books[username] = book
+            self.unrealized += book.unrealized
+            self.realized += book.realized
+            for leg in book.legs.values():
+                if leg.qty:
+                    self.holders.setdefault(leg.symbol, set()).add(username)
+            for symbol in set(old.legs if old is not None else ()) - book.legs.keys():
+                exit_engine.on_position(username, symbol, 0, 0.0)
+            for leg in book.legs.values():
+                exit_engine.on_position(username, leg.symbol, leg.qty, leg.avg_price)
+
+    def swap_book(self, username, mode):
+        """Park the user's flat book and bring back the one kept for `mode`, so paper and live P&L never mix"""
+        with self.lock:
+            current = self.books.pop(username, None)
+            if current is not None:
+                self.unrealized -= current.unrealized
+                self.realized -= current.realized
+                self.parked[(username, "live" if mode == "paper" else "paper")] = current
+            book = self.parked.pop((username, mode), None)
+            if book is not None:
+                self.books[username] = book
+                self.unrealized += book.unrealized
+                self.realized += book.realized
+
+    def discard(self, username):
+        """Forget the user's books, live and parked"""
+        with self.lock:
+            self.parked.pop((username, "live"), None)
+            self.parked.pop((username, "paper"), None)
+            book = self.books.pop(username, None)
+            if book is None:
+                return
+            self.unrealized -= book.unrealized
+            self.realized -= book.realized
+            for symbol in book.legs:
+                holders = self.holders.get(symbol)
+                if holders is not None:
+                    holders.discard(username)
+                    if not holders:
+                        del self.holders[symbol]
+
+    def open_legs(self, username):
+        """[(symbol, qty, avg_price)] of the user's non-zero legs"""
+        with self.lock:
+            book = self.books.get(username)
+            return [(leg.symbol, leg.qty, leg.avg_price) for leg in book.legs.values() if leg.qty] if book else []
+
+    def symbols(self, username):
+        """Symbols the user currently holds"""
+        book = self.books.get(username)
+        return {symbol for symbol, leg in list(book.legs.items()) if leg.qty} if book else set()
+
+    def snapshot(self, username):
+        with self.lock:
+            book = self.books.get(username)
+            if book is None:
+                return {"legs": [], "unrealized": 0.0, "realized": 0.0, "total": 0.0, "updated_at": None}
+            return {
+                "legs": [leg.to_dict() for leg in book.legs.values()],
+                "unrealized": round(book.unrealized, 2),
+                "realized": round(book.realized, 2),
+                "total": round(book.unrealized + book.realized, 2),
+                "updated_at": book.updated_at,
+            }
+
+    def aggregate(self):
+        """P&L summed over every user"""
+        with self.lock:
+            return {
+                "users": len(self.books),
+                "open_symbols": len(self.holders),
+                "unrealized": round(self.unrealized, 2),
+                "realized": round(self.realized, 2),
+                "total": round(self.unrealized + self.realized, 2),
+            }
+
+
+pnl_engine = PnlEngine()
+
+
+# ---- Exit Rules ----
+EXIT_RULE_FIELDS = ('sl_points', 'sl_pct', 'target_points', 'target_pct', 'trail_points', 'trail_pct', 'square_off')
+
+
+def parse_exit_rules(values, current):
+    """Validated copy of `current` updated from request values; raises ValueError on bad input"""
+    config = dict(current)
+    for field in EXIT_RULE_FIELDS:
+        if field not in values:
+            continue
+        value = values[field]
+        if value is None or str(value).strip() == "":
+            config[field] = None
+        elif field == 'square_off':
+            config[field] = _parse_clock(str(value).strip()).strftime("%H:%M:%S")
+        else:
+            number = float(value)
+            if number <= 0:
+                raise ValueError(f"{field} must be positive")
+            config[field] = number
+    return config
+
+
+class ExitRule:
+    """Exit levels armed for one held leg; prices are real, `side` is +1 long / -1 short"""
+    __slots__ = ('username', 'symbol', 'side', 'qty', 'entry', 'stop', 'target', 'trail_points',
+                 'trail_pct', 'peak', 'trailed', 'square_off_at', 'gen')
+
+    def __init__(self, username, symbol, qty, entry, config, peak=None):
+        side = 1 if qty > 0 else -1
+        self.username = username
+        self.symbol = symbol
+        self.side = side
+        self.qty = abs(qty)
+        self.entry = entry
+        self.trail_points = config.get('trail_points')
+        self.trail_pct = config.get('trail_pct')
+        self.peak = entry if peak is None else self.best(peak, entry)
+        self.trailed = False
+        self.gen = 0
+
+        stops = []
+        if config.get('sl_points'):
+            stops.append(entry - side * config['sl_points'])
+        if config.get('sl_pct'):
+            stops.append(entry * (1 - side * config['sl_pct'] / 100))
+        trail = self.trail_stop(self.peak)
+        if trail is not None:
+            stops.append(trail)
+        self.stop = max(stops, key=self.signed) if stops else None
+
+        targets = []
+        if config.get('target_points'):
+            targets.append(entry + side * config['target_points'])
+        if config.get('target_pct'):
+            targets.append(entry * (1 + side * config['target_pct'] / 100))
+        self.target = min(targets, key=self.signed) if targets else None
+
+        self.square_off_at = None
+        if config.get('square_off'):
+            self.square_off_at = datetime.combine(trading_calendar.now().date(), _parse_clock(config['square_off']),
+                                                  MARKET_TIMEZONE).timestamp()
+
+    def signed(self, price):
+        """Price in the leg's favourable direction: higher is always better"""
+        return self.side * price
+
+    def best(self, a, b):
+        return a if self.signed(a) >= self.signed(b) else b
+
+    def trail_stop(self, peak):
+        """Trailing stop for the best price seen, or None without a trail"""
+        candidates = []
+        if self.trail_points:
+            candidates.append(peak - self.side * self.trail_points)
+        if self.trail_pct:
+            candidates.append(peak * (1 - self.side * self.trail_pct / 100))
+        return max(candidates, key=self.signed) if candidates else None
+
+    @property
+    def enabled(self):
+        return self.stop is not None or self.target is not None or self.square_off_at is not None
+
+    def to_dict(self):
+        return {
+            "symbol": self.symbol,
+            "side": self.side,
+            "qty": self.qty,
+            "entry": round(self.entry, 2),
+            "stop": None if self.stop is None else round(self.stop, 2),
+            "target": None if self.target is None else round(self.target, 2),
+            "peak": round(self.peak, 2),
+            "trailing": bool(self.trail_points or self.trail_pct),
+            "square_off_at": None if self.square_off_at is None
+            else datetime.fromtimestamp(self.square_off_at, MARKET_TIMEZONE).isoformat(),
+        }
+
+
+class ExitRuleEngine:
+    """Stop-loss, target, trailing-stop and time square-off exits for every held leg.
+
+    Rules are indexed per symbol and side in three heaps of "signed" prices
+    (higher is better for the leg): stops as a max-heap, targets and trail
+    peaks as min-heaps. A tick only pops the entries it crosses, so a price
+    that triggers nothing costs a few comparisons however many rules are
+    armed. Heap entries carry the rule's arm generation and are dropped
+    lazily once the rule is re-armed, fired or removed. Square-offs sit in a
+    deadline heap served by their own thread. Fired exits go through
+    `exit_position` on a small pool and are appended to EXIT_TRIGGER_LOG.
+    A failed exit re-arms the leg's rule after a cooldown that doubles with
+    every failure, up to EXIT_RETRY_LIMIT times, so one rejected order does
+    not leave the leg unprotected.
+    """
+
+    def __init__(self, log_file=EXIT_TRIGGER_LOG, workers=EXIT_WORKERS):
+        self.log_file = log_file
+        self.rules = {}        # (username, symbol) -> ExitRule
+        self.index = {}        # symbol -> {side: (stops, targets, peaks)}
+        self.square_offs = []  # heap of (timestamp, gen, key)
+        self.cooldown = {}     # key -> time before which the leg is not re-armed
+        self.triggers = {}     # username -> recent trigger records
+        self.failures = {}     # key -> consecutive failed exits
+        self.gen = 0
+        self.cond = threading.Condition()
+        self.thread = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="exit")
+        self.log_lock = threading.Lock()
+
+    # -- arming --
+    def _valid(self, key, gen):
+        rule = self.rules.get(key)
+        return rule if rule is not None and rule.gen == gen else None
+
+    def _push(self, rule):
+        key = (rule.username, rule.symbol)
+        stops, targets, peaks = self.index.setdefault(rule.symbol, {}).setdefault(rule.side, ([], [], []))
+        if rule.stop is not None:
+            heapq.heappush(stops, (-rule.signed(rule.stop), rule.gen, key))
+        if rule.target is not None:
+            heapq.heappush(targets, (rule.signed(rule.target), rule.gen, key))
+        if rule.trail_points or rule.trail_pct:
+            heapq.heappush(peaks, (rule.signed(rule.peak), rule.gen, key))
+        if rule.square_off_at is not None:
+            heapq.heappush(self.square_offs, (rule.square_off_at, rule.gen, key))
+            self.cond.notify()
+
+    def on_position(self, username, symbol, qty, avg_price, rearm=False):
+        """Arm, re-arm or remove the rule of a leg after its position changed"""
+        key = (username, symbol)
+        fired = []
+        with self.cond:
+            old = self.rules.get(key)
+            if not qty:
+                self.rules.pop(key, None)
+                return
+            if old is not None and not rearm and old.qty == abs(qty) and old.side == (1 if qty > 0 else -1):
+                return
+            if self.cooldown.get(key, 0) > time.time():
+                return
+            state = user_sessions.get(username)
+            config = state.exit_rules if state is not None else {}
+            rule = ExitRule(username, symbol, qty, avg_price, config,
+                            peak=old.peak if old is not None and old.side == (1 if qty > 0 else -1) else None)
+            if not rule.enabled:
+                self.rules.pop(key, None)
+                return
+            self.gen += 1
+            rule.gen = self.gen
+            self.rules[key] = rule
+            self._push(rule)
+            if self.thread is None and rule.square_off_at is not None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if rule.square_off_at is not None and rule.square_off_at <= time.time():
+                fired.append(self._fire(rule, "square_off", None))
+        self._dispatch(fired)
+
+    def rearm_user(self, username):
+        """Rebuild the user's rules from their open legs, e.g. after the config changed"""
+        legs = pnl_engine.open_legs(username)
+        held = {symbol for symbol, _, _ in legs}
+        with self.cond:
+            for key in [key for key in self.rules if key[0] == username and key[1] not in held]:
+                del self.rules[key]
+        for symbol, qty, avg_price in legs:
+            self.on_position(username, symbol, qty, avg_price, rearm=True)
+
+    # -- evaluation --
+    def _fire(self, rule, reason, ltp):
+        """Remove a triggered rule and return its trigger record (caller holds the lock)"""
+        key = (rule.username, rule.symbol)
+        del self.rules[key]
+        self.cooldown[key] = time.time() + EXIT_RETRIGGER_COOLDOWN
+        level = {"stop_loss": rule.stop, "trailing_stop": rule.stop, "target": rule.target}.get(reason)
+        record = {
+            "ts": datetime.now(MARKET_TIMEZONE).isoformat(timespec="milliseconds"),
+            "user": rule.username,
+            "symbol": rule.symbol,
+            "side": rule.side,
+            "qty": rule.qty,
+            "reason": reason,
+            "entry": rule.entry,
+            "level": level,
+            "ltp": ltp,
+            "peak": rule.peak,
+            "outcome": "pending",
+        }
+        self.triggers.setdefault(rule.username, deque(maxlen=100)).append(record)
+        return record
+
+    def on_prices(self, prices):
+        """Check the armed rules of every symbol in {symbol: ltp}"""
+        if not self.index:
+            return
+        fired = []
+        with self.cond:
+            for symbol in self.index.keys() & prices.keys():
+                ltp = prices[symbol]
+                for side, (stops, targets, peaks) in list(self.index[symbol].items()):
+                    price = side * ltp
+                    while peaks and peaks[0][0] < price:
+                        _, gen, key = heapq.heappop(peaks)
+                        rule = self._valid(key, gen)
+                        if rule is None:
+                            continue
+                        rule.peak = ltp
+                        stop = rule.trail_stop(ltp)
+                        if rule.stop is None or rule.signed(stop) > rule.signed(rule.stop):
+                            rule.stop = stop
+                            rule.trailed = True
+                            heapq.heappush(stops, (-rule.signed(stop), gen, key))
+                        heapq.heappush(peaks, (price, gen, key))
+                    while stops and -stops[0][0] >= price:
+                        level, gen, key = heapq.heappop(stops)
+                        rule = self._valid(key, gen)
+                        if rule is not None and -level == rule.signed(rule.stop):
+                            fired.append(self._fire(rule, "trailing_stop" if rule.trailed else "stop_loss", ltp))
+                    while targets and targets[0][0] <= price:
+                        _, gen, key = heapq.heappop(targets)
+                        rule = self._valid(key, gen)
+                        if rule is not None:
+                            fired.append(self._fire(rule, "target", ltp))
+                    if len(stops) > 2 * len(peaks) + 64:
+                        stops[:] = [e for e in stops if self._valid(e[2], e[1])]
+                        heapq.heapify(stops)
+                    if not (stops or targets or peaks):
+                        del self.index[symbol][side]
+                if not self.index[symbol]:
+                    del self.index[symbol]
+        self._dispatch(fired)
+
+    def run(self):
+        """Fire time square-offs as they come due"""
+        while True:
+            fired = []
+            with self.cond:
+                while not self.square_offs or self.square_offs[0][0] > time.time():
+                    self.cond.wait(self.square_offs[0][0] - time.time() if self.square_offs else None)
+                now = time.time()
+                while self.square_offs and self.square_offs[0][0] <= now:
+                    _, gen, key = heapq.heappop(self.square_offs)
+                    rule = self._valid(key, gen)
+                    if rule is not None:
+                        fired.append(self._fire(rule, "square_off", None))
+            self._dispatch(fired)
+
+    # -- execution --
+    def _dispatch(self, fired):
+        for record in fired:
+            log_event(logging.WARNING, "Exit rule triggered", user=record["user"], symbol=record["symbol"],
+                      stage="exit", reason=record["reason"], ltp=record["ltp"], trigger_level=record["level"])
+            self.executor.submit(self._execute, record)
+
+    def _execute(self, record):
+        start = time.perf_counter()
+        if record["ltp"] is None:
+            record["ltp"] = pnl_engine.last_price(record["symbol"])
+        try:
+            result = exit_position(record["user"], record["symbol"], record["qty"], -record["side"])
+        except Exception as e:
+            result = {"error": str(e)}
+        ok = "error" not in result and (result.get("response") or {}).get("s") == "ok"
+        record["result"] = result
+        record["outcome"] = "ok" if ok else "error"
+        record["exit_latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        if not ok:
+            self._retry_later(record)
+        else:
+            with self.cond:
+                self.failures.pop((record["user"], record["symbol"]), None)
+        with self.log_lock:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def _retry_later(self, record):
+        """Schedule the re-arm of a leg whose exit failed, with a doubling cooldown"""
+        key = (record["user"], record["symbol"])
+        with self.cond:
+            failures = self.failures[key] = self.failures.get(key, 0) + 1
+            if failures > EXIT_RETRY_LIMIT:
+                record["retry_in"] = None
+                self.failures.pop(key, None)
+            else:
+                delay = EXIT_RETRIGGER_COOLDOWN * 2 ** (failures - 1)
+                self.cooldown[key] = time.time() + delay
+                record["retry_in"] = delay
+        if record["retry_in"] is None:
+            log_event(logging.CRITICAL, "Exit failed; retries exhausted, leg left without exit rules",
+                      user=key[0], symbol=key[1], stage="exit", failures=failures, result=record["result"])
+            return
+        log_event(logging.ERROR, "Exit failed; re-arming after cooldown", user=key[0], symbol=key[1],
+                  stage="exit", failures=failures, retry_in=record["retry_in"], result=record["result"])
+        timer = threading.Timer(record["retry_in"], self._rearm_failed, (key,))
+        timer.daemon = True
+        timer.start()
+
+    def _rearm_failed(self, key):
+        username, symbol = key
+        with self.cond:
+            self.cooldown.pop(key, None)
+        for leg_symbol, qty, avg_price in pnl_engine.open_legs(username):
+            if leg_symbol == symbol:
+                self.on_position(username, symbol, qty, avg_price, rearm=True)
+                return
+        with self.cond:
+            self.failures.pop(key, None)
+
+    def discard(self, username):
+        """Disarm every rule of the user; their heap entries are dropped lazily"""
+        with self.cond:
+            for key in [key for key in self.rules if key[0] == username]:
+                del self.rules[key]
+            for table in (self.cooldown, self.failures):
+                for key in [key for key in table if key[0] == username]:
+                    del table[key]
+            self.triggers.pop(username, None)
+
+    def describe(self, username):
+        with self.cond:
+            return {
+                "armed": [rule.to_dict() for key, rule in self.rules.items() if key[0] == username],
+                "triggers": list(self.triggers.get(username, ())),
+            }
+
+
+exit_engine = ExitRuleEngine()
+
+
+# ---- Order Chasing ----
+METRIC_HELP['order_time_to_fill_seconds'] = 'Time from order acceptance to a complete fill, by how it filled (limit or market)'
+METRIC_HELP['order_chase_actions_total'] = 'Order chaser actions (modify, market, cancel) and terminal outcomes'
+
+# Fyers order status codes
+ORDER_STATUS_CANCELLED = 1
+ORDER_STATUS_FILLED = 2
+ORDER_STATUS_REJECTED = 5
+ORDER_STATUS_EXPIRED = 7
+ORDER_STATUS_FINAL = {ORDER_STATUS_CANCELLED: "cancelled", ORDER_STATUS_FILLED: "filled",
+                      ORDER_STATUS_REJECTED: "rejected", ORDER_STATUS_EXPIRED: "expired"}
+
+
+def round_to_tick(price, tick=OPTION_TICK_SIZE):
+    return round(round(price / tick) * tick, 2)
+
+
+class ChasedOrder:
+    """A working signal order followed by the chaser"""
+    __slots__ = ('username', 'fyers', 'order_id', 'symbol', 'side', 'qty', 'signal_price', 'limit',
+                 'filled_qty', 'started', 'converted', 'due', 'running')
+
+    def __init__(self, username, fyers, order_id, data):
+        self.username = username
+        self.fyers = fyers
+        self.order_id = order_id
+        self.symbol = data["symbol"]
+        self.side = data["side"]
+        self.qty = data["qty"]
+        self.signal_price = data["limitPrice"]
+        self.limit = data["limitPrice"]
+        self.filled_qty = 0
+        self.started = time.perf_counter()
+        self.converted = False
+        self.due = None
+        self.running = False
+
+    def slippage_bound(self, max_slippage_pct):
+        """Worst price the order may pay, ORDER_CHASE_MAX_SLIPPAGE_PCT beyond the signal price"""
+        return self.signal_price * (1 + self.side * max_slippage_pct / 100)
+
+
+class OrderChaser:
+    """Walks unfilled signal LIMIT orders toward the market until they fill.
+
+    Every `interval` each working order's status is checked; fills are booked
+    into the P&L engine at the traded price, and an open order is modified to
+    the current market price (never past the slippage bound). After `timeout`
+    it is converted to MARKET if the market is still within the bound, and
+    cancelled otherwise. One scheduler thread keeps a heap of due orders and
+    hands each step to a small pool so a slow broker call delays only its
+    own order. While the user's order stream is live the status comes from
+    `order_store`, and every update for a chased order wakes it at once.
+    """
+
+    def __init__(self, interval=ORDER_CHASE_INTERVAL, timeout=ORDER_CHASE_TIMEOUT,
+                 max_slippage_pct=ORDER_CHASE_MAX_SLIPPAGE_PCT, workers=ORDER_CHASE_WORKERS):
+        self.interval = interval
+        self.timeout = timeout
+        self.max_slippage_pct = max_slippage_pct
+        self.orders = {}  # order_id -> ChasedOrder
+        self.heap = []    # (due perf_counter, order_id)
+        self.cond = threading.Condition()
+        self.thread = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chase")
+
+    def track(self, username, fyers, order_id, data):
+        """Start chasing an accepted LIMIT order; False when chasing is off or the order cannot be tracked"""
+        if self.interval <= 0 or not order_id or data.get("type") != 1:
+            return False
+        order = ChasedOrder(username, fyers, order_id, data)
+        with self.cond:
+            self.orders[order_id] = order
+            order.due = time.perf_counter() + self.interval
+            heapq.heappush(self.heap, (order.due, order_id))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return True
+
+    def wake(self, order_id):
+        """Step a chased order now, e.g. because an update for it arrived"""
+        with self.cond:
+            order = self.orders.get(order_id)
+            if order is None or order.running:
+                return
+            order.due = time.perf_counter()
+            heapq.heappush(self.heap, (order.due, order_id))
+            self.cond.notify()
+
+    def cancel_user(self, username):
+        """Cancel and stop chasing every working order of the user; returns how many were cancelled"""
+        with self.cond:
+            orders = [order for order in self.orders.values() if order.username == username]
+            for order in orders:
+                self.orders.pop(order.order_id, None)
+        cancelled = 0
+        for order in orders:
+            try:
+                broker_call('cancel_order', order.fyers.cancel_order, data={"id": order.order_id})
+                increment_counter('order_chase_actions_total', action="cancel")
+                cancelled += 1
+            except Exception as e:
+                log_event(logging.ERROR, "Cancel of chased order failed", user=username, symbol=order.symbol,
+                          stage="chase", order_id=order.order_id, error=str(e))
+        return cancelled
+
+    def discard(self, username):
+        """Stop chasing the user's orders without touching them at the broker"""
+        with self.cond:
+            for order_id in [order_id for order_id, order in self.orders.items() if order.username == username]:
+                del self.orders[order_id]
+
+    def working(self, username):
+        with self.cond:
+            return [{"id": o.order_id, "symbol": o.symbol, "side": o.side, "qty": o.qty, "limit": o.limit,
+                     "signal_price": o.signal_price, "filled_qty": o.filled_qty, "market": o.converted,
+                     "age_seconds": round(time.perf_counter() - o.started, 3)}
+                    for o in self.orders.values() if o.username == username]
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.perf_counter():
+                    self.cond.wait(self.heap[0][0] - time.perf_counter() if self.heap else None)
+                now = time.perf_counter()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due_at, order_id = heapq.heappop(self.heap)
+                    order = self.orders.get(order_id)
+                    if order is not None and not order.running and order.due == due_at:
+                        order.running = True
+                        due.append(order)
+            for order in due:
+                self.executor.submit(self._step, order)
+
+    def _step(self, order):
+        try:
+            done = self._advance(order)
+        except Exception as e:
+            log_event(logging.ERROR, "Order chase error", user=order.username, symbol=order.symbol,
+                      stage="chase", order_id=order.order_id, error=str(e))
+            done = False
+        with self.cond:
+            order.running = False
+            if done:
+                self.orders.pop(order.order_id, None)
+            else:
+                order.due = time.perf_counter() + self.interval
+                heapq.heappush(self.heap, (order.due, order.order_id))
+                self.cond.notify()
+
+    def order_status(self, order):
+        """Latest state of the order: from the live order stream, else polled from the orderbook"""
+        if order_stream.is_live(order.username):
+            return order_store.get(order.username, order.order_id)
+        response = broker_call('orderbook', order.fyers.orderbook, data={"id": order.order_id})
+        for item in (response or {}).get("orderBook") or []:
+            if str(item.get("id")) == str(order.order_id):
+                order_store.apply_order(order.username, item, source="poll")
+                return item
+        return None
+
+    def market_price(self, order):
+        ltp = quote_batcher.fresh_ltp(order.symbol)
+        if ltp is not None:
+            return ltp
+        response = broker_call('quotes', order.fyers.quotes, data={"symbols": order.symbol})
+        for item in (response or {}).get("d") or []:
+            ltp = (item.get("v") or {}).get("lp")
+            if item.get("s") == "ok" and ltp is not None:
+                return float(ltp)
+        return None
+
+    def _advance(self, order):
+        """One chase step; True once the order reached a final state"""
+        status = self.order_status(order)
+        elapsed = time.perf_counter() - order.started
+        if status is not None:
+            # The order store books the fills into the P&L as it merges the update
+            order.filled_qty = max(order.filled_qty, int(status.get("filledQty") or 0))
+            outcome = ORDER_STATUS_FINAL.get(status.get("status"))
+            if outcome is not None:
+                increment_counter('order_chase_actions_total', action=outcome)
+                if outcome == "filled":
+                    observe_latency('order_time_to_fill_seconds', elapsed,
+                                    outcome="market" if order.converted else "limit")
+                log_event(logging.INFO, f"Chased order {outcome}", user=order.username, symbol=order.symbol,
+                          stage="chase", order_id=order.order_id, limit=order.limit,
+                          filled_qty=order.filled_qty, latency_ms=elapsed * 1000)
+                return True
+
+        if order.converted:
+            if elapsed > 3 * self.timeout:
+                log_event(logging.WARNING, "Market order still unconfirmed - no longer chasing", user=order.username,
+                          symbol=order.symbol, stage="chase", order_id=order.order_id)
+                return True
+            return False
+
+        market = self.market_price(order)
+        bound = order.slippage_bound(self.max_slippage_pct)
+        if elapsed >= self.timeout:
+            if market is not None and order.side * (market - bound) <= 0:
+                broker_call('modify_order', order.fyers.modify_order, data={"id": order.order_id, "type": 2})
+                order.converted = True
+                increment_counter('order_chase_actions_total', action="market")
+                log_event(logging.INFO, "Chased order converted to market", user=order.username, symbol=order.symbol,
+                          stage="chase", order_id=order.order_id, ltp=market)
+                return False
+            broker_call('cancel_order', order.fyers.cancel_order, data={"id": order.order_id})
+            increment_counter('order_chase_actions_total', action="cancel")
+            log_event(logging.WARNING, "Chased order cancelled - market beyond slippage bound", user=order.username,
+                      symbol=order.symbol, stage="chase", order_id=order.order_id, ltp=market, bound=round(bound, 2))
+            return True
+
+        if market is None:
+            return False
+        target = round_to_tick(min(market, bound, key=lambda p: order.side * p))
+        if order.side * (target - order.limit) >= OPTION_TICK_SIZE / 2:
+            broker_call('modify_order', order.fyers.modify_order,
+                        data={"id": order.order_id, "type": 1, "limitPrice": target})
+            increment_counter('order_chase_actions_total', action="modify")
+            log_event(logging.DEBUG, "Chased order repriced", user=order.username, symbol=order.symbol,
+                      stage="chase", order_id=order.order_id, old_limit=order.limit, limit=target)
+            order.limit = target
+        return False
+
+
+order_chaser = OrderChaser()
+
+
+# ---- Order Updates ----
+METRIC_HELP['order_fill_confirm_seconds'] = 'Time from order submission until the app sees it filled, by update source'
+METRIC_HELP['order_updates_total'] = 'Order and trade updates that changed the in-memory order state, by source'
+
+
+class LocalOrderSocket:
+    """In-process stand-in for the Fyers order websocket.
+
+    Takes the same constructor callbacks and offers the same connect /
+    subscribe / close_connection calls as order_ws.FyersOrderSocket. Updates
+    are injected with `push_order` and `push_trade`, so the order update path
+    runs without a broker connection (ORDER_STREAM_MODE=local).
+    """
+    instances = {}  # access_token -> socket
+
+    def __init__(self, access_token, on_connect=None, on_close=None, on_error=None,
+                 on_orders=None, on_trades=None, on_positions=None, **kwargs):
+        self.access_token = access_token
+        self.on_connect = on_connect
+        self.on_close = on_close
+        self.on_error = on_error
+        self.on_orders = on_orders
+        self.on_trades = on_trades
+        self.on_positions = on_positions
+        self.data_types = set()
+        self.connected = False
+
+    def connect(self):
+        LocalOrderSocket.instances[self.access_token] = self
+        self.connected = True
+        if self.on_connect:
+            self.on_connect()
+
+    def subscribe(self, data_type):
+        self.data_types.update(data_type.split(","))
+
+    def keep_running(self):
+        pass
+
+    def is_connected(self):
+        return self.connected
+
+    def close_connection(self):
+        LocalOrderSocket.instances.pop(self.access_token, None)
+        self.connected = False
+        if self.on_close:
+            self.on_close({"code": 1000, "message": "closed"})
+
+    def push_order(self, order):
+        if self.connected and "OnOrders" in self.data_types and self.on_orders:
+            self.on_orders({"s": "ok", "orders": order})
+
+    def push_trade(self, trade):
+        if self.connected and "OnTrades" in self.data_types and self.on_trades:
+            self.on_trades({"s": "ok", "trades": trade})
+
+
+class OrderStore:
+    """Live order and fill state per user, fed by the order stream, chaser polls and reconciliation"""
+    TRACKED_FIELDS = ('status', 'filledQty', 'tradedPrice', 'limitPrice', 'type', 'qty')
+
+    def __init__(self, fill_poll_interval=ORDER_FILL_POLL_INTERVAL):
+        self.orders = {}   # username -> {order_id: latest order dict}
+        self.trades = {}   # username -> {trade number: trade dict}
+        self.sent_at = {}  # order_id -> perf_counter when it was submitted
+        self.fills = {}    # order_id -> [username, symbol, side, qty booked] of our orders still working
+        self.fill_poll_interval = fill_poll_interval
+        self.fill_thread = None
+        self.lock = threading.Lock()
+
+    def expect(self, order_id, username=None, data=None):
+        """Note the submit time of an order so its fill confirmation latency can be measured.
+
+        With the username and order data, the order's fills are booked into
+        `pnl_engine` as updates confirm them, whatever their source.
+        """
+        if not order_id:
+            return
+        order_id = str(order_id)
+        booked = None
+        with self.lock:
+            self.sent_at[order_id] = time.perf_counter()
+            if username is not None:
+                self.fills[order_id] = [username, data["symbol"], int(data["side"]), 0]
+                # The stream may have reported the order before the place_order reply came back
+                order = self.orders.get(username, {}).get(order_id)
+                if order is not None:
+                    booked = self._fill_delta(order_id, order)
+                if self.fill_thread is None and self.fill_poll_interval > 0:
+                    self.fill_thread = threading.Thread(target=self._poll_fills, daemon=True)
+                    self.fill_thread.start()
+        if booked is not None:
+            pnl_engine.record_fill(*booked)
+
+    def _fill_delta(self, order_id, order):
+        """(username, symbol, signed qty, price) newly filled on a booked order, or None (caller holds the lock)"""
+        fill = self.fills.get(order_id)
+        if fill is None:
+            return None
+        status = order.get("status")
+        filled = int(order.get("filledQty") or (order.get("qty") if status == ORDER_STATUS_FILLED else 0) or 0)
+        if status in ORDER_STATUS_FINAL:
+            del self.fills[order_id]
+        if filled <= fill[3]:
+            return None
+        price = float(order.get("tradedPrice") or order.get("limitPrice") or 0)
+        booked = (fill[0], fill[1], fill[2] * (filled - fill[3]), price)
+        fill[3] = filled
+        return booked
+
+    def _poll_fills(self):
+        """Poll the orderbook of users with working orders that neither a stream nor the chaser follows"""
+        while True:
+            time.sleep(self.fill_poll_interval)
+            with self.lock:
+                usernames = {fill[0] for order_id, fill in self.fills.items() if order_id not in order_chaser.orders}
+            for username in usernames:
+                if not order_stream.is_live(username):
+                    order_stream.reconcile(username)
+
+    def apply_order(self, username, order, source):
+        """Merge an order update; True if it changed anything"""
+        order_id = str(order.get("id") or "")
+        if not order_id:
+            return False
+        with self.lock:
+            orders = self.orders.setdefault(username, {})
+            old = orders.get(order_id)
+            if old is not None and all(old.get(k) == order.get(k, old.get(k)) for k in self.TRACKED_FIELDS):
+                return False
+            merged = orders[order_id] = dict(old or {}, **order)
+            sent_at = self.sent_at.pop(order_id, None) if order.get("status") in ORDER_STATUS_FINAL else None
+            booked = self._fill_delta(order_id, merged)
+        if booked is not None:
+            pnl_engine.record_fill(*booked)
+        increment_counter('order_updates_total', kind="order", source=source)
+        if sent_at is not None and order.get("status") == ORDER_STATUS_FILLED:
+            observe_latency('order_fill_confirm_seconds', time.perf_counter() - sent_at, source=source)
+        order_chaser.wake(order_id)
+        return True
+
+    def apply_trade(self, username, trade, source):
+        trade_id = str(trade.get("tradeNumber") or trade.get("id") or "")
+        if not trade_id:
+            return False
+        with self.lock:
+            trades = self.trades.setdefault(username, {})
+            if trade_id in trades:
+                return False
+            trades[trade_id] = dict(trade)
+        increment_counter('order_updates_total', kind="trade", source=source)
+        if trade.get("orderNumber"):
+            order_chaser.wake(str(trade["orderNumber"]))
+        return True
+
+    def get(self, username, order_id):
+        with self.lock:
+            order = self.orders.get(username, {}).get(str(order_id))
+            return dict(order) if order is not None else None
+
+    def snapshot(self, username):
+        with self.lock:
+            return {
+                "orders": [dict(order) for order in self.orders.get(username, {}).values()],
+                "trades": [dict(trade) for trade in self.trades.get(username, {}).values()],
+            }
+
+    def working(self, username):
+        """True while one of the user's orders still awaits fills"""
+        with self.lock:
+            return any(fill[0] == username for fill in self.fills.values())
+
+    def discard(self, username):
+        with self.lock:
+            self.orders.pop(username, None)
+            self.trades.pop(username, None)
+            for order_id in [order_id for order_id, fill in self.fills.items() if fill[0] == username]:
+                del self.fills[order_id]
+
+
+class OrderStream:
+    """Per-user order/trade websocket connections feeding `order_store`.
+
+    The stream is the primary source of order state; every
+    ORDER_RECONCILE_INTERVAL the orderbook of each connected user is merged
+    in as well, which repairs anything missed while a socket was down.
+    """
+
+    def __init__(self, mode=ORDER_STREAM_MODE, reconcile_interval=ORDER_RECONCILE_INTERVAL):
+        self.mode = mode
+        self.reconcile_interval = reconcile_interval
+        self.sockets = {}  # username -> socket
+        self.live = set()  # usernames whose socket is connected
+        self.lock = threading.Lock()
+        self.reconcile_thread = None
+
+    def socket_class(self):
+        if self.mode == "local":
+            return LocalOrderSocket
+        if self.mode == "fyers" and order_ws is not None:
+            return order_ws.FyersOrderSocket
+        return None
+
+    def connect(self, username, token):
+        """(Re)open the user's order stream with a fresh access token"""
+        socket_class = self.socket_class()
+        if socket_class is None or not token:
+            return False
+        self.disconnect(username)
+        client_id = get_user_info(username).get('fyers_client_id')
+        socket = socket_class(
+            access_token=f"{client_id}:{token}",
+            write_to_file=False,
+            log_path="",
+            on_connect=lambda: self._on_connect(username),
+            on_close=lambda message: self._on_down(username, "closed", message),
+            on_error=lambda message: self._on_down(username, "error", message),
+            on_orders=lambda message: self._on_orders(username, message),
+            on_trades=lambda message: self._on_trades(username, message),
+            reconnect=True,
+        )
+        with self.lock:
+            self.sockets[username] = socket
+            if self.reconcile_thread is None and self.reconcile_interval > 0:
+                self.reconcile_thread = threading.Thread(target=self.reconcile_loop, daemon=True)
+                self.reconcile_thread.start()
+        threading.Thread(target=socket.connect, daemon=True).start()
+        return True
+
+    def disconnect(self, username):
+        with self.lock:
+            socket = self.sockets.pop(username, None)
+            self.live.discard(username)
+        if socket is not None:
+            try:
+                socket.close_connection()
+            except Exception as e:
+                log_event(logging.WARNING, "Order stream close failed", user=username, stage="orders", error=str(e))
+        order_store.discard(username)
+
+    def is_live(self, username):
+        return username in self.live
+
+    def _on_connect(self, username):
+        socket = self.sockets.get(username)
+        if socket is None:
+            return
+        socket.subscribe(data_type="OnOrders,OnTrades")
+        self.live.add(username)
+        log_event(logging.INFO, "Order stream connected", user=username, stage="orders")
+        # Catch up on anything that happened before the socket came up
+        threading.Thread(target=self.reconcile, args=(username,), daemon=True).start()
+
+    def _on_down(self, username, reason, message):
+        self.live.discard(username)
+        log_event(logging.WARNING, f"Order stream {reason}", user=username, stage="orders", detail=str(message))
+
+    def _on_orders(self, username, message):
+        order = message.get("orders", message) if isinstance(message, dict) else None
+        if isinstance(order, dict):
+            order_store.apply_order(username, order, source="stream")
+
+    def _on_trades(self, username, message):
+        trade = message.get("trades", message) if isinstance(message, dict) else None
+        if isinstance(trade, dict):
+            order_store.apply_trade(username, trade, source="stream")
+
+    def reconcile(self, username):
+        """Merge the user's orderbook into the order store; returns the number of orders that changed"""
         fyers, _ = get_user_fyers_session(username)
         if fyers is None:
-            print(f"⚠️ {username}: Waiting for login...")
-            time.sleep(5)
+            return 0
+        try:
+            response = broker_call('orderbook', fyers.orderbook)
+        except Exception as e:
+            log_event(logging.ERROR, "Order reconciliation failed", user=username, stage="orders", error=str(e))
+            return 0
+        changed = sum(order_store.apply_order(username, order, source="reconcile")
+                      for order in (response or {}).get("orderBook") or [])
+        if changed and self.is_live(username):
+            log_event(logging.WARNING, "Reconciliation found orders the stream missed", user=username,
+                      stage="orders", changed=changed)
+        return changed
+
+    def reconcile_loop(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            for username in list(self.sockets):
+                self.reconcile(username)
+
+
+order_store = OrderStore()
+order_stream = OrderStream()
+
+
+# ---- Paper Trading ----
+METRIC_HELP['paper_orders_total'] = 'Paper exchange orders by outcome (accepted, filled, cancelled, rejected)'
+
+ORDER_STATUS_PENDING = 6
+
+
+class PaperOrder:
+    """A paper order; `book` is the Fyers-shaped dict returned by the orderbook"""
+    __slots__ = ('username', 'order_id', 'symbol', 'side', 'qty', 'type', 'limit', 'arrives', 'version', 'book')
+
+    def __init__(self, username, order_id, data, arrives):
+        self.username = username
+        self.order_id = order_id
+        self.symbol = data["symbol"]
+        self.side = int(data["side"])
+        self.qty = int(data["qty"])
+        self.type = int(data.get("type", 2))
+        self.limit = float(data.get("limitPrice") or 0)
+        self.arrives = arrives
+        self.version = 0
+        self.book = {
+            "id": order_id, "symbol": self.symbol, "side": self.side, "qty": self.qty, "type": self.type,
+            "limitPrice": self.limit, "status": ORDER_STATUS_PENDING, "filledQty": 0, "tradedPrice": 0,
+            "productType": data.get("productType", "INTRADAY"), "orderTag": data.get("orderTag", ""),
+            "orderDateTime": datetime.now(MARKET_TIMEZONE).strftime("%d-%b-%Y %H:%M:%S"),
+        }
+
+
+class PaperAccount:
+    """Orders and net positions of one virtual account"""
+    __slots__ = ('orders', 'positions')
+
+    def __init__(self):
+        self.orders = {}     # order_id -> PaperOrder
+        self.positions = {}  # symbol -> PositionLeg
+
+
+class PaperExchange:
+    """Local matching simulator behind the paper trading clients.
+
+    Orders reach the book PAPER_LATENCY after they are placed. A market
+    order, or a limit order that is marketable on arrival, fills at the
+    last traded price plus PAPER_SLIPPAGE_TICKS (never past its limit).
+    Other limit orders rest in per-symbol heaps and fill at their limit as
+    soon as a chain snapshot or quote trades through it, so a price update
+    only touches the orders it crosses. Every change is pushed into
+    `order_store`, exactly like an order stream update. Accounts live in
+    memory; thousands share the one book and lock. Positions (not resting
+    orders) are checkpointed with the user's state.
+    """
+
+    def __init__(self, latency=PAPER_LATENCY, slippage_ticks=PAPER_SLIPPAGE_TICKS):
+        self.latency = latency
+        self.slippage_ticks = slippage_ticks
+        self.accounts = {}  # username -> PaperAccount
+        self.prices = {}    # symbol -> last traded price
+        self.bids = {}      # symbol -> heap of (-limit, seq, order_id, version)
+        self.asks = {}      # symbol -> heap of (limit, seq, order_id, version)
+        self.waiting = {}   # symbol -> [order_id] market orders that arrived before any price
+        self.orders = {}    # order_id -> PaperOrder, working orders only
+        self.arrivals = []  # heap of (arrives, seq, order_id)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def client(self, username, data_client=None):
+        return PaperFyers(self, username, data_client)
+
+    def account(self, username):
+        with self.cond:
+            account = self.accounts.get(username)
+            if account is None:
+                account = self.accounts[username] = PaperAccount()
+            return account
+
+    # -- order entry --
+    def place(self, username, data):
+        try:
+            if data.get("type") == 1 and float(data.get("limitPrice") or 0) <= 0:
+                raise ValueError("limit price must be positive")
+            if int(data["qty"]) <= 0 or int(data["side"]) not in (1, -1):
+                raise ValueError("bad quantity or side")
+        except (KeyError, TypeError, ValueError) as e:
+            increment_counter('paper_orders_total', outcome="rejected")
+            return {"s": "error", "code": -50, "message": f"Invalid order: {e}"}
+
+        updates = []
+        with self.cond:
+            self.seq += 1
+            order_id = f"PAPER{self.seq}"
+            order = PaperOrder(username, order_id, data, time.perf_counter() + self.latency)
+            account = self.accounts.get(username)
+            if account is None:
+                account = self.accounts[username] = PaperAccount()
+            account.orders[order_id] = order
+            self.orders[order_id] = order
+            if self.latency > 0:
+                heapq.heappush(self.arrivals, (order.arrives, self.seq, order_id))
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+                self.cond.notify()
+            else:
+                self._arrive(order, updates)
+        increment_counter('paper_orders_total', outcome="accepted")
+        self._publish(updates)
+        return {"s": "ok", "code": 1101, "message": "Paper order submitted", "id": order_id}
+
+    def modify(self, username, data):
+        updates = []
+        with self.cond:
+            order = self.orders.get(str(data.get("id")))
+            if order is None or order.username != username:
+                return {"s": "error", "code": -52, "message": "Order not found or no longer working"}
+            if data.get("type") is not None:
+                order.type = int(data["type"])
+            if data.get("limitPrice") is not None:
+                order.limit = float(data["limitPrice"])
+            order.book.update(type=order.type, limitPrice=order.limit)
+            order.version += 1
+            if order.arrives <= time.perf_counter():
+                self._arrive(order, updates)
+        self._publish(updates)
+        return {"s": "ok", "code": 1102, "message": "Paper order modified", "id": order.order_id}
+
+    def cancel(self, username, data):
+        with self.cond:
+            order = self.orders.get(str(data.get("id")))
+            if order is None or order.username != username:
+                return {"s": "error", "code": -52, "message": "Order not found or no longer working"}
+            self._close(order, ORDER_STATUS_CANCELLED)
+            update = (username, dict(order.book), None)
+        increment_counter('paper_orders_total', outcome="cancelled")
+        self._publish([update])
+        return {"s": "ok", "code": 1103, "message": "Paper order cancelled", "id": order.order_id}
+
+    # -- matching (callers hold self.cond) --
+    def _close(self, order, status):
+        order.book["status"] = status
+        order.version += 1  # invalidates its heap entries
+        self.orders.pop(order.order_id, None)
+
+    def _fill(self, order, price, updates):
+        price = round_to_tick(price)
+        leg = self.accounts[order.username].positions.get(order.symbol)
+        if leg is None:
+            leg = self.accounts[order.username].positions[order.symbol] = PositionLeg(order.symbol)
+        leg.fill(order.side * order.qty, price)
+        leg.mark(self.prices.get(order.symbol, price))
+        order.book.update(filledQty=order.qty, tradedPrice=price)
+        self._close(order, ORDER_STATUS_FILLED)
+        self.seq += 1
+        trade = {"id": f"PT{self.seq}", "tradeNumber": f"PT{self.seq}", "orderNumber": order.order_id,
+                 "symbol": order.symbol, "side": order.side, "tradedQty": order.qty, "tradePrice": price}
+        updates.append((order.username, dict(order.book), trade))
+
+    def _arrive(self, order, updates):
+        """Match an order that just reached the book (or was modified there)"""
+        ltp = self.prices.get(order.symbol)
+        slipped = None if ltp is None else ltp + order.side * self.slippage_ticks * OPTION_TICK_SIZE
+        if order.type == 2:
+            if slipped is None:
+                self.waiting.setdefault(order.symbol, []).append(order.order_id)
+            else:
+                self._fill(order, slipped, updates)
+                increment_counter('paper_orders_total', outcome="filled")
+            return
+        if slipped is not None and order.side * (order.limit - ltp) >= 0:
+            self._fill(order, min(slipped, order.limit, key=lambda p: order.side * p), updates)
+            increment_counter('paper_orders_total', outcome="filled")
+            return
+        self.seq += 1
+        if order.side == 1:
+            heapq.heappush(self.bids.setdefault(order.symbol, []), (-order.limit, self.seq, order.order_id, order.version))
+        else:
+            heapq.heappush(self.asks.setdefault(order.symbol, []), (order.limit, self.seq, order.order_id, order.version))
+        updates.append((order.username, dict(order.book), None))
+
+    def _cross(self, symbol, ltp, updates):
+        """Fill the resting orders of `symbol` that `ltp` trades through"""
+        for book, crosses in ((self.bids, lambda key: -key >= ltp), (self.asks, lambda key: key <= ltp)):
+            heap = book.get(symbol)
+            while heap and crosses(heap[0][0]):
+                _, _, order_id, version = heapq.heappop(heap)
+                order = self.orders.get(order_id)
+                if order is not None and order.version == version:
+                    self._fill(order, order.limit, updates)
+                    increment_counter('paper_orders_total', outcome="filled")
+            if heap is not None and not heap:
+                del book[symbol]
+        for order_id in self.waiting.pop(symbol, ()):
+            order = self.orders.get(order_id)
+            if order is not None and order.type == 2:
+                self._fill(order, ltp + order.side * self.slippage_ticks * OPTION_TICK_SIZE, updates)
+                increment_counter('paper_orders_total', outcome="filled")
+
+    def on_prices(self, prices):
+        """Record {symbol: ltp} and match the orders they cross"""
+        updates = []
+        with self.cond:
+            self.prices.update(prices)
+            for symbol in (self.bids.keys() | self.asks.keys() | self.waiting.keys()) & prices.keys():
+                self._cross(symbol, prices[symbol], updates)
+        self._publish(updates)
+
+    def on_chain(self, options_data):
+        self.on_prices({row["symbol"]: float(row["ltp"]) for row in options_data
+                        if row.get("symbol") and row.get("ltp") is not None})
+
+    def run(self):
+        while True:
+            updates = []
+            with self.cond:
+                while not self.arrivals or self.arrivals[0][0] > time.perf_counter():
+                    self.cond.wait(self.arrivals[0][0] - time.perf_counter() if self.arrivals else None)
+                now = time.perf_counter()
+                while self.arrivals and self.arrivals[0][0] <= now:
+                    order = self.orders.get(heapq.heappop(self.arrivals)[2])
+                    if order is not None:
+                        self._arrive(order, updates)
+            self._publish(updates)
+
+    def _publish(self, updates):
+        for username, book, trade in updates:
+            order_store.apply_order(username, book, source="paper")
+            if trade is not None:
+                order_store.apply_trade(username, trade, source="paper")
+                mark_state_dirty(username)
+
+    # -- reporting --
+    def orderbook(self, username, order_id=None):
+        with self.cond:
+            account = self.accounts.get(username)
+            orders = account.orders.values() if account is not None else ()
+            return [dict(order.book) for order in orders if order_id is None or order.order_id == str(order_id)]
+
+    def positions(self, username):
+        with self.cond:
+            account = self.accounts.get(username)
+            legs = list(account.positions.values()) if account is not None else []
+            for leg in legs:
+                if leg.symbol in self.prices:
+                    leg.mark(self.prices[leg.symbol])
+            return [{"symbol": leg.symbol, "netQty": leg.qty, "netAvg": round(leg.avg_price, 2),
+                     "avgPrice": round(leg.avg_price, 2), "ltp": leg.ltp, "pl": round(leg.mtm + leg.realized, 2),
+                     "unrealized_profit": round(leg.mtm, 2), "realized_profit": round(leg.realized, 2),
+                     "productType": "INTRADAY"} for leg in legs]
+
+    def restore_positions(self, username, positions):
+        """Reload checkpointed netPositions into a virtual account"""
+        with self.cond:
+            account = self.accounts.get(username)
+            if account is None:
+                account = self.accounts[username] = PaperAccount()
+            for pos in positions:
+                ltp = pos.get("ltp")
+                leg = PositionLeg(pos["symbol"], int(pos.get("netQty", 0)), float(pos.get("netAvg", 0) or 0),
+                                  realized=float(pos.get("realized_profit", 0) or 0))
+                leg.mark(float(ltp) if ltp is not None else leg.avg_price)
+                account.positions[leg.symbol] = leg
+
+    def reset(self, username):
+        """Forget a virtual account's orders and positions"""
+        with self.cond:
+            account = self.accounts.pop(username, None)
+            for order_id in (account.orders if account is not None else ()):
+                order = self.orders.pop(order_id, None)
+                if order is not None:
+                    order.version += 1
+
+
+class PaperFyers:
+    """FyersModel-shaped client that trades on the paper exchange.
+
+    Order calls go to the exchange; market data calls go to the live client
+    when the user has one, else are answered from the shared chain snapshot
+    and the exchange's last prices.
+    """
+
+    def __init__(self, exchange, username, data_client=None):
+        self.exchange = exchange
+        self.username = username
+        self.data_client = data_client
+
+    def place_order(self, data):
+        return self.exchange.place(self.username, data)
+
+    def modify_order(self, data):
+        return self.exchange.modify(self.username, data)
+
+    def cancel_order(self, data):
+        return self.exchange.cancel(self.username, data)
+
+    def orderbook(self, data=None):
+        return {"s": "ok", "code": 200, "orderBook": self.exchange.orderbook(self.username, (data or {}).get("id"))}
+
+    def positions(self):
+        positions = self.exchange.positions(self.username)
+        return {"s": "ok", "code": 200, "netPositions": positions,
+                "overall": {"count_open": sum(1 for p in positions if p["netQty"]),
+                            "pl_total": round(sum(p["pl"] for p in positions), 2)}}
+
+    def quotes(self, data):
+        if self.data_client is not None:
+            return self.data_client.quotes(data=data)
+        symbols = [symbol for symbol in data["symbols"].split(",") if symbol]
+        prices = self.exchange.prices
+        return {"s": "ok", "code": 200,
+                "d": [{"n": symbol, "s": "ok", "v": {"lp": prices[symbol]}} if symbol in prices
+                      else {"n": symbol, "s": "error", "v": {}} for symbol in symbols]}
+
+    def optionchain(self, data):
+        if self.data_client is not None:
+            return self.data_client.optionchain(data=data)
+        snapshot = chain_cache.snapshot
+        if snapshot is None:
+            return {"s": "error", "code": -99, "message": "No market data for the paper account yet"}
+        return snapshot.response
+
+    def get_profile(self):
+        if self.data_client is not None:
+            return self.data_client.get_profile()
+        return {"s": "ok", "code": 200, "data": {"name": self.username, "paper": True}}
+
+
+paper_exchange = PaperExchange()
+
+
+# ---- Option Chain Helpers ----
+def build_option_pivot(options_data):
+    """Pivot raw optionsChain rows into one CE/PE row per strike"""
+    df = pd.DataFrame(options_data)
+
+    ce_df = df[df['option_type'] == 'CE']
+    pe_df = df[df['option_type'] == 'PE']
+
+    df_pivot = pd.merge(
+        ce_df[['strike_price', 'ltp', 'oi', 'volume']],
+        pe_df[['strike_price', 'ltp', 'oi', 'volume']],
+        on='strike_price',
+        suffixes=('_CE', '_PE')
+    )
+
+    return df_pivot.rename(columns={
+        'ltp_CE': 'CE_LTP',
+        'oi_CE': 'CE_OI',
+        'volume_CE': 'CE_Volume',
+        'ltp_PE': 'PE_LTP',
+        'oi_PE': 'PE_OI',
+        'volume_PE': 'PE_Volume'
+    })
+
+
+def detect_atm_strike(response_data, df_pivot):
+    """Pick the strike closest to the underlying spot"""
+    nifty_spot = response_data.get(
+        "underlyingValue",
+        df_pivot["strike_price"].iloc[len(df_pivot) // 2]
+    )
+    return min(df_pivot["strike_price"], key=lambda x: abs(x - nifty_spot))
+
+
+def chain_symbol_map(options_data):
+    """Map strike -> {"CE": symbol, "PE": symbol} from raw optionsChain rows"""
+    symbols = {}
+    for item in options_data:
+        option_type = item.get("option_type")
+        if option_type in ("CE", "PE") and item.get("symbol"):
+            symbols.setdefault(item["strike_price"], {})[option_type] = item["symbol"]
+    return symbols
+
+
+def pivot_leg_quotes(df_pivot, ce_target_strike, pe_target_strike):
+    """Return {leg: (strike, live ltp)} for the CE/PE offset strikes present in the pivot"""
+    legs = {}
+    for option_type, strike in (("CE", ce_target_strike), ("PE", pe_target_strike)):
+        ltps = df_pivot.loc[df_pivot["strike_price"] == strike, f"{option_type}_LTP"]
+        if not ltps.empty and pd.notna(ltps.iloc[0]):
+            legs[option_type] = (strike, float(ltps.iloc[0]))
+    return legs
+
+
+def evaluate_offset_legs(legs, initial_data, placed_orders):
+    """Check offset legs against initial LTP + fixed threshold.
+
+    Returns (fired, gaps): fired lists (signal_name, strike, ltp, option_type)
+    for legs above their threshold that have not been ordered yet, gaps maps
+    each still-pending leg to the points it has left to its trigger level.
+    """
+    fired, gaps = [], {}
+    for option_type, (strike, ltp) in legs.items():
+        signal_name = f"{option_type}_OFFSET_{strike}"
+        if signal_name in placed_orders:
+            continue
+        initial = next((item[f"{option_type}_LTP"] for item in initial_data if item["strike_price"] == strike), None)
+        if initial is None:
             continue
+        threshold = FIXED_CE_THRESHOLD if option_type == "CE" else FIXED_PE_THRESHOLD
+        if ltp > initial + threshold:
+            fired.append((signal_name, strike, ltp, option_type))
+        else:
+            gaps[option_type] = initial + threshold - ltp
+    return fired, gaps
+
+
+def find_offset_signals(df_pivot, initial_data, ce_target_strike, pe_target_strike, placed_orders):
+    """Return (signal_name, strike, ltp, option_type) for offset strikes above their fixed threshold"""
+    legs = pivot_leg_quotes(df_pivot, ce_target_strike, pe_target_strike)
+    return evaluate_offset_legs(legs, initial_data, placed_orders)[0]
+
+
+# ---- Option Analytics ----
+def _erf(x):
+    """Vectorized erf (Abramowitz & Stegun 7.1.26, |error| < 1.5e-7)"""
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return sign * (1.0 - poly * np.exp(-x * x))
+
+
+def _norm_cdf(x):
+    return 0.5 * (1.0 + _erf(x / np.sqrt(2.0)))
+
+
+def _norm_pdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2.0 * np.pi)
+
+
+def black_scholes(spot, strike, years, rate, sigma, is_call):
+    """Vectorized Black-Scholes price and vega (per 1.0 of volatility)"""
+    sqrt_t = np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * sigma * sigma) * years) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    discounted = strike * np.exp(-rate * years)
+    call = spot * _norm_cdf(d1) - discounted * _norm_cdf(d2)
+    price = np.where(is_call, call, call - spot + discounted)  # put via parity
+    return price, spot * _norm_pdf(d1) * sqrt_t
+
+
+def implied_volatility(price, spot, strike, years, rate, is_call, iterations=ANALYTICS_IV_ITERATIONS):
+    """Vectorized IV: Newton steps, falling back to bisection whenever a step leaves the bracket.
+
+    NaN where the price is outside the no-arbitrage bounds.
+    """
+    price = np.asarray(price, dtype=float)
+    discounted = strike * np.exp(-rate * years)
+    intrinsic = np.where(is_call, np.maximum(spot - discounted, 0.0), np.maximum(discounted - spot, 0.0))
+    upper = np.where(is_call, spot, discounted)
+    valid = np.isfinite(price) & (price > intrinsic) & (price < upper)
+
+    sigma = np.full(price.shape, 0.2)
+    lo = np.full(price.shape, 1e-4)
+    hi = np.full(price.shape, 5.0)
+    for _ in range(iterations):
+        model, vega = black_scholes(spot, strike, years, rate, sigma, is_call)
+        diff = model - price
+        if not np.any(valid & (np.abs(diff) > 1e-4)):
+            break
+        hi = np.where(diff > 0, sigma, hi)
+        lo = np.where(diff < 0, sigma, lo)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = sigma - diff / vega
+        in_bracket = (vega > 1e-8) & (newton > lo) & (newton < hi)
+        sigma = np.where(in_bracket, newton, 0.5 * (lo + hi))
+    return np.where(valid, sigma, np.nan)
+
+
+def option_greeks(spot, strike, years, rate, sigma, is_call):
+    """Vectorized delta, gamma, theta (per day) and vega (per 1 vol point)"""
+    sqrt_t = np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * sigma * sigma) * years) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    pdf = _norm_pdf(d1)
+    carry = rate * strike * np.exp(-rate * years)
+    decay = -spot * pdf * sigma / (2 * sqrt_t)
+    return {
+        "delta": np.where(is_call, _norm_cdf(d1), _norm_cdf(d1) - 1.0),
+        "gamma": pdf / (spot * sigma * sqrt_t),
+        "theta": np.where(is_call, decay - carry * _norm_cdf(d2), decay + carry * _norm_cdf(-d2)) / 365.0,
+        "vega": spot * pdf * sqrt_t / 100.0,
+    }
 
+
+def max_pain_strike(strikes, ce_oi, pe_oi):
+    """Strike at which option writers pay out the least at expiry"""
+    moneyness = strikes[:, None] - strikes[None, :]  # settlement j minus strike i
+    payout = np.maximum(moneyness, 0.0) @ ce_oi + np.maximum(-moneyness, 0.0) @ pe_oi
+    return float(strikes[int(np.argmin(payout))])
+
+
+def chain_expiry(response_data):
+    """Expiry of the chain as an aware datetime at the close, or None if unknown"""
+    for item in response_data.get("expiryData") or []:
         try:
-            # Get user-specific settings
-            atm_strike = get_user_data(username, 'atm_strike')
-            initial_data = get_user_data(username, 'initial_data')
-            symbol_prefix = get_user_data(username, 'symbol_prefix')
-            ce_strike_offset = get_user_data(username, 'ce_strike_offset')
-            pe_strike_offset = get_user_data(username, 'pe_strike_offset')
-            signals = get_user_data(username, 'signals')
-            placed_orders = get_user_data(username, 'placed_orders')
-
-            data = {"symbol": "NSE:NIFTY50-INDEX", "strikecount": 20, "timestamp": ""}
-            response = fyers.optionchain(data=data)
-
-            if "data" not in response or "optionsChain" not in response["data"]:
-                print(f"{username}: Invalid response from API")
-                time.sleep(2)
+            day = datetime.fromtimestamp(int(item["expiry"]), MARKET_TIMEZONE).date()
+        except (KeyError, TypeError, ValueError):
+            continue
+        return datetime.combine(day, _parse_clock(MARKET_CLOSE_TIME), MARKET_TIMEZONE)
+    if symbol_master.ensure_loaded(wait=False):
+        day = symbol_master.nearest_expiry(SYMBOL_UNDERLYING)
+        if day is not None:
+            return datetime.combine(day, _parse_clock(MARKET_CLOSE_TIME), MARKET_TIMEZONE)
+    return None
+
+
+def compute_chain_analytics(response_data, df_pivot, now=None):
+    """IV and Greeks for every strike plus PCR and max pain, vectorized over the pivot's display window"""
+    strikes = df_pivot["strike_price"].to_numpy(dtype=float)
+    if len(strikes):
+        # The fetched width follows users' legs; analytics stay on the fixed display window
+        df_pivot = strike_window.display_rows(df_pivot, float(response_data.get("underlyingValue") or np.median(strikes)))
+        strikes = df_pivot["strike_price"].to_numpy(dtype=float)
+    ce_oi = np.nan_to_num(df_pivot["CE_OI"].to_numpy(dtype=float))
+    pe_oi = np.nan_to_num(df_pivot["PE_OI"].to_numpy(dtype=float))
+    ce_volume = np.nan_to_num(df_pivot["CE_Volume"].to_numpy(dtype=float))
+    pe_volume = np.nan_to_num(df_pivot["PE_Volume"].to_numpy(dtype=float))
+    spot = float(response_data.get("underlyingValue") or strikes[len(strikes) // 2])
+
+    result = {
+        "spot": spot,
+        "pcr_oi": round(float(pe_oi.sum() / ce_oi.sum()), 4) if ce_oi.sum() else None,
+        "pcr_volume": round(float(pe_volume.sum() / ce_volume.sum()), 4) if ce_volume.sum() else None,
+        "max_pain": max_pain_strike(strikes, ce_oi, pe_oi) if len(strikes) else None,
+        "expiry": None,
+        "strikes": [],
+    }
+    expiry = chain_expiry(response_data)
+    if expiry is None or not len(strikes):
+        return result
+
+    now = now or trading_calendar.now()
+    years = max((expiry - now).total_seconds(), 60.0) / (365.0 * 86400)
+    rate = ANALYTICS_RISK_FREE_RATE
+    columns = {"strike_price": strikes}
+    for option_type, is_call in (("CE", True), ("PE", False)):
+        ltp = df_pivot[f"{option_type}_LTP"].to_numpy(dtype=float)
+        iv = implied_volatility(ltp, spot, strikes, years, rate, is_call)
+        greeks = option_greeks(spot, strikes, years, rate, iv, is_call)
+        columns[f"{option_type}_IV"] = iv * 100
+        for name, values in greeks.items():
+            columns[f"{option_type}_{name}"] = values
+    columns.update(chain_history.momentum(strikes, CHAIN_HISTORY_WINDOW))
+    table = pd.DataFrame(columns).round(4)
+    result["expiry"] = expiry.isoformat()
+    result["strikes"] = table.astype(object).where(table.notna(), None).to_dict(orient="records")
+    return result
+
+
+# ---- Chain History ----
+CHAIN_FIELDS = ('CE_LTP', 'PE_LTP', 'CE_OI', 'PE_OI', 'CE_Volume', 'PE_Volume')
+CHAIN_FIELD_INDEX = {name: i for i, name in enumerate(CHAIN_FIELDS)}
+
+
+class ChainHistory:
+    """Ring buffer of the last `capacity` chain snapshots per strike and field.
+
+    Everything lives in preallocated arrays: values[slot, column, field]
+    with one column per strike seen. Appending writes one slot in place;
+    window queries index the slots they need and reduce over them in a
+    single NumPy call, so nothing is copied per tick beyond the window.
+    Strikes missing from a snapshot are NaN in that slot. When every
+    column is taken, the strike seen least recently gives its column up.
+    EMAs for CHAIN_HISTORY_EMA_SPANS are kept incrementally on append.
+    """
+
+    def __init__(self, capacity=CHAIN_HISTORY_SIZE, max_strikes=CHAIN_HISTORY_MAX_STRIKES,
+                 ema_spans=CHAIN_HISTORY_EMA_SPANS):
+        fields = len(CHAIN_FIELDS)
+        self.capacity = capacity
+        self.values = np.full((capacity, max_strikes, fields), np.nan)
+        self.times = np.zeros(capacity)
+        self.strikes = np.full(max_strikes, np.nan)
+        self.last_seen = np.full(max_strikes, -1, dtype=np.int64)
+        self.columns = {}  # strike -> column
+        self.emas = {span: np.full((max_strikes, fields), np.nan) for span in ema_spans}
+        self.head = 0      # next slot to write
+        self.count = 0     # snapshots appended in total
+        self.lock = threading.Lock()
+
+    def _column(self, strike):
+        strike = float(strike)
+        column = self.columns.get(strike)
+        if column is not None:
+            self.last_seen[column] = self.count
+            return column
+        free = np.flatnonzero(np.isnan(self.strikes))
+        if len(free):
+            column = int(free[0])
+        else:
+            column = int(np.argmin(self.last_seen))
+            del self.columns[float(self.strikes[column])]
+            self.values[:, column] = np.nan
+            for ema in self.emas.values():
+                ema[column] = np.nan
+        self.strikes[column] = strike
+        self.columns[strike] = column
+        self.last_seen[column] = self.count
+        return column
+
+    def append(self, df_pivot, at):
+        """Record one pivot (one row per strike) taken at perf_counter time `at`"""
+        strikes = df_pivot["strike_price"].to_numpy(dtype=float)
+        rows = df_pivot[list(CHAIN_FIELDS)].to_numpy(dtype=float)
+        with self.lock:
+            columns = np.fromiter((self._column(strike) for strike in strikes), dtype=np.intp, count=len(strikes))
+            slot = self.values[self.head]
+            slot.fill(np.nan)
+            slot[columns] = rows
+            self.times[self.head] = at
+            for span, ema in self.emas.items():
+                alpha = 2.0 / (span + 1)
+                previous = ema[columns]
+                ema[columns] = np.where(np.isnan(previous), rows, previous + alpha * (rows - previous))
+            self.head = (self.head + 1) % self.capacity
+            self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _slots(self, window):
+        """Slot indices for the newest `window` snapshots, newest first"""
+        window = max(1, min(window, len(self)))
+        return (self.head - 1 - np.arange(window)) % self.capacity
+
+    def _lookup(self, strikes):
+        """(columns, known) for `strikes`; unknown strikes map to column 0 and are masked by `known`"""
+        columns = np.fromiter((self.columns.get(float(strike), -1) for strike in strikes),
+                              dtype=np.intp, count=len(strikes))
+        known = columns >= 0
+        return np.where(known, columns, 0), known
+
+    def _select(self, field, strikes, slots):
+        columns, known = self._lookup(strikes)
+        window = self.values[slots[:, None], columns[None, :], CHAIN_FIELD_INDEX[field]]
+        return np.where(known[None, :], window, np.nan)
+
+    def _latest(self, field, strikes):
+        if not self.count:
+            return np.full(len(strikes), np.nan)
+        return self._select(field, strikes, self._slots(1))[0]
+
+    def _ago(self, field, strikes, window):
+        if window >= len(self):
+            return np.full(len(strikes), np.nan)
+        slots = np.array([(self.head - 1 - window) % self.capacity])
+        return self._select(field, strikes, slots)[0]
+
+    def latest(self, field, strikes):
+        with self.lock:
+            return self._latest(field, strikes)
+
+    def ago(self, field, strikes, window):
+        """Value `window` snapshots before the latest (NaN until that much history exists)"""
+        with self.lock:
+            return self._ago(field, strikes, window)
+
+    def change(self, field, strikes, window):
+        """Latest minus the value `window` snapshots back (e.g. OI change)"""
+        with self.lock:
+            return self._latest(field, strikes) - self._ago(field, strikes, window)
+
+    def roc(self, field, strikes, window):
+        """Rate of change over `window` snapshots, in percent"""
+        with self.lock:
+            latest = self._latest(field, strikes)
+            before = self._ago(field, strikes, window)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(before > 0, (latest - before) / before * 100, np.nan)
+
+    def rolling_max(self, field, strikes, window):
+        # fmax/fmin skip NaN and leave all-NaN columns NaN without a RuntimeWarning
+        with self.lock:
+            return np.fmax.reduce(self._select(field, strikes, self._slots(window)), axis=0)
+
+    def rolling_min(self, field, strikes, window):
+        with self.lock:
+            return np.fmin.reduce(self._select(field, strikes, self._slots(window)), axis=0)
+
+    def ema(self, field, strikes, span):
+        with self.lock:
+            columns, known = self._lookup(strikes)
+            return np.where(known, self.emas[span][columns, CHAIN_FIELD_INDEX[field]], np.nan)
+
+    def momentum(self, strikes, window):
+        """Per-strike LTP ROC and OI change over `window` snapshots, for the analytics table"""
+        return {
+            "CE_ROC": self.roc('CE_LTP', strikes, window),
+            "PE_ROC": self.roc('PE_LTP', strikes, window),
+            "CE_OI_Change": self.change('CE_OI', strikes, window),
+            "PE_OI_Change": self.change('PE_OI', strikes, window),
+        }
+
+
+chain_history = ChainHistory()
+
+
+# ---- Strike Window ----
+class StrikeWindow:
+    """Smallest optionchain strikecount that covers every loaded user's legs.
+
+    A user's legs are the CE/PE offset strikes, the strikes of their strategy
+    rules and of their shadow variants, all relative to their baseline ATM
+    (the current ATM until they have one). The window is measured from the
+    spot of the latest chain snapshot, so it widens by itself as ATM drifts
+    away from the baselines, plus STRIKE_WINDOW_MARGIN strikes, and never
+    drops below the STRIKE_WINDOW_DISPLAY strikes the dashboard shows.
+    Recomputed at most once per CHAIN_CACHE_TTL.
+
+    Baselines are captured from a full STRIKE_WINDOW_BASELINE fetch
+    (`request(baseline=True)`), not from the current window, so offsets,
+    rules and shadows changed after the capture still find their strikes.
+    """
+
+    def __init__(self, step=CHAIN_STRIKE_STEP, margin=STRIKE_WINDOW_MARGIN, limit=STRIKE_WINDOW_MAX,
+                 display=STRIKE_WINDOW_DISPLAY, baseline=STRIKE_WINDOW_BASELINE, ttl=CHAIN_CACHE_TTL):
+        self.step = step
+        self.margin = margin
+        self.limit = limit
+        self.display = min(display, limit)
+        self.baseline = min(baseline, limit)
+        self.ttl = ttl
+        self.count = limit
+        self.computed_at = None
+
+    def _reach(self, state, spot):
+        """Farthest distance in points between the spot and one of the user's legs"""
+        offsets = [state.ce_strike_offset, state.pe_strike_offset]
+        entry = strategy_engine.rules.get(state.username)
+        if entry is not None:
+            offsets.extend(rule.offset for rule in entry[1])
+        for config in state.shadow_configs:
+            offsets.append(config['ce_strike_offset'])
+            offsets.append(config['pe_strike_offset'])
+        if spot is None:
+            return max(abs(offset) for offset in offsets)
+        center = spot if state.atm_strike is None else state.atm_strike
+        return max(abs(center + offset - spot) for offset in offsets)
+
+    def strikecount(self):
+        now = time.monotonic()
+        if self.computed_at is not None and now - self.computed_at < self.ttl:
+            return self.count
+        snapshot = chain_cache.snapshot
+        spot = snapshot.response["data"].get("underlyingValue") if snapshot is not None else None
+        with user_sessions_lock:
+            states = list(user_sessions.values())
+        reach = max((self._reach(state, spot) for state in states), default=0)
+        count = min(self.limit, max(self.display, int(-(-reach // self.step)) + self.margin))
+        if count != self.count:
+            log_event(logging.INFO, "Option chain strike window changed", stage="fetch",
+                      strikecount=count, previous=self.count, users=len(states))
+        self.count = count
+        self.computed_at = now
+        return count
+
+    def request(self, baseline=False):
+        """optionchain request data for the current window, or at least the baseline width"""
+        count = self.strikecount()
+        if baseline:
+            count = max(count, self.baseline)
+        return {"symbol": "NSE:NIFTY50-INDEX", "strikecount": count, "timestamp": ""}
+
+    def covers_baseline(self, df_pivot):
+        """Whether a pivot is wide enough to capture a baseline from"""
+        return (len(df_pivot) - 1) // 2 >= self.baseline
+
+    def display_rows(self, df_pivot, spot):
+        """The pivot rows within the dashboard window around spot, whatever width was fetched"""
+        return df_pivot[(df_pivot["strike_price"] - spot).abs() <= self.display * self.step]
+
+
+strike_window = StrikeWindow()
+
+
+# ---- Chain Snapshot Cache ----
+METRIC_HELP['chain_cache_requests_total'] = 'Chain snapshot requests served from the shared cache (hit) or fetched (miss)'
+
+
+class ChainSnapshot:
+    """One optionchain fetch and its pivot; the JSON and analytics are derived once and shared"""
+    __slots__ = ('version', 'fetched_at', 'response', 'df_pivot', '_json', '_analytics', 'lock')
+
+    def __init__(self, version, fetched_at, response, df_pivot):
+        self.version = version
+        self.fetched_at = fetched_at
+        self.response = response
+        self.df_pivot = df_pivot
+        self._json = None
+        self._analytics = None
+        self.lock = threading.Lock()
+
+    @property
+    def options_data(self):
+        return self.response["data"]["optionsChain"]
+
+    def to_json(self):
+        if self._json is None:
+            with self.lock:
+                if self._json is None:
+                    # The dashboard table shows the fixed display window, whatever width was fetched
+                    df_pivot = self.df_pivot
+                    if len(df_pivot):
+                        spot = self.response["data"].get("underlyingValue") or df_pivot["strike_price"].median()
+                        df_pivot = strike_window.display_rows(df_pivot, float(spot))
+                    self._json = df_pivot.to_json(orient="records")
+        return self._json
+
+    def analytics(self):
+        if self._analytics is None:
+            with self.lock:
+                if self._analytics is None:
+                    start = time.perf_counter()
+                    analytics = compute_chain_analytics(self.response["data"], self.df_pivot)
+                    observe_latency('pipeline_stage_seconds', time.perf_counter() - start, stage="analytics", source="fetch")
+                    analytics["version"] = self.version
+                    self._analytics = analytics
+        return dict(self._analytics, age_seconds=round(time.perf_counter() - self.fetched_at, 3))
+
+
+class ChainSnapshotCache:
+    """The latest NIFTY chain snapshot, shared by every user's /fetch and /analytics.
+
+    A snapshot younger than `ttl` is served as is; otherwise one caller
+    fetches a new one with its own client while the others wait for it, so
+    broker calls, pivots and analytics stay at one per snapshot however many
+    dashboards are open. Bots publish the chains they fetch as well.
+    """
+
+    def __init__(self, ttl=CHAIN_CACHE_TTL):
+        self.ttl = ttl
+        self.snapshot = None
+        self.version = 0
+        self.lock = threading.Lock()        # guards version / snapshot
+        self.fetch_lock = threading.Lock()  # one fetch in flight
+
+    def current(self):
+        snapshot = self.snapshot
+        if snapshot is not None and time.perf_counter() - snapshot.fetched_at <= self.ttl:
+            return snapshot
+        return None
+
+    def publish(self, response, fetched_at, df_pivot):
+        with self.lock:
+            if self.snapshot is not None and self.snapshot.fetched_at >= fetched_at:
+                return self.snapshot
+            self.version += 1
+            snapshot = self.snapshot = ChainSnapshot(self.version, fetched_at, response, df_pivot)
+            chain_history.append(df_pivot, fetched_at)
+        paper_exchange.on_chain(response["data"]["optionsChain"])
+        strategy_engine.evaluate(df_pivot, fetched_at)
+        shadow_engine.evaluate(df_pivot, fetched_at)
+        return snapshot
+
+    def get(self, fyers, baseline=False):
+        """Return (snapshot, None) or (None, error message); with baseline, one wide enough to capture a baseline"""
+        snapshot = self._usable(baseline)
+        if snapshot is None:
+            with self.fetch_lock:
+                snapshot = self._usable(baseline)
+                if snapshot is None:
+                    increment_counter('chain_cache_requests_total', result="miss")
+                    return self._fetch(fyers, baseline)
+        increment_counter('chain_cache_requests_total', result="hit")
+        return snapshot, None
+
+    def _usable(self, baseline):
+        snapshot = self.current()
+        if snapshot is not None and baseline and not strike_window.covers_baseline(snapshot.df_pivot):
+            return None
+        return snapshot
+
+    def _fetch(self, fyers, baseline=False):
+        start = time.perf_counter()
+        response = broker_call('optionchain', fyers.optionchain, data=strike_window.request(baseline))
+        fetched_at = time.perf_counter()
+        observe_latency('pipeline_stage_seconds', fetched_at - start, stage="fetch", source="fetch")
+
+        if "data" not in response or "optionsChain" not in response["data"]:
+            return None, f"Invalid response from API: {response}"
+        options_data = response["data"]["optionsChain"]
+        if not options_data:
+            return None, "No options data found!"
+        increment_counter('feed_rows_total', len(options_data), feed="chain")
+
+        df_pivot = build_option_pivot(options_data)
+        observe_latency('pipeline_stage_seconds', time.perf_counter() - fetched_at, stage="pivot", source="fetch")
+        return self.publish(response, fetched_at, df_pivot), None
+
+
+chain_cache = ChainSnapshotCache()
+
+
+# ---- Adaptive Polling ----
+class PollCadence:
+    """Pick a user's next bot poll interval from signal proximity, volatility and API budget"""
+    VOLATILITY_ALPHA = 0.3   # EWMA weight of the latest |dLTP|/dt sample
+    ETA_FRACTION = 0.25      # poll ~4 times before the fastest leg could reach its trigger
+    LOW_BUDGET = 0.2         # below this bucket fill, never poll faster than the sustainable rate
+    MIN_SPEED = 1.0          # points/second assumed for legs with no (or a flat) volatility history
+    ERROR_BACKOFF = 2.0      # interval multiplier per consecutive failed poll, from 1s up to max_interval
+
+    def __init__(self, min_interval=BOT_POLL_MIN_INTERVAL, max_interval=BOT_POLL_MAX_INTERVAL,
+                 budget_per_min=BOT_POLL_BUDGET_PER_MIN):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.refill_per_sec = budget_per_min / 60.0
+        self.capacity = max(1.0, budget_per_min / 6.0)  # allow 10s worth of bursting
+        self.tokens = self.capacity
+        self.refilled_at = time.monotonic()
+        self.volatility = {}  # leg -> EWMA points/second
+        self.last_ltp = {}    # leg -> (monotonic time, ltp)
+        self.last_decision = {"interval": min_interval, "reason": "startup"}
+        self.gaps = None      # gaps of the latest evaluation, None until the first one
+        self.failures = 0     # consecutive failed polls
+        self.lock = threading.Lock()  # observe() runs on the evaluate stage, next_interval() on fetch
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.refill_per_sec)
+        self.refilled_at = now
+
+    def record_poll(self):
+        """Charge one API call against the polling budget"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = max(0.0, self.tokens - 1)
+
+    def observe(self, legs, gaps=None):
+        """Update volatility from {leg: ltp} seen on this poll and remember the evaluated gaps"""
+        with self.lock:
+            self._observe(legs)
+            self.gaps = gaps
+
+    def _observe(self, legs):
+        now = time.monotonic()
+        for leg, ltp in legs.items():
+            prev = self.last_ltp.get(leg)
+            self.last_ltp[leg] = (now, ltp)
+            if prev is None or now <= prev[0]:
                 continue
+            speed = abs(ltp - prev[1]) / (now - prev[0])
+            old = self.volatility.get(leg)
+            self.volatility[leg] = speed if old is None else old + self.VOLATILITY_ALPHA * (speed - old)
+
+    def next_interval(self, gaps=None, failed=False):
+        """Return seconds until the next poll; `gaps` is {leg: points left to the trigger level}"""
+        with self.lock:
+            return self._next_interval(gaps, failed)
+
+    def _next_interval(self, gaps, failed):
+        now = time.monotonic()
+        self._refill(now)
+        budget = self.tokens / self.capacity
+        self.failures = self.failures + 1 if failed else 0
+
+        if failed:
+            interval, reason, eta = self.ERROR_BACKOFF ** (self.failures - 1), "backing off after error", None
+        elif gaps is None:
+            interval, reason, eta = self.min_interval, "no evaluation yet", None
+        elif not gaps:
+            interval, reason, eta = self.max_interval, "no pending legs", None
+        else:
+            # A leg close to its trigger keeps the interval short even in a quiet market
+            eta = min(max(gap, 0.0) / max(self.volatility.get(leg, 0.0), self.MIN_SPEED) for leg, gap in gaps.items())
+            interval, reason = eta * self.ETA_FRACTION, "distance to trigger"
+
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        if budget < self.LOW_BUDGET:
+            sustainable = 1.0 / self.refill_per_sec if self.refill_per_sec > 0 else self.max_interval
+            if interval < sustainable:
+                interval, reason = sustainable, "rate-limit budget"
+            if self.tokens < 1 and self.refill_per_sec > 0:
+                interval = max(interval, (1 - self.tokens) / self.refill_per_sec)
+
+        self.last_decision = {
+            "interval": round(interval, 3),
+            "reason": reason,
+            "gaps": {leg: round(gap, 2) for leg, gap in (gaps or {}).items()},
+            "volatility": {leg: round(v, 3) for leg, v in self.volatility.items()},
+            "eta_seconds": None if eta is None else round(min(eta, 1e6), 2),
+            "budget": round(budget, 3),
+        }
+        return interval
+
+    def describe(self):
+        with self.lock:
+            return dict(self.last_decision, min_interval=self.min_interval, max_interval=self.max_interval)
+
+
+# ---- Trading Calendar ----
+def _parse_clock(value):
+    return datetime.strptime(value, "%H:%M:%S" if value.count(":") == 2 else "%H:%M").time()
+
+
+class TradingCalendar:
+    """NSE sessions (Mon-Fri, open/close times) minus holidays read from a local file.
+
+    The holidays file holds one ISO date per line, optionally followed by a
+    description; blank lines and lines starting with # are ignored. It is
+    re-read whenever its modification time changes.
+    """
+
+    def __init__(self, holidays_file=NSE_HOLIDAYS_FILE, open_time=MARKET_OPEN_TIME,
+                 close_time=MARKET_CLOSE_TIME, tz=MARKET_TIMEZONE):
+        self.holidays_file = holidays_file
+        self.open_time = _parse_clock(open_time)
+        self.close_time = _parse_clock(close_time)
+        self.tz = tz
+        self.holidays = set()
+        self._holidays_mtime = None
+        self._lock = threading.Lock()
+
+    def _refresh_holidays(self):
+        try:
+            mtime = os.path.getmtime(self.holidays_file)
+        except OSError:
+            mtime = None
+        if mtime == self._holidays_mtime:
+            return
+        holidays = set()
+        if mtime is not None:
+            try:
+                with open(self.holidays_file, 'r') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            holidays.add(date.fromisoformat(line.split()[0]))
+            except Exception as e:
+                log_event(logging.ERROR, "Error loading holidays", stage="calendar", error=str(e))
+                return
+        with self._lock:
+            self.holidays = holidays
+            self._holidays_mtime = mtime
+
+    def now(self):
+        return datetime.now(self.tz)
+
+    def is_trading_day(self, day):
+        self._refresh_holidays()
+        return day.weekday() < 5 and day not in self.holidays
+
+    def session_bounds(self, day):
+        return (datetime.combine(day, self.open_time, self.tz),
+                datetime.combine(day, self.close_time, self.tz))
+
+    def is_open(self, now=None):
+        now = now or self.now()
+        if not self.is_trading_day(now.date()):
+            return False
+        open_at, close_at = self.session_bounds(now.date())
+        return open_at <= now < close_at
+
+    def next_open(self, now=None):
+        """Open time of the current or next session that has not closed yet"""
+        now = now or self.now()
+        day = now.date()
+        for _ in range(30):
+            if self.is_trading_day(day):
+                open_at, close_at = self.session_bounds(day)
+                if now < close_at:
+                    return open_at
+            day += timedelta(days=1)
+        raise RuntimeError("No trading session found in the next 30 days")
+
+    def baseline_time(self, day):
+        return datetime.combine(day, _parse_clock(BASELINE_CAPTURE_TIME), self.tz)
+
+    def describe(self, now=None):
+        now = now or self.now()
+        try:
+            next_open = self.next_open(now).isoformat()
+        except RuntimeError:
+            next_open = None
+        return {
+            "open": self.is_open(now),
+            "next_open": next_open,
+            "baseline_capture": self.baseline_time(now.date()).isoformat(),
+        }
+
+
+trading_calendar = TradingCalendar()
+
+
+def sleep_while_running(username, seconds, step=1.0):
+    """Sleep up to `seconds`, waking early if the bot is stopped; False if it was stopped"""
+    deadline = time.monotonic() + max(0.0, seconds)
+    state = find_user_state(username)
+    while state is not None and state.bot_running:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True
+        time.sleep(min(step, remaining))
+    return False
+
+
+def prewarm_user(username):
+    """Validate the token and warm the broker connection and chain data ahead of the open"""
+    fyers, _ = get_user_fyers_session(username)
+    if fyers is None:
+        log_event(logging.WARNING, "Pre-open warmup skipped: not logged in to Fyers", user=username, stage="warmup")
+        return False
+    start = time.perf_counter()
+    try:
+        broker_call('get_profile', fyers.get_profile)
+        broker_call('optionchain', fyers.optionchain, data=strike_window.request())
+        symbol_master.ensure_loaded()
+    except Exception as e:
+        log_event(logging.ERROR, "Pre-open warmup failed", user=username, stage="warmup", error=str(e))
+        return False
+    log_event(logging.INFO, "Pre-open warmup done", user=username, stage="warmup",
+              latency_ms=(time.perf_counter() - start) * 1000)
+    return True
+
+
+def park_bot_until_market(username):
+    """Hold a bot outside market hours at zero API cost; True once the market is open"""
+    now = trading_calendar.now()
+    if trading_calendar.is_open(now):
+        return True
+
+    # Stop the shared quote poller fetching this bot's legs while it is parked
+    quote_batcher.unsubscribe(username)
+    try:
+        next_open = trading_calendar.next_open(now)
+    except RuntimeError as e:
+        # e.g. the holiday file closes a whole month; check again later instead of killing the bot
+        log_event(logging.ERROR, "Market closed - no session found, bot parked", user=username, stage="calendar",
+                  error=str(e))
+        sleep_while_running(username, 3600, step=5.0)
+        return False
+    warmup_at = next_open - timedelta(minutes=PREOPEN_WARMUP_MINUTES)
+    log_event(logging.INFO, "Market closed - bot parked", user=username, stage="calendar",
+              next_open=next_open.isoformat())
+    if not sleep_while_running(username, (warmup_at - trading_calendar.now()).total_seconds(), step=5.0):
+        return False
+    prewarm_user(username)
+    return sleep_while_running(username, (next_open - trading_calendar.now()).total_seconds())
+
+
+def reset_baseline(username):
+    """Forget the ATM baseline so the next poll captures a fresh one"""
+    state = find_user_state(username)
+    if state is None:
+        return
+    state.reset_baseline()
+    mark_state_dirty(username)
+    # Signals of the new baseline get fresh idempotency tags
+    order_journal.reset(username)
+
+
+# ---- Symbol Master ----
+SYMBOL_MASTER_DTYPE = np.dtype([
+    ('underlying', 'S16'),
+    ('expiry', 'i4'),       # date.toordinal() of the expiry in IST
+    ('strike', 'i8'),       # strike in paise so the key stays integral
+    ('option_type', 'S2'),
+    ('lot_size', 'i4'),
+    ('symbol', 'S48'),
+])
+
+
+class SymbolMaster:
+    """Daily-cached F&O instrument master with O(1) (underlying, expiry, strike, type) lookups.
+
+    The broker CSV is downloaded at most once per day into SYMBOL_MASTER_CSV,
+    compacted into a fixed-width record array sorted by symbol, saved next to
+    SYMBOL_MASTER_INDEX (one file per day) and memory-mapped from there.
+    Symbol checks binary-search the mapped array; the contract key index of
+    an underlying is built on its first lookup. Nothing is loaded until the
+    first lookup or the pre-open warmup, and a stale index keeps serving
+    while the next day's copy is rebuilt in the background.
+    """
+
+    def __init__(self, url=SYMBOL_MASTER_URL, csv_path=SYMBOL_MASTER_CSV, index_path=SYMBOL_MASTER_INDEX):
+        self.url = url
+        self.csv_path = csv_path
+        self.index_path = index_path
+        self.records = None
+        self.symbols = None    # records['symbol'], contiguous for searchsorted
+        self.contracts = {}    # underlying -> ({(expiry ordinal, strike paise, type): symbol}, sorted expiry ordinals)
+        self.last_prefix = None  # prefix of the last resolved symbol, used while the master is loading
+        self.loaded_for = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+
+    @staticmethod
+    def _file_day(path):
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(path), MARKET_TIMEZONE).date()
+        except OSError:
+            return None
+
+    def _download(self):
+        response = requests.get(self.url, timeout=30)
+        response.raise_for_status()
+        tmp_path = self.csv_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_path, self.csv_path)
+
+    def _index_file(self, today):
+        base, ext = os.path.splitext(self.index_path)
+        return f"{base}_{today:%Y%m%d}{ext or '.npy'}"
+
+    def _build_index(self, index_file):
+        rows = []
+        with open(self.csv_path, 'r', newline='') as f:
+            for row in csv.reader(f):
+                # Fyers layout: 3 lot size, 8 expiry epoch, 9 ticker, 13 underlying, 15 strike, 16 option type
+                if len(row) < 17 or row[16] not in ("CE", "PE"):
+                    continue
+                expiry = datetime.fromtimestamp(int(row[8]), MARKET_TIMEZONE).date()
+                rows.append((row[13], expiry.toordinal(), int(round(float(row[15]) * 100)),
+                             row[16], int(float(row[3] or 0)), row[9]))
+        records = np.array(rows, dtype=SYMBOL_MASTER_DTYPE)
+        tmp_file = index_file + ".tmp.npy"
+        np.save(tmp_file, records[np.argsort(records['symbol'], kind='stable')])
+        os.replace(tmp_file, index_file)
+
+    def _refresh_files(self, today):
+        """Make sure today's CSV and index exist; returns the index file to map"""
+        if self._file_day(self.csv_path) != today:
+            try:
+                self._download()
+            except Exception as e:
+                if not os.path.exists(self.csv_path):
+                    raise
+                log_event(logging.WARNING, "Symbol master download failed, using cached copy",
+                          stage="symbols", error=str(e))
+        index_file = self._index_file(today)
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(self.csv_path):
+            self._build_index(index_file)
+        # Older indexes may still be mapped by this process; removal is best effort
+        base = os.path.basename(os.path.splitext(self.index_path)[0]) + "_"
+        for name in os.listdir(os.path.dirname(os.path.abspath(index_file))):
+            path = os.path.join(os.path.dirname(os.path.abspath(index_file)), name)
+            if name.startswith(base) and name.endswith(".npy") and path != os.path.abspath(index_file):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return index_file
+
+    def _load(self, today):
+        start = time.perf_counter()
+        index_file = self._refresh_files(today)
+        records = np.load(index_file, mmap_mode='r')
+        symbols = np.ascontiguousarray(records['symbol'])
+        if len(symbols) > 1 and (symbols[1:] < symbols[:-1]).any():
+            # Written before indexes were sorted by symbol
+            self._build_index(index_file)
+            records = np.load(index_file, mmap_mode='r')
+            symbols = np.ascontiguousarray(records['symbol'])
+        with self._lock:
+            self.records = records
+            self.symbols = symbols
+            self.contracts = {}
+            self.loaded_for = today
+        log_event(logging.INFO, "Symbol master loaded", stage="symbols", instruments=len(records),
+                  latency_ms=(time.perf_counter() - start) * 1000)
+
+    def _contracts(self, underlying):
+        """Contract index and expiries of one underlying, built from its rows on first use"""
+        contracts = self.contracts.get(underlying)
+        if contracts is None:
+            records = self.records
+            rows = records[records['underlying'] == underlying.encode()]
+            by_key = {(int(expiry), int(strike), option_type.decode()): symbol.decode()
+                      for expiry, strike, option_type, symbol
+                      in zip(rows['expiry'], rows['strike'], rows['option_type'], rows['symbol'])}
+            contracts = (by_key, np.unique(rows['expiry']).tolist())
+            with self._lock:
+                if self.records is records:
+                    self.contracts[underlying] = contracts
+        return contracts
+
+    def _row(self, symbol):
+        """Row of `symbol` in the records, or None"""
+        key = symbol.encode()
+        i = int(np.searchsorted(self.symbols, key))
+        return i if i < len(self.symbols) and self.symbols[i] == key else None
+
+    def _background_refresh(self, today):
+        try:
+            with self._load_lock:
+                if self.loaded_for != today:
+                    self._load(today)
+        except Exception as e:
+            log_event(logging.ERROR, "Symbol master refresh failed", stage="symbols", error=str(e))
+        finally:
+            self._refreshing = False
+
+    def _start_background_load(self, today):
+        with self._lock:
+            if not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._background_refresh, args=(today,), daemon=True).start()
+
+    def ensure_loaded(self, wait=True):
+        """Load today's master; False if none is available (or, with wait=False, not loaded yet)"""
+        today = trading_calendar.now().date()
+        if self.loaded_for == today:
+            return True
+        if self.records is not None:
+            # Serve yesterday's index while today's is rebuilt off the hot path
+            self._start_background_load(today)
+            return True
+        if not wait:
+            self._start_background_load(today)
+            return False
+        try:
+            with self._load_lock:
+                if self.records is None:
+                    self._load(today)
+            return True
+        except Exception as e:
+            log_event(logging.ERROR, "Symbol master unavailable", stage="symbols", error=str(e))
+            return False
 
-            options_data = response["data"]["optionsChain"]
-            if not options_data:
-                print(f"{username}: No options data found!")
-                time.sleep(2)
+    def nearest_expiry(self, underlying=SYMBOL_UNDERLYING, on=None):
+        if not self.ensure_loaded():
+            return None
+        on = (on or trading_calendar.now().date()).toordinal()
+        ordinals = self._contracts(underlying)[1]
+        i = bisect.bisect_left(ordinals, on)
+        return date.fromordinal(ordinals[i]) if i < len(ordinals) else None
+
+    def resolve(self, underlying, expiry, strike, option_type):
+        """Return the broker symbol for the contract, or None if it does not exist"""
+        if not self.ensure_loaded():
+            return None
+        symbol = self._contracts(underlying)[0].get((expiry.toordinal(), int(round(float(strike) * 100)), option_type))
+        # Pivot strikes are floats (24200.0); the symbol spells integral strikes as 24200
+        strike = int(strike) if float(strike).is_integer() else strike
+        suffix = f"{strike}{option_type}"
+        if symbol is not None and symbol.endswith(suffix):
+            self.last_prefix = symbol[:-len(suffix)]
+        return symbol
+
+    def is_valid(self, symbol):
+        """True/False once the master is loaded, None when it cannot be checked (never blocks)"""
+        if not self.ensure_loaded(wait=False):
+            return None
+        return self._row(symbol) is not None
+
+    def lot_size(self, symbol):
+        row = self._row(symbol) if self.ensure_loaded() else None
+        return None if row is None else int(self.records['lot_size'][row])
+
+
+symbol_master = SymbolMaster()
+
+
+def build_order_symbol(symbol_prefix, strike, option_type):
+    """Broker symbol for an offset leg: resolved from the master for AUTO, else prefix + strike + type"""
+    if (symbol_prefix or "").strip().upper() == AUTO_SYMBOL_PREFIX:
+        if not symbol_master.ensure_loaded(wait=False):
+            # Never hold an order for the master download; reuse the last resolved prefix meanwhile
+            prefix = symbol_master.last_prefix
+            strike = int(strike) if float(strike).is_integer() else strike
+            return f"{prefix}{strike}{option_type}" if prefix else None
+        expiry = symbol_master.nearest_expiry(SYMBOL_UNDERLYING)
+        return symbol_master.resolve(SYMBOL_UNDERLYING, expiry, strike, option_type) if expiry else None
+    return f"{symbol_prefix}{strike}{option_type}"
+
+
+# ---- Staged Orders ----
+METRIC_HELP['staged_order_misses_total'] = 'Signal orders built on the spot because no matching staged payload existed'
+
+
+class StagedOrders:
+    """Signal order payloads for one user's CE and PE offset legs.
+
+    Built as soon as the ATM and offsets are known, so a firing signal only
+    copies the payload, sets the limit price and sends it. `key` holds the
+    inputs the payloads were built from; the set is rebuilt when any of them
+    changes.
+    """
+    __slots__ = ('key', 'fyers', 'legs')
+
+    def __init__(self, key, fyers, legs):
+        self.key = key
+        self.fyers = fyers
+        self.legs = legs  # option_type -> (strike, payload), or None when the symbol is invalid
+
+
+def stage_signal_orders(state):
+    """Return the user's staged payloads, rebuilding them only when ATM, offsets, prefix or client changed"""
+    atm_strike = state.atm_strike
+    fyers = state.fyers
+    if atm_strike is None or fyers is None:
+        return None
+    symbol_prefix = state.symbol_prefix
+    offsets = (("CE", state.ce_strike_offset), ("PE", state.pe_strike_offset))
+    key = (atm_strike, offsets, symbol_prefix, state.token, symbol_master.loaded_for)
+    staged = state.staged_orders
+    if staged is not None and staged.key == key:
+        return staged
+
+    legs = {}
+    for option_type, offset in offsets:
+        strike = atm_strike + offset
+        symbol = build_order_symbol(symbol_prefix, strike, option_type)
+        if not symbol or symbol_master.is_valid(symbol) is False:
+            log_event(logging.WARNING, "Cannot stage order: unknown symbol", user=state.username,
+                      symbol=symbol, stage="stage", strike=strike, option_type=option_type)
+            legs[option_type] = None
+            continue
+        legs[option_type] = (strike, signal_order_payload(state.username, symbol, side=1))
+
+    staged = state.staged_orders = StagedOrders(key, fyers, legs)
+    log_event(logging.DEBUG, "Staged signal orders", user=state.username, stage="stage",
+              symbols=[leg[1]["symbol"] for leg in legs.values() if leg])
+    return staged
+
+
+def submit_signal_order(state, signal_name, strike, option_type, price):
+    """Send a signal entry from the staged payload, building it on the spot if none matches"""
+    staged = state.staged_orders
+    leg = staged.legs.get(option_type) if staged is not None else None
+    if leg is None or leg[0] != strike:
+        increment_counter('staged_order_misses_total')
+        return place_order(state.username, build_order_symbol(state.symbol_prefix, strike, option_type), price,
+                           side=1, signal_name=signal_name)
+    return send_order(state.username, staged.fyers, {**leg[1], "limitPrice": price}, signal_name)
+
+
+# ---- Batched Quotes ----
+class QuoteBatcher:
+    """Shared poller for the offset-strike quotes of every running bot.
+
+    Bots subscribe the two symbols they watch; one thread dedupes the union,
+    splits it into calls of at most QUOTES_MAX_SYMBOLS_PER_CALL symbols and
+    fetches them with a subscribed user's client, rotating between users so
+    no single account carries the whole rate limit.
+    """
+
+    def __init__(self, max_symbols=QUOTES_MAX_SYMBOLS_PER_CALL, interval=QUOTES_POLL_INTERVAL):
+        self.max_symbols = max_symbols
+        self.interval = interval
+        self.subscriptions = {}  # username -> frozenset(symbols)
+        self.quotes = {}         # symbol -> (ltp, perf_counter when the batch was requested)
+        self.cond = threading.Condition()
+        self.thread = None
+        self._rotation = 0
+
+    def subscribe(self, username, symbols):
+        symbols = frozenset(symbols)
+        with self.cond:
+            if self.subscriptions.get(username) == symbols:
+                return
+            self.subscriptions[username] = symbols
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def unsubscribe(self, username):
+        with self.cond:
+            self.subscriptions.pop(username, None)
+
+    def fresh_ltp(self, symbol, max_age=QUOTES_MAX_AGE):
+        """Cached LTP of `symbol` if it is at most `max_age` seconds old, else None"""
+        with self.cond:
+            quote = self.quotes.get(symbol)
+        if quote is None or time.perf_counter() - quote[1] > max_age:
+            return None
+        return quote[0]
+
+    def latest(self, symbols, timeout):
+        """Wait up to `timeout` for fresh quotes of all `symbols`; return ({symbol: ltp}, requested_at) or (None, None)"""
+        deadline = time.perf_counter() + timeout
+        with self.cond:
+            while True:
+                now = time.perf_counter()
+                entries = [self.quotes.get(symbol) for symbol in symbols]
+                if all(entry is not None and now - entry[1] <= QUOTES_MAX_AGE for entry in entries):
+                    return {symbol: entry[0] for symbol, entry in zip(symbols, entries)}, min(e[1] for e in entries)
+                if now >= deadline:
+                    return None, None
+                self.cond.wait(deadline - now)
+
+    def _pick_client(self, usernames):
+        for i in range(len(usernames)):
+            username = usernames[(self._rotation + i) % len(usernames)]
+            fyers, _ = get_user_fyers_session(username)
+            if fyers is not None:
+                self._rotation = (self._rotation + i + 1) % len(usernames)
+                return fyers
+        return None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.subscriptions:
+                    self.cond.wait()
+                usernames = sorted(self.subscriptions)
+                symbols = sorted(set().union(*self.subscriptions.values()))
+
+            started = time.perf_counter()
+            fyers = self._pick_client(usernames)
+            if fyers is not None:
+                for i in range(0, len(symbols), self.max_symbols):
+                    chunk = symbols[i:i + self.max_symbols]
+                    try:
+                        response = broker_call('quotes', fyers.quotes, data={"symbols": ",".join(chunk)})
+                    except Exception as e:
+                        log_event(logging.ERROR, "Batched quotes failed", stage="fetch", error=str(e))
+                        continue
+                    increment_counter('feed_rows_total', len(chunk), feed="quotes")
+                    fresh = {}
+                    for item in response.get("d") or []:
+                        ltp = (item.get("v") or {}).get("lp")
+                        if item.get("s") == "ok" and ltp is not None:
+                            fresh[item.get("n")] = (float(ltp), started)
+                    with self.cond:
+                        self.quotes.update(fresh)
+                        self.cond.notify_all()
+                    prices = {symbol: ltp for symbol, (ltp, _) in fresh.items()}
+                    pnl_engine.on_prices(prices)
+                    paper_exchange.on_prices(prices)
+                observe_latency('pipeline_stage_seconds', time.perf_counter() - started, stage="fetch", source="quotes")
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - started)))
+
+
+quote_batcher = QuoteBatcher()
+
+
+def read_batched_leg_quotes(username, ce_target_strike, pe_target_strike, strike_symbols, timeout):
+    """Return ({leg: (strike, ltp)}, requested_at) from the quote batcher, or (None, None) to fall back to the chain"""
+    symbols = {}
+    for leg, strike in (("CE", ce_target_strike), ("PE", pe_target_strike)):
+        symbol = (strike_symbols or {}).get(strike, {}).get(leg)
+        if symbol is None:
+            quote_batcher.unsubscribe(username)
+            return None, None
+        symbols[leg] = symbol
+
+    # Open legs ride along so their MTM stays current between chain fetches
+    quote_batcher.subscribe(username, set(symbols.values()) | pnl_engine.symbols(username))
+    quotes, requested_at = quote_batcher.latest(list(symbols.values()), timeout)
+    if quotes is None:
+        return None, None
+    strikes = {"CE": ce_target_strike, "PE": pe_target_strike}
+    return {leg: (strikes[leg], quotes[symbol]) for leg, symbol in symbols.items()}, requested_at
+
+
+# ---- Strategy Rules ----
+METRIC_HELP['strategy_rules_fired_total'] = 'Strategy rules that fired and queued an order'
+
+STRATEGY_RULE_PATTERN = re.compile(
+    r"^(CE|PE)\s+ATM\s*(?:([+-])\s*(\d+))?\s+IF\s+(.+?)"
+    r"(?:\s+BETWEEN\s+(\d{1,2}:\d{2}(?::\d{2})?)\s+AND\s+(\d{1,2}:\d{2}(?::\d{2})?))?$", re.IGNORECASE)
+STRATEGY_CONDITION_PATTERN = re.compile(
+    r"^(ltp|oi|volume)(?:_(chg_pct|chg|roc|delta))?(?:\((\d+)\))?\s*(>=|<=|>|<)\s*(-?\d+(?:\.\d+)?)$", re.IGNORECASE)
+STRATEGY_METRIC_FIELDS = {'ltp': 'LTP', 'oi': 'OI', 'volume': 'Volume'}
+STRATEGY_KINDS = ('level', 'chg', 'chg_pct', 'roc', 'delta')  # roc/delta read the chain history
+STRATEGY_OPS = ('>', '>=', '<', '<=')
+
+
+class StrategyRule:
+    """One parsed rule, e.g. "CE ATM-300 if ltp_chg > 20 and oi_delta(30) > 0 between 09:20 and 14:30".
+
+    A condition compares a metric of the rule's leg at its ATM-relative
+    strike with a number. Metrics are ltp, oi and volume, either as is,
+    as `_chg` / `_chg_pct` against the ATM baseline, or as `_roc(N)` /
+    `_delta(N)` over the last N chain snapshots. All conditions must hold,
+    inside the optional time window. `rule_id` is derived from the text,
+    so a rule keeps its signal names when other rules are edited or moved.
+    """
+    __slots__ = ('text', 'rule_id', 'option_type', 'offset', 'conditions', 'start', 'end')
+
+    def __init__(self, text):
+        match = STRATEGY_RULE_PATTERN.match(text.strip())
+        if match is None:
+            raise ValueError(f"cannot parse rule {text!r}")
+        option_type, sign, offset, conditions, start, end = match.groups()
+        self.text = text.strip()
+        normalized = " ".join(self.text.upper().split())
+        self.rule_id = int(hashlib.sha256(normalized.encode()).hexdigest(), 16) % 100000
+        self.option_type = option_type.upper()
+        self.offset = int(offset or 0) * (-1 if sign == '-' else 1)
+        self.conditions = []
+        for condition in re.split(r"\s+AND\s+", conditions, flags=re.IGNORECASE):
+            cond = STRATEGY_CONDITION_PATTERN.match(condition.strip())
+            if cond is None:
+                raise ValueError(f"cannot parse condition {condition!r}")
+            metric, kind, window, op, threshold = cond.groups()
+            kind = (kind or 'level').lower()
+            if (kind in ('roc', 'delta')) != (window is not None):
+                raise ValueError(f"{condition!r}: a window (N) goes with _roc and _delta only")
+            if window is not None and not 0 < int(window) < CHAIN_HISTORY_SIZE:
+                raise ValueError(f"{condition!r}: window must be between 1 and {CHAIN_HISTORY_SIZE - 1}")
+            field = f"{self.option_type}_{STRATEGY_METRIC_FIELDS[metric.lower()]}"
+            self.conditions.append((field, kind, int(window or 0), op, float(threshold)))
+        self.start = self.end = None
+        if start:
+            self.start = _seconds_of_day(_parse_clock(start))
+            self.end = _seconds_of_day(_parse_clock(end))
+
+
+def _seconds_of_day(clock):
+    return clock.hour * 3600 + clock.minute * 60 + clock.second
+
+
+def parse_strategy_rules(values):
+    """Validated tuple of rule texts from a list or newline-separated text; raises ValueError on bad input"""
+    if isinstance(values, str):
+        values = values.splitlines()
+    texts = tuple(str(value).strip() for value in values or () if str(value).strip())
+    if len(texts) > STRATEGY_MAX_RULES:
+        raise ValueError(f"at most {STRATEGY_MAX_RULES} rules per user")
+    rule_ids = set()
+    for text in texts:
+        rule = StrategyRule(text)
+        if rule.rule_id in rule_ids:
+            raise ValueError(f"{text!r} repeats another rule (or shares its id; reword it)")
+        rule_ids.add(rule.rule_id)
+    return texts
+
+
+class CompiledRules:
+    """Many owners' rules flattened into NumPy arrays, one entry per rule and per condition.
+
+    `entries` lists (owner, state, rules): the state supplies the ATM and
+    baseline, the owner is handed back with each fired rule.
+    """
+
+    def __init__(self, key, entries):
+        rule_owner, rule_state, rule_rules, rule_strike = [], [], [], []
+        rule_ltp_field, rule_start, rule_end, rule_first = [], [], [], []
+        cond_strike, cond_field, cond_kind, cond_window, cond_op, cond_threshold, cond_base = [], [], [], [], [], [], []
+        baselines = {}
+        for owner, state, rules in entries:
+            atm_strike = state.atm_strike
+            baseline = baselines.get(id(state))
+            if baseline is None:
+                baseline = baselines[id(state)] = {row["strike_price"]: row for row in state.initial_data or ()}
+            for rule in rules:
+                strike = atm_strike + rule.offset
+                rule_owner.append(owner)
+                rule_state.append(state)
+                rule_rules.append(rule)
+                rule_strike.append(strike)
+                rule_ltp_field.append(CHAIN_FIELD_INDEX[f"{rule.option_type}_LTP"])
+                rule_start.append(0 if rule.start is None else rule.start)
+                rule_end.append(86400 if rule.end is None else rule.end)
+                rule_first.append(len(cond_strike))
+                base_row = baseline.get(strike, {})
+                for field, kind, window, op, threshold in rule.conditions:
+                    cond_strike.append(strike)
+                    cond_field.append(CHAIN_FIELD_INDEX[field])
+                    cond_kind.append(STRATEGY_KINDS.index(kind))
+                    cond_window.append(window)
+                    cond_op.append(STRATEGY_OPS.index(op))
+                    cond_threshold.append(threshold)
+                    base = base_row.get(field)
+                    cond_base.append(np.nan if base is None else base)
+
+        self.key = key
+        self.owners = rule_owner
+        self.states = rule_state
+        self.rules = rule_rules
+        self.rule_strike = np.array(rule_strike, dtype=float)
+        self.rule_ltp_field = np.array(rule_ltp_field, dtype=np.intp)
+        self.rule_start = np.array(rule_start)
+        self.rule_end = np.array(rule_end)
+        self.rule_first = np.array(rule_first, dtype=np.intp)
+        self.done = np.zeros(len(rule_state), dtype=bool)  # fired, or already placed
+        self.cond_strike = np.array(cond_strike, dtype=float)
+        self.cond_field = np.array(cond_field, dtype=np.intp)
+        self.cond_kind = np.array(cond_kind, dtype=np.intp)
+        self.cond_window = np.array(cond_window, dtype=np.intp)
+        self.cond_op = np.array(cond_op, dtype=np.intp)
+        self.cond_threshold = np.array(cond_threshold, dtype=float)
+        self.cond_base = np.array(cond_base, dtype=float)
+        # History-backed conditions grouped by (field, window), queried once per group
+        history = self.cond_kind >= STRATEGY_KINDS.index('roc')
+        self.history_groups = {}
+        for i in np.flatnonzero(history):
+            self.history_groups.setdefault((int(self.cond_field[i]), int(self.cond_window[i]), int(self.cond_kind[i])),
+                                           []).append(i)
+        self.history_groups = {group: np.array(rows, dtype=np.intp) for group, rows in self.history_groups.items()}
+
+    def __len__(self):
+        return len(self.states)
+
+    def evaluate(self, strikes, values, seconds):
+        """Indices of the rules that fire on a chain given as sorted strikes and values[strike, field]"""
+        pos = np.minimum(np.searchsorted(strikes, self.cond_strike), len(strikes) - 1)
+        current = np.where(strikes[pos] == self.cond_strike, values[pos, self.cond_field], np.nan)
+
+        base = self.cond_base
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lhs = np.select(
+                [self.cond_kind == 0, self.cond_kind == 1, self.cond_kind == 2],
+                [current, current - base, np.where(base > 0, (current - base) / base * 100, np.nan)],
+                np.nan)
+        for (field, window, kind), rows in self.history_groups.items():
+            query = chain_history.roc if STRATEGY_KINDS[kind] == 'roc' else chain_history.change
+            unique, inverse = np.unique(self.cond_strike[rows], return_inverse=True)
+            lhs[rows] = query(CHAIN_FIELDS[field], unique, window)[inverse]
+
+        threshold = self.cond_threshold
+        op = self.cond_op
+        ok = np.where(op == 0, lhs > threshold,
+                      np.where(op == 1, lhs >= threshold, np.where(op == 2, lhs < threshold, lhs <= threshold)))
+        fired = np.logical_and.reduceat(ok, self.rule_first)
+        fired &= ~self.done & (self.rule_start <= seconds) & (seconds < self.rule_end)
+        return np.flatnonzero(fired)
+
+
+class StrategyEngine:
+    """Evaluates the strategy rules of every running bot once per chain snapshot.
+
+    Users' rule texts are parsed when they are set. On a snapshot, the rules
+    of all running users are compiled into one CompiledRules (reused until a
+    user's rules, baseline or bot state change), every condition is
+    evaluated in a handful of NumPy operations and fired rules are claimed
+    and queued on the order submitter like offset signals.
+    """
+
+    def __init__(self):
+        self.rules = {}  # username -> (state, [StrategyRule])
+        self.compiled = None
+        self.lock = threading.Lock()
+
+    def set_rules(self, username, values):
+        """Validate and install a user's rules; raises ValueError on bad input"""
+        texts = parse_strategy_rules(values)
+        state = get_user_state(username)
+        parsed = [StrategyRule(text) for text in texts]
+        with self.lock:
+            state.strategy_rules = texts
+            if parsed:
+                self.rules[username] = (state, parsed)
+            else:
+                self.rules.pop(username, None)
+        return texts
+
+    def discard(self, username):
+        with self.lock:
+            self.rules.pop(username, None)
+
+    source = "rules"
+
+    def _entries(self):
+        """(owner, state, rules) for the users that can trade now"""
+        return [(state, state, parsed) for state, parsed in self.rules.values()
+                if state.bot_running and state.atm_strike is not None and state.fyers is not None]
+
+    def _compiled(self):
+        """Compiled rules of the current entries, rebuilt only when one of them changed"""
+        entries = self._entries()
+        key = tuple((id(owner), id(rules), state.atm_strike, id(state.initial_data)) for owner, state, rules in entries)
+        compiled = self.compiled
+        if compiled is None or compiled.key != key:
+            compiled = self.compiled = CompiledRules(key, entries)
+        return compiled
+
+    def evaluate(self, df_pivot, tick_start):
+        """Evaluate every entry's rules against one chain pivot and act on the fired ones"""
+        if not self.rules:
+            return
+        start = time.perf_counter()
+        with self.lock:
+            compiled = self._compiled()
+            if not len(compiled):
+                return
+            strikes = df_pivot["strike_price"].to_numpy(dtype=float)
+            order = np.argsort(strikes)
+            strikes = strikes[order]
+            values = df_pivot[list(CHAIN_FIELDS)].to_numpy(dtype=float)[order]
+            now = trading_calendar.now()
+            fired = compiled.evaluate(strikes, values, _seconds_of_day(now))
+            compiled.done[fired] = True
+        observe_latency('pipeline_stage_seconds', time.perf_counter() - start, stage="evaluate", source=self.source)
+
+        for i in fired:
+            strike = compiled.rule_strike[i]
+            strike = int(strike) if strike.is_integer() else float(strike)
+            option_type = CHAIN_FIELDS[compiled.rule_ltp_field[i]][:2]
+            ltp = float(values[np.searchsorted(strikes, strike), compiled.rule_ltp_field[i]])
+            self._fire(compiled.owners[i], compiled.states[i], compiled.rules[i], strike, option_type, ltp,
+                       tick_start)
+
+    def _fire(self, owner, state, rule, strike, option_type, ltp, tick_start):
+        """Claim a fired rule's signal and queue its order"""
+        signal_name = f"{option_type}_RULE{rule.rule_id}_{strike}"
+        if kill_switch.blocks(state.username, signal_name, "rules"):
+            return
+        if not state.record_signal(signal_name, f"{strike} {ltp} {option_type} Rule {rule.rule_id}"):
+            return
+        mark_state_dirty(state.username)
+        increment_counter('strategy_rules_fired_total')
+        log_event(logging.INFO, "Strategy rule fired", user=state.username, stage="rules",
+                  signal=signal_name, rule=rule.text, ltp=ltp)
+        order_submitter.submit(state, signal_name, strike, option_type, ltp, tick_start, source="rules")
+
+    def describe(self, username):
+        entry = self.rules.get(username)
+        if entry is None:
+            return []
+        state, parsed = entry
+        return [{
+            "rule": rule.text,
+            "signal": f"{rule.option_type}_RULE{rule.rule_id}_{state.atm_strike + rule.offset}"
+            if state.atm_strike is not None else None,
+            "fired": state.atm_strike is not None and
+            f"{rule.option_type}_RULE{rule.rule_id}_{state.atm_strike + rule.offset}" in state.placed_orders,
+        } for rule in parsed]
+
+
+strategy_engine = StrategyEngine()
+
+
+# ---- Shadow Strategies ----
+METRIC_HELP['shadow_signals_total'] = 'Hypothetical signals fired by shadow strategy variants'
+SHADOW_FIELDS = ('ce_strike_offset', 'pe_strike_offset', 'ce_threshold', 'pe_threshold')
+
+
+class ShadowConfig:
+    """One what-if variant of a user's offset strategy and the signals it would have fired.
+
+    The variant is compiled into two strategy rules (CE and PE: LTP above
+    the baseline plus the threshold at ATM plus the offset), so shadows are
+    evaluated in the same batch as every other shadow on the shared chain
+    snapshot. Fills are hypothetical, at the LTP of the firing snapshot,
+    are checkpointed with the user's state and are cleared whenever the
+    user's baseline changes.
+    """
+    __slots__ = ('name', 'config', 'rules', 'baseline', 'placed', 'fills')
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.rules = [StrategyRule(text) for text in shadow_rule_texts(config)]
+        self.baseline = None
+        self.placed = set()
+        self.fills = []  # (signal_name, strike, option_type, entry, wall time)
+
+    def follow_baseline(self, state):
+        """Forget the fills of an earlier baseline"""
+        marker = (state.atm_strike, id(state.initial_data))
+        if self.baseline != marker:
+            self.baseline = marker
+            self.placed = set()
+            self.fills = []
+
+    def to_dict(self):
+        return dict(self.config, name=self.name)
+
+
+def shadow_rule_texts(config):
+    """CE and PE strategy rule texts of a shadow config; thresholds in fixed-point so the rule grammar accepts them"""
+    return [
+        f"{leg} ATM{int(config[f'{leg.lower()}_strike_offset']):+d} if ltp_chg > "
+        f"{np.format_float_positional(config[f'{leg.lower()}_threshold'], trim='-')}"
+        for leg in ("CE", "PE")
+    ]
+
+
+def parse_shadow_configs(values, state):
+    """Validated shadow configs from request values; unset fields default to the live settings"""
+    if not isinstance(values, (list, tuple)):
+        raise ValueError("shadows must be a list")
+    if len(values) > SHADOW_MAX_CONFIGS:
+        raise ValueError(f"at most {SHADOW_MAX_CONFIGS} shadow configs per user")
+    defaults = {
+        'ce_strike_offset': state.ce_strike_offset,
+        'pe_strike_offset': state.pe_strike_offset,
+        'ce_threshold': FIXED_CE_THRESHOLD,
+        'pe_threshold': FIXED_PE_THRESHOLD,
+    }
+    configs = []
+    for i, values in enumerate(values):
+        if not isinstance(values, dict):
+            raise ValueError("each shadow must be an object")
+        name = str(values.get('name') or f"shadow{i + 1}").strip()
+        if any(name == config['name'] for config in configs):
+            raise ValueError(f"duplicate shadow name {name!r}")
+        config = {'name': name}
+        for field in SHADOW_FIELDS:
+            value = values.get(field)
+            value = defaults[field] if value is None or str(value).strip() == "" else value
+            config[field] = int(value) if field.endswith('offset') else float(value)
+            if not np.isfinite(config[field]):
+                raise ValueError(f"{name}: {field} must be a finite number")
+        for text in shadow_rule_texts(config):
+            StrategyRule(text)
+        configs.append(config)
+    return configs
+
+
+class ShadowEngine(StrategyEngine):
+    """Strategy engine for shadow variants: fired rules become hypothetical fills, never orders.
+
+    Shadows run whenever their user has a baseline, bot or not. Adding a
+    shadow adds two rules to the batch, so its marginal cost per snapshot
+    is a few array elements.
+    """
+    source = "shadow"
+
+    def set_shadows(self, username, configs):
+        """Install a user's shadow configs, keeping the fills of variants whose settings did not change"""
+        state = get_user_state(username)
+        with self.lock:
+            previous = {shadow.name: shadow for shadow in self.rules.get(username, (None, ()))[1]}
+            shadows = []
+            for config in configs:
+                name = config['name']
+                settings = {field: config[field] for field in SHADOW_FIELDS}
+                shadow = previous.get(name)
+                if shadow is None or shadow.config != settings:
+                    shadow = ShadowConfig(name, settings)
+                shadows.append(shadow)
+            state.shadow_configs = tuple(shadow.to_dict() for shadow in shadows)
+            if shadows:
+                self.rules[username] = (state, shadows)
+            else:
+                self.rules.pop(username, None)
+        return state.shadow_configs
+
+    def _entries(self):
+        entries = []
+        for state, shadows in self.rules.values():
+            if state.atm_strike is None:
                 continue
+            for shadow in shadows:
+                shadow.follow_baseline(state)
+                entries.append((shadow, state, shadow.rules))
+        return entries
+
+    def _fire(self, owner, state, rule, strike, option_type, ltp, tick_start):
+        signal_name = f"{option_type}_OFFSET_{strike}"
+        if signal_name in owner.placed:
+            return
+        owner.placed.add(signal_name)
+        owner.fills.append((signal_name, strike, option_type, ltp, time.time()))
+        mark_state_dirty(state.username)
+        increment_counter('shadow_signals_total')
+        log_event(logging.INFO, "Shadow signal", user=state.username, stage="shadow", shadow=owner.name,
+                  signal=signal_name, ltp=ltp)
+
+    def fills(self, username):
+        """{shadow name: [fill, ...]} for the state checkpoint"""
+        with self.lock:
+            shadows = self.rules.get(username, (None, ()))[1]
+            return {shadow.name: [list(fill) for fill in shadow.fills] for shadow in shadows}
+
+    def restore_fills(self, username, fills):
+        """Reinstate checkpointed fills; they belong to the baseline the state was restored with"""
+        with self.lock:
+            entry = self.rules.get(username)
+            if entry is None:
+                return
+            state, shadows = entry
+            for shadow in shadows:
+                restored = [tuple(fill) for fill in fills.get(shadow.name) or ()]
+                if restored and state.atm_strike is not None:
+                    shadow.baseline = (state.atm_strike, id(state.initial_data))
+                    shadow.fills = restored
+                    shadow.placed = {fill[0] for fill in restored}
+
+    def describe(self, username):
+        """Each shadow's settings, hypothetical fills and their MTM against the latest chain snapshot"""
+        entry = self.rules.get(username)
+        if entry is None:
+            return []
+        state, shadows = entry
+        snapshot = chain_cache.snapshot
+        ltps = {}
+        if snapshot is not None:
+            for row in snapshot.df_pivot[["strike_price", "CE_LTP", "PE_LTP"]].itertuples(index=False):
+                ltps[(row.strike_price, "CE")] = row.CE_LTP
+                ltps[(row.strike_price, "PE")] = row.PE_LTP
+        qty = signal_order_payload(username, "", side=1)["qty"]
+        result = []
+        for shadow in shadows:
+            fills, total = [], 0.0
+            for signal_name, strike, option_type, entry_price, at in list(shadow.fills):
+                ltp = ltps.get((strike, option_type))
+                mtm = None if ltp is None or pd.isna(ltp) else round((float(ltp) - entry_price) * qty, 2)
+                total += mtm or 0.0
+                fills.append({"signal": signal_name, "strike": strike, "option_type": option_type,
+                              "entry": entry_price, "ltp": None if mtm is None else float(ltp), "qty": qty,
+                              "mtm": mtm, "time": datetime.fromtimestamp(at, MARKET_TIMEZONE).isoformat()})
+            result.append(dict(shadow.to_dict(), fills=fills, pnl=round(total, 2)))
+        return result
+
+
+shadow_engine = ShadowEngine()
+
+
+# ---- Bot Pipeline ----
+METRIC_HELP['pipeline_snapshots_dropped_total'] = 'Market snapshots replaced by a newer one before the evaluate stage took them'
+
+
+class BotSnapshot:
+    """Market data captured by one poll, handed from the fetch stage to the evaluate stage"""
+    __slots__ = ('tick_start', 'fetched_at', 'response', 'legs')
+
+    def __init__(self, tick_start, fetched_at, response=None, legs=None):
+        self.tick_start = tick_start
+        self.fetched_at = fetched_at
+        self.response = response  # optionchain payload, when the whole chain was fetched
+        self.legs = legs          # {leg: (strike, ltp)}, when only the offset legs were quoted
+
+
+class LatestSlot:
+    """Single-item hand-off between two pipeline stages.
+
+    `put` replaces an item the consumer has not taken yet, so the consumer
+    always works on the newest snapshot and a slow consumer never holds up
+    the producer. Replaced items are counted as dropped.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.item = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        with self.cond:
+            if self.item is not None:
+                increment_counter('pipeline_snapshots_dropped_total', stage=self.name)
+            self.item = item
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get(self):
+        """Block until an item is available; None once the slot is closed"""
+        with self.cond:
+            while self.item is None and not self.closed:
+                self.cond.wait()
+            item, self.item = self.item, None
+            return item
+
+
+class OrderSubmitter:
+    """Worker pool that sends the fired signal orders of every bot.
+
+    Evaluate stages enqueue an order and move on, so a slow broker response
+    delays neither the other leg's check nor the next poll. The queue is
+    bounded: if the broker falls far behind, `submit` blocks the evaluate
+    stage instead of letting orders pile up.
+    """
+
+    def __init__(self, workers=ORDER_SUBMIT_WORKERS, maxsize=ORDER_SUBMIT_QUEUE_SIZE):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(max(1, self.workers)):
+                thread = threading.Thread(target=self._run, name=f"order-submit-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, state, signal_name, strike, option_type, ltp, tick_start, source):
+        """Queue a claimed signal for submission"""
+        if not self.threads:
+            self.start()
+        self.queue.put((state, signal_name, strike, option_type, ltp, tick_start, source, time.perf_counter()))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            state, signal_name, strike, option_type, ltp, tick_start, source, queued_at = self.queue.get()
+            try:
+                submit_start = time.perf_counter()
+                submit_signal_order(state, signal_name, strike, option_type, ltp)
+                submitted_at = time.perf_counter()
+                observe_latency('pipeline_stage_seconds', submit_start - queued_at, stage="queue", source=source)
+                observe_latency('pipeline_stage_seconds', submitted_at - submit_start, stage="submit", source=source)
+                observe_latency('pipeline_stage_seconds', submitted_at - tick_start, stage="tick_to_order", source=source)
+                log_event(logging.INFO, "Signal fired - order sent", user=state.username, stage="tick_to_order",
+                          signal=signal_name, strike=strike, option_type=option_type, ltp=ltp,
+                          latency_ms=(submitted_at - tick_start) * 1000)
+            except Exception as e:
+                log_event(logging.ERROR, "Order submit worker error", user=state.username, stage="submit",
+                          signal=signal_name, error=str(e))
+            finally:
+                self.queue.task_done()
+
+
+order_submitter = OrderSubmitter()
+
+
+def refresh_shared_chain(fyers):
+    """Fetch the shared chain snapshot once it is BOT_CHAIN_REFRESH_TTLS old, so chain history, analytics
+    and the marks of legs outside the quote subscriptions keep moving while bots run on quotes"""
+    snapshot = chain_cache.snapshot
+    if snapshot is not None and time.perf_counter() - snapshot.fetched_at <= CHAIN_CACHE_TTL * BOT_CHAIN_REFRESH_TTLS:
+        return
+    snapshot, error = chain_cache.get(fyers)
+    if snapshot is None:
+        log_event(logging.WARNING, "Shared chain refresh failed", stage="fetch", error=error)
+        return
+    pnl_engine.on_chain(snapshot.options_data)
+
+
+def fetch_bot_snapshot(username, state, fyers, cadence):
+    """Fetch stage: quote the offset legs after the baseline, else pull the whole chain; None on a bad response"""
+    atm_strike = state.atm_strike
+    if atm_strike is not None and BOT_FEED_MODE == "quotes" and not state.strategy_rules and not state.shadow_configs:
+        refresh_shared_chain(fyers)
+        tick_start = time.perf_counter()
+        legs, quoted_at = read_batched_leg_quotes(
+            username, atm_strike + state.ce_strike_offset, atm_strike + state.pe_strike_offset,
+            state.strike_symbols, timeout=QUOTES_MAX_AGE)
+        if legs is not None:
+            # The tick starts when the bot reads the quote; how long it sat in the cache is its own stage
+            observe_latency('pipeline_stage_seconds', max(0.0, tick_start - quoted_at), stage="quote_age", source="bot")
+            return BotSnapshot(tick_start, time.perf_counter(), legs=legs)
+
+    tick_start = time.perf_counter()
+    cadence.record_poll()
+    # Without a baseline this fetch captures it, so it must be full width
+    response = broker_call('optionchain', fyers.optionchain, data=strike_window.request(baseline=atm_strike is None))
+    fetched_at = time.perf_counter()
+    observe_latency('pipeline_stage_seconds', fetched_at - tick_start, stage="fetch", source="bot")
+
+    if "data" not in response or "optionsChain" not in response["data"]:
+        log_event(logging.WARNING, "Invalid response from API", user=username, stage="fetch")
+        return None
 
-            df = pd.DataFrame(options_data)
-            
-            ce_df = df[df['option_type'] == 'CE'].copy()
-            pe_df = df[df['option_type'] == 'PE'].copy()
-            
-            df_pivot = pd.merge(
-                ce_df[['strike_price', 'ltp', 'oi', 'volume']],
-                pe_df[['strike_price', 'ltp', 'oi', 'volume']],
-                on='strike_price',
-                suffixes=('_CE', '_PE')
-            )
-            
-            df_pivot = df_pivot.rename(columns={
-                'ltp_CE': 'CE_LTP',
-                'oi_CE': 'CE_OI',
-                'volume_CE': 'CE_Volume',
-                'ltp_PE': 'PE_LTP',
-                'oi_PE': 'PE_OI',
-                'volume_PE': 'PE_Volume'
-            })
-
-            # ATM detection
-            if atm_strike is None:
-                nifty_spot = response["data"].get(
-                    "underlyingValue",
-                    df_pivot["strike_price"].iloc[len(df_pivot) // 2]
-                )
-                atm_strike = min(df_pivot["strike_price"], key=lambda x: abs(x - nifty_spot))
-                initial_data = df_pivot.to_dict(orient="records")
-                signals.clear()
-                placed_orders.clear()
-                set_user_data(username, 'atm_strike', atm_strike)
-                set_user_data(username, 'initial_data', initial_data)
-                set_user_data(username, 'signals', signals)
-                set_user_data(username, 'placed_orders', placed_orders)
-                print(f"{username}: 📍 ATM Strike detected: {atm_strike}")
-
-            # Calculate target strikes
-            ce_target_strike = atm_strike + ce_strike_offset
-            pe_target_strike = atm_strike + pe_strike_offset
-
-            # Order placement for offset strikes
-            for row in df_pivot.itertuples():
-                strike = row.strike_price
-                ce_ltp = getattr(row, "CE_LTP", None)
-                pe_ltp = getattr(row, "PE_LTP", None)
-
-                # CE order at offset strike (using fixed threshold)
-                if strike == ce_target_strike and ce_ltp is not None:
-                    initial_ce = next((item["CE_LTP"] for item in initial_data if item["strike_price"] == strike), None)
-                    if initial_ce is not None and ce_ltp > initial_ce + FIXED_CE_THRESHOLD:
-                        signal_name = f"CE_OFFSET_{strike}"
-                        if signal_name not in placed_orders:
-                            signals.append(f"{strike} {ce_ltp} CE Offset Strike")
-                            print(f"{username}: 🚨 Signal: {signal_name} - Placing order")
-                            place_order(username, f"{symbol_prefix}{strike}CE", ce_ltp, side=1)
-                            placed_orders.add(signal_name)
-                            set_user_data(username, 'signals', signals)
-                            set_user_data(username, 'placed_orders', placed_orders)
-
-                # PE order at offset strike (using fixed threshold)
-                if strike == pe_target_strike and pe_ltp is not None:
-                    initial_pe = next((item["PE_LTP"] for item in initial_data if item["strike_price"] == strike), None)
-                    if initial_pe is not None and pe_ltp > initial_pe + FIXED_PE_THRESHOLD:
-                        signal_name = f"PE_OFFSET_{strike}"
-                        if signal_name not in placed_orders:
-                            signals.append(f"{strike} {pe_ltp} PE Offset Strike")
-                            print(f"{username}: 🚨 Signal: {signal_name} - Placing order")
-                            place_order(username, f"{symbol_prefix}{strike}PE", pe_ltp, side=1)
-                            placed_orders.add(signal_name)
-                            set_user_data(username, 'signals', signals)
-                            set_user_data(username, 'placed_orders', placed_orders)
+    options_data = response["data"]["optionsChain"]
+    if not options_data:
+        log_event(logging.WARNING, "No options data found", user=username, stage="fetch")
+        return None
+    increment_counter('feed_rows_total', len(options_data), feed="chain")
+    pnl_engine.on_chain(options_data)
+    return BotSnapshot(tick_start, fetched_at, response=response)
+
+
+def evaluate_bot_snapshot(username, state, snapshot):
+    """Pivot and evaluate stages: turn a snapshot into leg quotes and queue the fired signals"""
+    atm_strike = state.atm_strike
+    legs = snapshot.legs
+    pivoted_at = snapshot.fetched_at
 
+    if legs is None:
+        options_data = snapshot.response["data"]["optionsChain"]
+        df_pivot = build_option_pivot(options_data)
+        pivoted_at = time.perf_counter()
+        observe_latency('pipeline_stage_seconds', pivoted_at - snapshot.fetched_at, stage="pivot", source="bot")
+        chain_cache.publish(snapshot.response, snapshot.fetched_at, df_pivot)
+
+        # ATM detection
+        if atm_strike is None:
+            atm_strike = detect_atm_strike(snapshot.response["data"], df_pivot)
+            state.set_baseline(atm_strike, df_pivot.to_dict(orient="records"), chain_symbol_map(options_data),
+                               trading_calendar.now().date())
+            mark_state_dirty(username)
+            log_event(logging.INFO, "ATM strike detected", user=username, stage="baseline", atm_strike=atm_strike)
+            stage_signal_orders(state)
+
+        legs = pivot_leg_quotes(df_pivot, atm_strike + state.ce_strike_offset, atm_strike + state.pe_strike_offset)
+    elif atm_strike is None:
+        return  # the baseline was reset after these quotes were read
+
+    fired, gaps = evaluate_offset_legs(legs, state.initial_data, state.placed_orders)
+    evaluated_at = time.perf_counter()
+    observe_latency('pipeline_stage_seconds', evaluated_at - pivoted_at, stage="evaluate", source="bot")
+
+    for signal_name, strike, ltp, option_type in fired:
+        if kill_switch.blocks(username, signal_name, "bot"):
+            continue
+        if not state.record_signal(signal_name, f"{strike} {ltp} {option_type} Offset Strike"):
+            continue
+        mark_state_dirty(username)
+        order_submitter.submit(state, signal_name, strike, option_type, ltp, snapshot.tick_start, source="bot")
+
+    state.cadence.observe({leg: ltp for leg, (strike, ltp) in legs.items()}, gaps)
+
+
+def bot_evaluate_worker(username, state, slot):
+    """Evaluate-stage thread of one bot: always works on the newest snapshot"""
+    while True:
+        snapshot = slot.get()
+        if snapshot is None:
+            return
+        try:
+            evaluate_bot_snapshot(username, state, snapshot)
         except Exception as e:
-            print(f"❌ Background bot error for {username}: {e}")
+            log_event(logging.ERROR, "Bot evaluate error", user=username, stage="evaluate", error=str(e))
 
-        time.sleep(2)
 
-    print(f"🤖 Background bot stopped for {username}")
+def background_bot_worker(username):
+    """Background thread for specific user: the fetch stage of its bot pipeline"""
+    log_event(logging.INFO, "Background bot started", user=username, stage="bot")
+    state = get_user_state(username)
+    cadence = PollCadence()
+    state.cadence = cadence
+    snapshots = LatestSlot("evaluate")
+    evaluator = threading.Thread(target=bot_evaluate_worker, args=(username, state, snapshots), daemon=True)
+    evaluator.start()
+
+    try:
+        while state.bot_running:
+            snapshot = None
+            try:
+                if not park_bot_until_market(username):
+                    continue
+
+                fyers, _ = get_user_fyers_session(username)
+                if fyers is None:
+                    log_event(logging.WARNING, "Waiting for Fyers login", user=username, stage="bot")
+                    sleep_while_running(username, 5)
+                    continue
+
+                # A new session gets a fresh baseline, captured at BASELINE_CAPTURE_TIME
+                today = trading_calendar.now().date()
+                baseline_date = state.baseline_date
+                if baseline_date is not None and baseline_date != today:
+                    reset_baseline(username)
+                if state.atm_strike is None:
+                    capture_in = (trading_calendar.baseline_time(today) - trading_calendar.now()).total_seconds()
+                    if capture_in > 0:
+                        sleep_while_running(username, capture_in, step=min(1.0, capture_in))
+                        continue
+
+                stage_signal_orders(state)
+                snapshot = fetch_bot_snapshot(username, state, fyers, cadence)
+            except Exception as e:
+                log_event(logging.ERROR, "Background bot error", user=username, stage="fetch", error=str(e))
+
+            if snapshot is not None:
+                snapshots.put(snapshot)
+            sleep_while_running(username, cadence.next_interval(cadence.gaps, failed=snapshot is None), step=0.25)
+    finally:
+        # Never leave the evaluate stage waiting on a bot that is gone
+        snapshots.close()
+        quote_batcher.unsubscribe(username)
+    log_event(logging.INFO, "Background bot stopped", user=username, stage="bot")
+
+
+def start_bot_thread(username):
+    """Mark the user's bot as running and start its worker thread"""
+    set_user_data(username, 'bot_running', True)
+    bot_thread = threading.Thread(target=background_bot_worker, args=(username,), daemon=True)
+    bot_thread.start()
+    set_user_data(username, 'bot_thread', bot_thread)
 
 
 # ---- HTML Templates ----
@@ -761,6 +5295,22 @@ SIGNUP_TEMPLATE = """
 # ---- Load active sessions on startup ----
 active_user_sessions = load_active_sessions()
 
+# ---- Request Metrics ----
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        observe_latency('http_request_seconds', time.perf_counter() - start, route=route)
+        increment_counter('http_requests_total', route=route, method=request.method, status=response.status_code)
+    return response
+
+
 # ---- Routes ----
 @app.route("/")
 def home():
@@ -832,16 +5382,9 @@ def signin():
 def logout():
     username = session.get('username')
     if username:
-        # Stop bot if running
-        if username in user_sessions and user_sessions[username].get('bot_running'):
-            user_sessions[username]['bot_running'] = False
-        
-        # Invalidate session
-        invalidate_user_session(username)
-        
-        # Clear user session data
-        if username in user_sessions:
-            del user_sessions[username]
+        # Invalidate session (stops the bot and clears user session data)
+        if invalidate_user_session(username) is None:
+            drop_user_state(username)
     
     # Clear Flask session
     session.clear()
@@ -915,6 +5458,8 @@ def index():
         prefix = request.form.get("symbol_prefix")
         if prefix:
             set_user_data(username, 'symbol_prefix', prefix.strip())
+        # Re-stage the signal orders now rather than on the next tick
+        stage_signal_orders(get_user_state(username))
 
     return render_template_string(
         TEMPLATE,
@@ -944,60 +5489,29 @@ def fetch_option_chain():
     
     try:
         # Get user-specific data
-        atm_strike = get_user_data(username, 'atm_strike')
-        initial_data = get_user_data(username, 'initial_data')
-        symbol_prefix = get_user_data(username, 'symbol_prefix')
-        ce_strike_offset = get_user_data(username, 'ce_strike_offset')
-        pe_strike_offset = get_user_data(username, 'pe_strike_offset')
-        signals = get_user_data(username, 'signals')
-        placed_orders = get_user_data(username, 'placed_orders')
-        bot_running = get_user_data(username, 'bot_running')
-
-        data = {"symbol": "NSE:NIFTY50-INDEX", "strikecount": 20, "timestamp": ""}
-        response = fyers.optionchain(data=data)
-
-        if "data" not in response or "optionsChain" not in response["data"]:
-            return jsonify({"error": f"Invalid response from API: {response}"})
-
-        options_data = response["data"]["optionsChain"]
-        if not options_data:
-            return jsonify({"error": "No options data found!"})
-
-        df = pd.DataFrame(options_data)
-        
-        ce_df = df[df['option_type'] == 'CE'].copy()
-        pe_df = df[df['option_type'] == 'PE'].copy()
-        
-        df_pivot = pd.merge(
-            ce_df[['strike_price', 'ltp', 'oi', 'volume']],
-            pe_df[['strike_price', 'ltp', 'oi', 'volume']],
-            on='strike_price',
-            suffixes=('_CE', '_PE')
-        )
-        
-        df_pivot = df_pivot.rename(columns={
-            'ltp_CE': 'CE_LTP',
-            'oi_CE': 'CE_OI',
-            'volume_CE': 'CE_Volume',
-            'ltp_PE': 'PE_LTP',
-            'oi_PE': 'PE_OI',
-            'volume_PE': 'PE_Volume'
-        })
+        state = get_user_state(username)
+        atm_strike = state.atm_strike
+        initial_data = state.initial_data
+        ce_strike_offset = state.ce_strike_offset
+        pe_strike_offset = state.pe_strike_offset
+        bot_running = state.bot_running
+
+        tick_start = time.perf_counter()
+        snapshot, error = chain_cache.get(fyers, baseline=atm_strike is None)
+        if snapshot is None:
+            return jsonify({"error": error})
+        response, options_data, df_pivot = snapshot.response, snapshot.options_data, snapshot.df_pivot
+        pnl_engine.on_chain(options_data)
+        pivoted_at = time.perf_counter()
 
         # ATM detection
         if atm_strike is None:
-            nifty_spot = response["data"].get(
-                "underlyingValue",
-                df_pivot["strike_price"].iloc[len(df_pivot) // 2]
-            )
-            atm_strike = min(df_pivot["strike_price"], key=lambda x: abs(x - nifty_spot))
+            atm_strike = detect_atm_strike(response["data"], df_pivot)
             initial_data = df_pivot.to_dict(orient="records")
-            signals.clear()
-            placed_orders.clear()
-            set_user_data(username, 'atm_strike', atm_strike)
-            set_user_data(username, 'initial_data', initial_data)
-            set_user_data(username, 'signals', signals)
-            set_user_data(username, 'placed_orders', placed_orders)
+            state.set_baseline(atm_strike, initial_data, chain_symbol_map(options_data),
+                               trading_calendar.now().date())
+            mark_state_dirty(username)
+        stage_signal_orders(state)
 
         # Calculate target strikes
         ce_target_strike = atm_strike + ce_strike_offset
@@ -1005,36 +5519,44 @@ def fetch_option_chain():
 
         # Order placement for offset strikes (only if bot not running)
         if not bot_running:
-            for row in df_pivot.itertuples():
-                strike = row.strike_price
-                ce_ltp = getattr(row, "CE_LTP", None)
-                pe_ltp = getattr(row, "PE_LTP", None)
-
-                # CE order at offset strike (using fixed threshold)
-                if strike == ce_target_strike and ce_ltp is not None:
-                    initial_ce = next((item["CE_LTP"] for item in initial_data if item["strike_price"] == strike), None)
-                    if initial_ce is not None and ce_ltp > initial_ce + FIXED_CE_THRESHOLD:
-                        signal_name = f"CE_OFFSET_{strike}"
-                        if signal_name not in placed_orders:
-                            signals.append(f"{strike} {ce_ltp} CE Offset Strike")
-                            place_order(username, f"{symbol_prefix}{strike}CE", ce_ltp, side=1)
-                            placed_orders.add(signal_name)
-                            set_user_data(username, 'signals', signals)
-                            set_user_data(username, 'placed_orders', placed_orders)
-
-                # PE order at offset strike (using fixed threshold)
-                if strike == pe_target_strike and pe_ltp is not None:
-                    initial_pe = next((item["PE_LTP"] for item in initial_data if item["strike_price"] == strike), None)
-                    if initial_pe is not None and pe_ltp > initial_pe + FIXED_PE_THRESHOLD:
-                        signal_name = f"PE_OFFSET_{strike}"
-                        if signal_name not in placed_orders:
-                            signals.append(f"{strike} {pe_ltp} PE Offset Strike")
-                            place_order(username, f"{symbol_prefix}{strike}PE", pe_ltp, side=1)
-                            placed_orders.add(signal_name)
-                            set_user_data(username, 'signals', signals)
-                            set_user_data(username, 'placed_orders', placed_orders)
-
-        return df_pivot.to_json(orient="records")
+            fired = find_offset_signals(df_pivot, initial_data, ce_target_strike, pe_target_strike, state.placed_orders)
+            evaluated_at = time.perf_counter()
+            observe_latency('pipeline_stage_seconds', evaluated_at - pivoted_at, stage="evaluate", source="fetch")
+            for signal_name, strike, ltp, option_type in fired:
+                if kill_switch.blocks(username, signal_name, "fetch"):
+                    continue
+                if not state.record_signal(signal_name, f"{strike} {ltp} {option_type} Offset Strike"):
+                    continue
+                mark_state_dirty(username)
+                order_submitter.submit(state, signal_name, strike, option_type, ltp, tick_start, source="fetch")
+
+        return snapshot.to_json()
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+
+@app.route("/analytics")
+def option_analytics():
+    """IV, Greeks, PCR and max pain of the shared option chain snapshot"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    fyers, _ = get_user_fyers_session(username)
+
+    if fyers is None:
+        return jsonify({"error": "⚠ Please login to Fyers first!"})
+
+    try:
+        snapshot, error = chain_cache.get(fyers)
+        if snapshot is None:
+            return jsonify({"error": error})
+        return jsonify(snapshot.analytics())
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -1057,8 +5579,9 @@ def get_positions():
         return jsonify({"error": "⚠ Please login to Fyers first!"})
     
     try:
-        positions = fyers.positions()
+        positions = broker_call('positions', fyers.positions)
         if positions and "netPositions" in positions:
+            pnl_engine.sync(username, positions["netPositions"])
             open_positions = [pos for pos in positions["netPositions"] if int(pos.get("netQty", 0)) != 0]
             return jsonify({"positions": open_positions})
         return jsonify({"positions": []})
@@ -1066,6 +5589,209 @@ def get_positions():
         return jsonify({"error": str(e)})
 
 
+@app.route("/pnl")
+def get_pnl():
+    """Live P&L of the user's open legs, marked from the latest market data"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    return jsonify(dict(pnl_engine.snapshot(username), working_orders=order_chaser.working(username)))
+
+
+@app.route("/orders")
+def get_orders():
+    """The user's live order and fill state as kept from the order stream"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    return jsonify(dict(order_store.snapshot(username), stream_live=order_stream.is_live(username)))
+
+
+@app.route("/exit_rules", methods=["GET", "POST"])
+def exit_rules():
+    """View or update the user's exit rules, their armed levels and recent triggers"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    state = get_user_state(username)
+    if request.method == "POST":
+        try:
+            config = parse_exit_rules(request.get_json(silent=True) or request.form, state.exit_rules)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid exit rules: {e}"})
+        set_user_data(username, 'exit_rules', config)
+        exit_engine.rearm_user(username)
+        log_event(logging.INFO, "Exit rules updated", user=username, stage="exit", **config)
+
+    return jsonify(dict(exit_engine.describe(username), config=state.exit_rules))
+
+
+@app.route("/strategy_rules", methods=["GET", "POST"])
+def strategy_rules():
+    """View or replace the user's strategy rules"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    if request.method == "POST":
+        values = request.get_json(silent=True) or request.form
+        if not hasattr(values, "get"):
+            return jsonify({"error": "Invalid strategy rules: expected an object with a \"rules\" field"})
+        try:
+            rules = strategy_engine.set_rules(username, values.get("rules"))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid strategy rules: {e}"})
+        mark_state_dirty(username)
+        log_event(logging.INFO, "Strategy rules updated", user=username, stage="rules", rules=list(rules))
+
+    return jsonify({"rules": strategy_engine.describe(username)})
+
+
+@app.route("/shadows", methods=["GET", "POST"])
+def shadows():
+    """View or replace the user's shadow strategy variants and their hypothetical P&L"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    if request.method == "POST":
+        values = request.get_json(silent=True) or {}
+        if not isinstance(values, dict):
+            return jsonify({"error": "Invalid shadow configs: expected an object with a \"shadows\" field"})
+        try:
+            configs = parse_shadow_configs(values.get("shadows", []), get_user_state(username))
+            shadow_engine.set_shadows(username, configs)
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": f"Invalid shadow configs: {e}"})
+        mark_state_dirty(username)
+        log_event(logging.INFO, "Shadow configs updated", user=username, stage="shadow",
+                  shadows=[config['name'] for config in configs])
+
+    return jsonify({"shadows": shadow_engine.describe(username)})
+
+
+@app.route("/paper", methods=["GET", "POST"])
+def paper_trading():
+    """Switch the user between live and paper trading, or view the paper account"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    state = get_user_state(username)
+    if request.method == "POST":
+        values = request.get_json(silent=True) or request.form
+        if str(values.get("reset", "")).lower() in ("1", "true", "on"):
+            paper_exchange.reset(username)
+            order_store.discard(username)
+            if state.paper_mode:
+                pnl_engine.sync(username, [])
+        enabled = str(values.get("enabled", state.paper_mode)).lower() in ("1", "true", "on")
+        if enabled != state.paper_mode:
+            try:
+                state.set_paper_mode(enabled)
+            except ValueError as e:
+                return jsonify({"error": f"⚠ {e}"})
+            mark_state_dirty(username)
+            stage_signal_orders(state)
+            log_event(logging.INFO, "Paper trading " + ("enabled" if enabled else "disabled"),
+                      user=username, stage="paper")
+
+    return jsonify({
+        "enabled": state.paper_mode,
+        "positions": paper_exchange.positions(username),
+        "orders": paper_exchange.orderbook(username),
+    })
+
+
+@app.route("/copy", methods=["GET", "POST"])
+def copy_trading():
+    """Follow a master account's signal orders (or stop following) and list your own followers"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    if request.method == "POST":
+        values = request.get_json(silent=True) or request.form
+        master = (values.get("master") or "").strip()
+        try:
+            if master:
+                copy_trader.follow(username, master, values.get("multiplier") or 1.0)
+            else:
+                copy_trader.unfollow(username)
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": f"Cannot follow: {e}"})
+        mark_state_dirty(username)
+        log_event(logging.INFO, "Copy subscription updated", user=username, stage="copy", master=master or None)
+
+    return jsonify(copy_trader.describe(username))
+
+
+@app.route("/admin/kill_switch", methods=["GET", "POST", "DELETE"])
+def admin_kill_switch():
+    """Admin only: POST flattens every user (NDJSON progress stream), DELETE lets signal orders through again"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    if username not in ADMIN_USERS:
+        return jsonify({"error": "⚠ Admin access required"}), 403
+
+    if request.method == "DELETE":
+        kill_switch.release()
+        log_event(logging.CRITICAL, "Kill switch released", user=username, stage="kill_switch")
+    elif request.method == "POST":
+        run = kill_switch.start(username)
+        if run is None:
+            return jsonify({"error": "A kill switch run is already in progress"}), 409
+        lines = (json.dumps(record, default=str) + "\n" for record in kill_switch.stream(run))
+        return Response(lines, mimetype="application/x-ndjson")
+
+    return jsonify({"engaged": kill_switch.engaged, "running": kill_switch.running.locked()})
+
+
 @app.route("/exit_position", methods=["POST"])
 def exit_single_position():
     """Exit a single position"""
@@ -1107,10 +5833,14 @@ def start_bot():
     if get_user_data(username, 'bot_running'):
         return jsonify({"error": "⚠️ Bot is already running!"})
 
-    set_user_data(username, 'bot_running', True)
-    bot_thread = threading.Thread(target=background_bot_worker, args=(username,), daemon=True)
-    bot_thread.start()
-    set_user_data(username, 'bot_thread', bot_thread)
+    master = get_user_data(username, 'copy_master')
+    if master:
+        return jsonify({"error": f"⚠️ Following {master}: orders are copied from their bot. Unfollow to run your own."})
+
+    if kill_switch.engaged:
+        return jsonify({"error": "⚠️ Trading is halted by the kill switch. Bots cannot be started until it is released."})
+
+    start_bot_thread(username)
 
     return jsonify({"message": "✅ Bot started! Running in background - you can close browser now!"})
 
@@ -1157,11 +5887,12 @@ def bot_status():
     if active_user_sessions.get(username) != session.get('session_id'):
         return jsonify({"error": "Session expired. Please login again."})
     
-    return jsonify({
-        "running": get_user_data(username, 'bot_running'),
-        "signals": get_user_data(username, 'signals'),
-        "placed_orders": list(get_user_data(username, 'placed_orders'))
-    })
+    state = get_user_state(username)
+    status = state.status()
+    status["feed"] = BOT_FEED_MODE if state.strike_symbols else "chain"
+    status["market"] = trading_calendar.describe()
+    status["orders_pending"] = order_submitter.pending()
+    return jsonify(status)
 
 
 @app.route("/reset", methods=["POST"])
@@ -1175,26 +5906,52 @@ def reset_orders():
     if active_user_sessions.get(username) != session.get('session_id'):
         return jsonify({"error": "Session expired. Please login again."})
     
-    set_user_data(username, 'placed_orders', set())
-    set_user_data(username, 'signals', [])
-    set_user_data(username, 'atm_strike', None)
-    set_user_data(username, 'initial_data', None)
+    reset_baseline(username)
     return jsonify({"message": "✅ Reset successful! You can trade again."})
 
 
-# ---- Background cleanup thread ----
-def cleanup_worker():
-    """Background worker to clean up expired sessions"""
-    while True:
-        try:
-            cleanup_expired_sessions()
-            time.sleep(300)  # Run every 5 minutes
-        except Exception as e:
-            print(f"Cleanup worker error: {e}")
-            time.sleep(60)
+@app.route("/log_level", methods=["GET", "POST"])
+def log_level():
+    """Get or set the log level for the current user's records"""
+    if 'username' not in session:
+        return jsonify({"error": "⚠ Please login first!"})
+
+    username = session.get('username')
+
+    # Verify session is still valid
+    if active_user_sessions.get(username) != session.get('session_id'):
+        return jsonify({"error": "Session expired. Please login again."})
+
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        level = str(data.get("level", "")).upper()
+        if level == "DEFAULT":
+            user_log_levels.pop(username, None)
+        elif isinstance(logging.getLevelName(level), int):
+            user_log_levels[username] = logging.getLevelName(level)
+        else:
+            return jsonify({"error": f"Unknown log level: {level}"})
+
+    return jsonify({"level": logging.getLevelName(user_log_levels.get(username, DEFAULT_LOG_LEVEL))})
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+# ---- Background threads ----
+# Resume checkpointed users and keep checkpointing; journaled orders first so none is repeated
+order_journal.load()
+restore_user_states()
+checkpoint_thread = threading.Thread(target=checkpoint_worker, daemon=True)
+checkpoint_thread.start()
 
-# Start cleanup worker
-cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
+# Session reaper; sessions loaded from disk get a full timeout from startup
+for _username, _session_id in list(active_user_sessions.items()):
+    session_reaper.schedule(_username, _session_id, time.time() + SESSION_TIMEOUT)
+cleanup_thread = threading.Thread(target=session_reaper.run, daemon=True)
 cleanup_thread.start()
 
 
@@ -1282,6 +6039,7 @@ TEMPLATE = """
     .btn-exit-single:hover { background-color: #c82333; }
     #signals { margin-top: 15px; font-weight: bold; color: red; }
     #profits { margin-top: 8px; font-weight: bold; color: green; }
+    #livePnlTotal { font-weight: bold; }
     form { margin-top: 20px; }
     label { margin-right: 10px; }
     input[type="number"], input[type="text"] { padding: 5px; margin-right: 20px; }
@@ -1474,6 +6232,38 @@ TEMPLATE = """
         positionsDiv.innerHTML = html;
     }
 
+    async function fetchPnl(){
+        let res = await fetch("/pnl");
+        let data = await res.json();
+        let pnlDiv = document.getElementById("livePnlTable");
+        let totalDiv = document.getElementById("livePnlTotal");
+        if(data.error){
+            pnlDiv.innerHTML = `<tr><td colspan="6" class="no-positions">${data.error}</td></tr>`;
+            totalDiv.innerHTML = "";
+            return;
+        }
+
+        let open = data.legs.filter(leg => leg.qty !== 0);
+        if(open.length === 0){
+            pnlDiv.innerHTML = `<tr><td colspan="6" class="no-positions">No open legs</td></tr>`;
+        } else {
+            let html = "";
+            open.forEach(leg => {
+                html += `<tr class="${leg.mtm >= 0 ? "profit" : "loss"}">
+                    <td>${leg.symbol}</td>
+                    <td>${leg.qty}</td>
+                    <td>₹${leg.avg_price.toFixed(2)}</td>
+                    <td>${leg.ltp === null ? "-" : "₹" + leg.ltp.toFixed(2)}</td>
+                    <td>₹${leg.mtm.toFixed(2)}</td>
+                    <td>₹${leg.realized.toFixed(2)}</td>
+                </tr>`;
+            });
+            pnlDiv.innerHTML = html;
+        }
+        totalDiv.style.color = data.total >= 0 ? "green" : "red";
+        totalDiv.innerHTML = `MTM: ₹${data.unrealized.toFixed(2)} | Realized: ₹${data.realized.toFixed(2)} | Total: ₹${data.total.toFixed(2)}`;
+    }
+
     async function fetchChain(){
         let res = await fetch("/fetch");
         let data = await res.json();
@@ -1659,13 +6449,32 @@ TEMPLATE = """
         }
     }
 
+    async function fetchAnalytics(){
+        let res = await fetch("/analytics");
+        let data = await res.json();
+        let div = document.getElementById("analytics");
+        if(data.error){
+            div.innerHTML = "";
+            return;
+        }
+        let atm = data.strikes.reduce((best, row) =>
+            best === null || Math.abs(row.strike_price - data.spot) < Math.abs(best.strike_price - data.spot) ? row : best, null);
+        let iv = (value) => value === null || value === undefined ? "-" : value.toFixed(2) + "%";
+        div.innerHTML = `PCR (OI): ${data.pcr_oi ?? "-"} | PCR (Vol): ${data.pcr_volume ?? "-"} | Max Pain: ${data.max_pain ?? "-"}`
+            + (atm ? ` | ATM ${atm.strike_price} IV CE ${iv(atm.CE_IV)} / PE ${iv(atm.PE_IV)}` : "");
+    }
+
     setInterval(fetchChain, 2000);
+    setInterval(fetchAnalytics, 5000);
     setInterval(fetchPositions, 3000);
+    setInterval(fetchPnl, 1000);
     setInterval(checkBotStatus, 3000);
     setInterval(checkSessionStatus, 30000); // Check session every 30 seconds
     window.onload = function(){
         fetchChain();
+        fetchAnalytics();
         fetchPositions();
+        fetchPnl();
         checkBotStatus();
     };
 
@@ -1741,13 +6550,33 @@ TEMPLATE = """
     </table>
   </div>
 
+  <div class="positions-section">
+    <h3>Live P&L</h3>
+    <div id="livePnlTotal"></div>
+    <table class="positions-table">
+      <thead>
+        <tr>
+          <th>Symbol</th>
+          <th>Quantity</th>
+          <th>Avg Price</th>
+          <th>LTP</th>
+          <th>MTM</th>
+          <th>Realized</th>
+        </tr>
+      </thead>
+      <tbody id="livePnlTable">
+        <tr><td colspan="6" class="no-positions">Loading P&L...</td></tr>
+      </tbody>
+    </table>
+  </div>
+
   <form method="POST" action="/">
     <label>CE Strike Offset (from ATM):</label>
     <input type="number" id="ce_strike_offset" name="ce_strike_offset" value="{{ ce_strike_offset }}" required>
     <label>PE Strike Offset (from ATM):</label>
     <input type="number" id="pe_strike_offset" name="pe_strike_offset" value="{{ pe_strike_offset }}" required>
     <br><br>
-    <label>Symbol Prefix:</label>
+    <label>Symbol Prefix (AUTO = nearest expiry):</label>
     <input type="text" id="symbol_prefix" name="symbol_prefix" value="{{ symbol_prefix }}" required>
     <button type="submit" class="btn-reset">Update Settings</button>
   </form>
@@ -1756,6 +6585,7 @@ TEMPLATE = """
     <button type="submit" class="btn-reset">🔄 Reset Orders</button>
   </form>
 
+  <div id="analytics"></div>
   <div id="signals"></div>
   <div id="profits"></div>
   <h3>Option Chain</h3>
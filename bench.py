@@ -0,0 +1,272 @@
+"""Microbenchmarks for the app's hot functions.
+
+Usage:
+    python bench.py                    # run all, compare against bench_baseline.json
+    python bench.py --save-baseline    # run all and store the results as the new baseline
+    python bench.py -k pivot -k atm    # run only benchmarks whose name contains a filter
+    python bench.py --tolerance 0.25   # fail when a median regresses more than 25%
+
+Exit status is 1 when any benchmark is slower than its baseline median by more
+than the tolerance.
+"""
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BASE_DIR, "bench_baseline.json")
+DEFAULT_TOLERANCE = 0.20
+
+# The app reads and writes its data files relative to the working directory,
+# so run everything from a scratch directory.
+WORK_DIR = tempfile.mkdtemp(prefix="algo_bench_")
+os.chdir(WORK_DIR)
+atexit.register(shutil.rmtree, WORK_DIR, ignore_errors=True)
+sys.path.insert(0, BASE_DIR)
+
+import app  # noqa: E402
+
+
+# ---- Fixtures ----
+def make_option_chain(strikecount=20, atm=24500, step=50):
+    """Build a synthetic optionchain response shaped like the Fyers payload"""
+    rng = random.Random(42)
+    options_chain = [{
+        "symbol": "NSE:NIFTY50-INDEX", "strike_price": -1, "option_type": "",
+        "ltp": atm + 3.5, "oi": 0, "volume": 0,
+    }]
+    for i in range(-strikecount, strikecount + 1):
+        strike = atm + i * step
+        for option_type in ("CE", "PE"):
+            intrinsic = max(0, (atm - strike) if option_type == "CE" else (strike - atm))
+            options_chain.append({
+                "symbol": f"NSE:NIFTY25{strike}{option_type}",
+                "strike_price": strike,
+                "option_type": option_type,
+                "ltp": round(intrinsic + rng.uniform(5, 150), 2),
+                "oi": rng.randint(10_000, 50_000_000),
+                "volume": rng.randint(1_000, 200_000_000),
+            })
+    return {"data": {"optionsChain": options_chain, "underlyingValue": atm + 3.5}}
+
+
+def write_users_file(count):
+    """Write a users file with `count` users and return the last username"""
+    hashed = app.hash_password("secret123")
+    with open(app.USERS_FILE, 'w') as f:
+        for i in range(count):
+            f.write(json.dumps({
+                'username': f"user{i}",
+                'password': hashed,
+                'email': f"user{i}@example.com",
+                'phone': "9999999999",
+                'fyers_client_id': f"APP{i:05d}-100",
+                'fyers_secret_key': "S3CR3T",
+            }) + '\n')
+    return f"user{count - 1}"
+
+
+# ---- Benchmarks ----
+def bench_pivot():
+    options_data = make_option_chain()["data"]["optionsChain"]
+    return lambda: app.build_option_pivot(options_data)
+
+
+def bench_atm():
+    response = make_option_chain()
+    df_pivot = app.build_option_pivot(response["data"]["optionsChain"])
+    return lambda: app.detect_atm_strike(response["data"], df_pivot)
+
+
+def bench_signal_check():
+    response = make_option_chain()
+    df_pivot = app.build_option_pivot(response["data"]["optionsChain"])
+    atm = app.detect_atm_strike(response["data"], df_pivot)
+    initial_data = df_pivot.to_dict(orient="records")
+    placed_orders = set()
+    return lambda: app.find_offset_signals(df_pivot, initial_data, atm - 300, atm + 300, placed_orders)
+
+
+def bench_to_json():
+    df_pivot = app.build_option_pivot(make_option_chain()["data"]["optionsChain"])
+    return lambda: df_pivot.to_json(orient="records")
+
+
+def _bench_load_users(count):
+    def setup():
+        write_users_file(count)
+        return app.load_users
+    return setup
+
+
+def _bench_verify_user(count):
+    def setup():
+        username = write_users_file(count)
+        return lambda: app.verify_user(username, "secret123")
+    return setup
+
+
+def bench_save_active_sessions():
+    app.active_user_sessions.clear()
+    for i in range(10_000):
+        app.active_user_sessions[f"user{i}"] = f"{i:08d}-0000-4000-8000-000000000000"
+    return app.save_active_sessions
+
+
+def bench_format_in_crores():
+    values = [12, 99_999, 250_000, 7_500_000, 12_345_678, 987_654_321, "n/a"]
+    def run():
+        for value in values:
+            app.format_in_crores(value)
+    return run
+
+
+def bench_user_state_access():
+    app.init_user_data("bench_user")
+    keys = ('atm_strike', 'initial_data', 'symbol_prefix', 'ce_strike_offset',
+            'pe_strike_offset', 'placed_orders', 'bot_running')
+    def run():
+        for key in keys:
+            app.get_user_data("bench_user", key)
+        app.set_user_data("bench_user", 'bot_thread', None)
+    return run
+
+
+def bench_strategy_rules():
+    """5,000 rules over 1,000 running users, none firing, evaluated against one chain"""
+    response = make_option_chain()
+    df_pivot = app.build_option_pivot(response["data"]["optionsChain"])
+    atm = app.detect_atm_strike(response["data"], df_pivot)
+    initial_data = df_pivot.to_dict(orient="records")
+    for _ in range(40):
+        app.chain_history.append(df_pivot, time.perf_counter())
+    rules = [
+        "CE ATM-300 if ltp_chg > 1000",
+        "PE ATM+300 if ltp_chg_pct > 500 and oi_chg > 0",
+        "CE ATM-100 if ltp_roc(10) > 400 between 09:20 and 15:00",
+        "PE ATM+100 if oi_delta(30) > 900000000 and volume > 0",
+        "CE ATM if ltp > 100000 and oi_chg_pct < -1000",
+    ]
+    for i in range(1_000):
+        username = f"rules_user{i}"
+        state = app.get_user_state(username)
+        state.set_baseline(atm, initial_data, None, None)
+        state.fyers = object()
+        state.bot_running = True
+        app.strategy_engine.set_rules(username, rules)
+    return lambda: app.strategy_engine.evaluate(df_pivot, time.perf_counter())
+
+
+BENCHMARKS = [
+    ("pivot", bench_pivot),
+    ("atm", bench_atm),
+    ("signal_check", bench_signal_check),
+    ("pivot_to_json", bench_to_json),
+    ("load_users_1k", _bench_load_users(1_000)),
+    ("load_users_100k", _bench_load_users(100_000)),
+    ("verify_user_1k", _bench_verify_user(1_000)),
+    ("verify_user_100k", _bench_verify_user(100_000)),
+    ("save_active_sessions_10k", bench_save_active_sessions),
+    ("format_in_crores", bench_format_in_crores),
+    ("user_state_access", bench_user_state_access),
+    ("strategy_rules_5k", bench_strategy_rules),
+]
+
+
+# ---- Runner ----
+def autorange(func, min_time=0.05):
+    """Return a loop count so that one sample takes at least `min_time` seconds"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_time or number >= 1_000_000:
+            return number
+        number *= 2
+
+
+def measure(func, warmup, repeat):
+    """Time `func` and return per-call statistics in microseconds"""
+    for _ in range(warmup):
+        func()
+    number = autorange(func)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number * 1e6)
+    samples.sort()
+    return {
+        "loops": number,
+        "min_us": samples[0],
+        "median_us": statistics.median(samples),
+        "mean_us": statistics.fmean(samples),
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "p95_us": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+    }
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE, 'r') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the app's hot functions")
+    parser.add_argument("-k", dest="filters", action="append", default=[],
+                        help="only run benchmarks whose name contains this string (repeatable)")
+    parser.add_argument("--warmup", type=int, default=3, help="warmup calls before timing")
+    parser.add_argument("--repeat", type=int, default=7, help="timed samples per benchmark")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed median regression as a fraction of the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store results as the new baseline")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline()
+    results = {}
+    regressions = []
+
+    print(f"{'benchmark':<28}{'median':>12}{'min':>12}{'p95':>12}{'stdev':>10}  vs baseline")
+    for name, setup in BENCHMARKS:
+        if args.filters and not any(k in name for k in args.filters):
+            continue
+        stats = measure(setup(), args.warmup, args.repeat)
+        results[name] = stats
+
+        verdict = "-"
+        base = baseline.get(name)
+        if base:
+            ratio = stats["median_us"] / base["median_us"] - 1
+            verdict = f"{ratio:+.1%}"
+            if ratio > args.tolerance:
+                verdict += "  REGRESSION"
+                regressions.append(name)
+        print(f"{name:<28}{stats['median_us']:>10.1f}us{stats['min_us']:>10.1f}us"
+              f"{stats['p95_us']:>10.1f}us{stats['stdev_us']:>8.1f}us  {verdict}")
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {BASELINE_FILE}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed past {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())